@@ -25,12 +25,13 @@ from .armature import (
     rescale_one_bone
 )
 
-from . import add_extras, importer, armature, solve_for_deform, attributes
+from . import add_extras, importer, armature, solve_for_deform, attributes, weights, spatial, unity_dump, import_cache, batch_import, textures, texture_analysis, proxies, lazy_textures, mesh_ops, prefabs, rig_tables
 
 from bpy.props import (
     BoolProperty,
     EnumProperty,
     FloatProperty,
+    IntProperty,
     PointerProperty,
     StringProperty,
     FloatVectorProperty
@@ -193,46 +194,9 @@ def load_presets():
         except Exception as e:
             print(f"Failed to load presets from {config_path}: {e}")
 
-    map_path = os.path.dirname(__file__) + "/assets/hash_map.txt"
-    textures = set()
-    try:
-        with open(map_path, "r") as f:
-            for x in f:
-                x = x.strip().split(' ', 1)
-                importer.hash_to_file_map[x[1]] = x[0]
-                textures.add(x[0])
-    except Exception as e:
-        print(f"Failed to load hash map: {e}")
-
-    saved_hash_map = None
-    try:
-        saved_hash_map = open(map_path, "a")
-    except Exception as e:
-        print(f"Failed to open hash map for writing: {e}")
-
-    n = 0
-    for x in preset_map:
-        dump_dir = preset_map[x].get_path()
-        try:
-            texture_dir = dump_dir + '/Textures/'
-            v = os.listdir(texture_dir)
-            for f in v:
-                if f.endswith('.png'):
-                    ff = texture_dir + f
-                    if ff in textures:
-                        continue
-                    try:
-                        md5 = hashlib.md5(open(ff, 'rb').read()).hexdigest()
-                        importer.hash_to_file_map[md5] = ff
-                        saved_hash_map.write(ff + " " + md5 + "\n")
-                        n += 1
-                    except:
-                        pass
-        except:
-            pass
-    if saved_hash_map:
-        saved_hash_map.close()
-    print(f"{n} newly indexed textures, {len(importer.hash_to_file_map)} unique hashes")
+    # Texture dedup hashes are brought up to date in the background
+    textures.load_index()
+    textures.start_indexing([preset_map[x].get_path() + '/Textures/' for x in preset_map])
 
 in_preset_select = False
 def preset_update(self, context):
@@ -400,6 +364,13 @@ injector_options = [
     ("No", "No", "Do not attach")
 ]
 
+texture_proxy_options = [
+    ("1", "Full resolution", "Use the textures as exported"),
+    ("2", "1/2", "Use proxy textures at half resolution"),
+    ("4", "1/4", "Use proxy textures at quarter resolution"),
+    ("8", "1/8", "Use proxy textures at 1/8 resolution")
+]
+
 def get_attr(name):
     return attributes.get_attr(name)
 
@@ -497,6 +468,29 @@ class hs2rig_props(PropertyGroup):
         default=True,
         description="Transfer weights from torso to clothing items covering it"
     )
+    use_import_cache: BoolProperty(
+        name="Import cache",
+        default=True,
+        description="Restore characters imported before with the same files and options from a saved .blend instead of importing them again"
+    )
+    texture_proxy: EnumProperty(
+        name="Textures",
+        items=texture_proxy_options,
+        default="1",
+        description="Texture resolution of imported characters in the viewport (full resolution is always used for rendering)"
+    )
+    defer_textures: BoolProperty(
+        name="Deferred clothing textures",
+        default=False,
+        description="Import clothing and accessories hidden, and only load hair, clothing and accessory textures once they are shown or rendered"
+    )
+    import_workers: IntProperty(
+        name="Import workers",
+        default=4,
+        min=1,
+        max=64,
+        description="Number of background Blender processes used by Load all presets / Load favorite presets (1 imports in this Blender, one character at a time)"
+    )
     add_exhaust: BoolProperty(
         name="Add an exhaust",
         default=True,
@@ -565,10 +559,11 @@ def set_fixed_pose(context, pose):
     v += finger_curl(0.0 if (pose == 'T' or pose == 'Pray') else context.scene.hs2rig_data.finger_curl_scale)
     if "deformed_rig" in arm:
         deformed_rig = arm["deformed_rig"]
-        for x in arm.pose.bones:
+        fk = numpy.flatnonzero(armature.bone_class_table(arm)['fk'][:, 3])
+        for x in [arm.pose.bones[k] for k in fk.tolist()]:
             if x.name in ['balls', 'stick_01', 'stick_02', 'stick_03', 'stick_04', 'tip_base', 'fskin_bottom', 'fskin_top', 'fskin_left', 'fskin_right', 'sheath']:
                 continue
-            if x.name in deformed_rig and armature.bone_class(x.name, 'rotation') == 'f':
+            if x.name in deformed_rig:
                 default_rig = Matrix(deformed_rig[x.name]).decompose()
                 current_rig = x.matrix_basis.decompose()
                 current_rig = (current_rig[0], default_rig[1], current_rig[2])
@@ -595,16 +590,20 @@ class hs2rig_OT_execute(Operator):
     def execute(self, context):
         arm = hs2object()
         if arm is not None:
-            if context.scene.hs2rig_data.command == 'nails':
-                add_extras.tweak_nails(arm, arm["body"])
-            elif context.scene.hs2rig_data.command == 'eye_shape':
-                add_extras.eye_shape(arm, arm["body"], None)
-            elif context.scene.hs2rig_data.command == 'lip_shape':
-                add_extras.lip_arch_shapekey(arm, arm["body"], None)
-            elif context.scene.hs2rig_data.command == 'nose_shape':
-                add_extras.nasolabial_crease(arm, arm["body"], None)
-            else:
-                getattr(normalizer, context.scene.hs2rig_data.command)(arm, arm["body"])
+            weights.begin_caching()
+            try:
+                if context.scene.hs2rig_data.command == 'nails':
+                    add_extras.tweak_nails(arm, arm["body"])
+                elif context.scene.hs2rig_data.command == 'eye_shape':
+                    add_extras.eye_shape(arm, arm["body"], None)
+                elif context.scene.hs2rig_data.command == 'lip_shape':
+                    add_extras.lip_arch_shapekey(arm, arm["body"], None)
+                elif context.scene.hs2rig_data.command == 'nose_shape':
+                    add_extras.nasolabial_crease(arm, arm["body"], None)
+                else:
+                    getattr(normalizer, context.scene.hs2rig_data.command)(arm, arm["body"])
+            finally:
+                weights.end_caching()
         return {'FINISHED'}
 
 class hs2rig_OT_reset_cust(Operator):
@@ -718,7 +717,10 @@ class hs2rig_OT_load_preset_character(Operator):
             c_hair=hair_color,
             name=name,
             customization=preset.get("customization"),
-            reweight_clothing=context.scene.hs2rig_data.reweight_clothing
+            reweight_clothing=context.scene.hs2rig_data.reweight_clothing,
+            use_cache=context.scene.hs2rig_data.use_import_cache,
+            texture_proxy=int(context.scene.hs2rig_data.texture_proxy),
+            defer_textures=context.scene.hs2rig_data.defer_textures
         )
         if uuid is not None:
             arm["preset_uuid"] = uuid
@@ -825,41 +827,104 @@ class hs2rig_OT_import(DirSelector):
             c_eye=eye_color,
             c_hair=hair_color,
             name=name,
-            customization=None
+            customization=None,
+            use_cache=context.scene.hs2rig_data.use_import_cache,
+            texture_proxy=int(context.scene.hs2rig_data.texture_proxy),
+            defer_textures=context.scene.hs2rig_data.defer_textures
         )
         bpy.context.scene.hs2rig_data.standard_poses = "T"
         return {'FINISHED'}
 
 class hs2rig_OT_import_subset(Operator):
     bl_options = {'REGISTER', 'UNDO'}
+
+    def import_args(self, context, preset):
+        return dict(
+            input=preset.get_path(),
+            refactor=context.scene.hs2rig_data.refactor,
+            do_extend_safe=context.scene.hs2rig_data.extend_safe,
+            do_extend_full=context.scene.hs2rig_data.extend_full,
+            replace_teeth=context.scene.hs2rig_data.replace_teeth,
+            add_injector=context.scene.hs2rig_data.add_injector,
+            add_exhaust=context.scene.hs2rig_data.add_exhaust,
+            subdivide=context.scene.hs2rig_data.subdivide,
+            c_eye=[float(x) for x in preset.eye_color],
+            c_hair=[float(x) for x in preset.hair_color],
+            name=preset.name,
+            customization=preset.get("customization"),
+            use_cache=context.scene.hs2rig_data.use_import_cache,
+            texture_proxy=int(context.scene.hs2rig_data.texture_proxy),
+            defer_textures=context.scene.hs2rig_data.defer_textures
+        )
+
+    def place(self, context, preset, arm):
+        if arm is not None:
+            arm.location = Vector([self.count, 0, 0])
+            self.count += 1
+            if "uuid" in preset:
+                arm["preset_uuid"] = preset["uuid"]
+            attributes.push_mat_attributes(preset)
+            bpy.context.scene.hs2rig_data.standard_poses = "T"
+
     def execute(self, context):
         print("trying to import...")
-        count = 0
-        for value in preset_map:
-            preset = preset_map[value]
-            if not self.import_check(preset["uuid"]):
-                continue
-            arm = importer.import_body(
-                preset.get_path(),
-                refactor=context.scene.hs2rig_data.refactor,
-                do_extend_safe=context.scene.hs2rig_data.extend_safe,
-                do_extend_full=context.scene.hs2rig_data.extend_full,
-                replace_teeth=context.scene.hs2rig_data.replace_teeth,
-                add_injector=context.scene.hs2rig_data.add_injector,
-                add_exhaust=context.scene.hs2rig_data.add_exhaust,
-                subdivide=context.scene.hs2rig_data.subdivide,
-                c_eye=preset.eye_color,
-                c_hair=preset.hair_color,
-                name=preset.name,
-                customization=preset.get("customization")
-            )
-            if arm is not None:
-                arm.location = Vector([count, 0, 0])
-                count += 1
-            if "uuid" in preset_map[value]:
-                arm["preset_uuid"] = preset_map[value]["uuid"]
-            attributes.push_mat_attributes(preset_map[value])
-            bpy.context.scene.hs2rig_data.standard_poses = "T"
+        self.count = 0
+        self.presets = [preset_map[value] for value in preset_map if self.import_check(preset_map[value]["uuid"])]
+        workers = context.scene.hs2rig_data.import_workers
+        if workers <= 1 or len(self.presets) <= 1 or bpy.app.background:
+            for preset in self.presets:
+                arm = importer.import_body(**self.import_args(context, preset))
+                self.place(context, preset, arm)
+            return {'FINISHED'}
+
+        # Import in background Blenders and append the results in preset order as they come in
+        jobs = [self.import_args(context, x) for x in self.presets]
+        for x in jobs:
+            x["texture_proxy"] = 1
+        self.batch = batch_import.BatchImport(jobs, workers)
+        self.next = 0
+        self.batch.poll()
+        wm = context.window_manager
+        wm.progress_begin(0, len(self.presets))
+        self.timer = wm.event_timer_add(0.5, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal(self, context, event):
+        if event.type == 'ESC':
+            self.batch.cancel()
+            self.report({'WARNING'}, "Batch import cancelled")
+            return self.finish_batch(context)
+        if event.type != 'TIMER':
+            return {'PASS_THROUGH'}
+        self.batch.poll()
+        while self.next < len(self.presets) and self.batch.status[self.next] is not None:
+            fn = self.batch.result(self.next)
+            if fn is not None:
+                arm = import_cache.append_character(fn)
+                if arm is not None:
+                    importer.add_skin_tone_properties(arm["Skin tone"])
+                    bpy.context.view_layer.objects.active = arm
+                    bpy.ops.object.mode_set(mode='POSE')
+                    if context.scene.hs2rig_data.texture_proxy != "1":
+                        proxies.set_resolution(arm, int(context.scene.hs2rig_data.texture_proxy))
+                self.place(context, self.presets[self.next], arm)
+            self.next += 1
+        context.window_manager.progress_update(self.batch.finished_count())
+        context.workspace.status_text_set("Importing characters: %d/%d done" % (self.batch.finished_count(), len(self.presets)))
+        if self.next == len(self.presets):
+            return self.finish_batch(context)
+        return {'PASS_THROUGH'}
+
+    def finish_batch(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+        failed = [x["name"] for x in self.batch.status if x is not None and not x["ok"]]
+        self.batch.cleanup()
+        if len(failed) > 0:
+            self.report({'WARNING'}, "Failed to import: " + ", ".join(failed))
         return {'FINISHED'}
 
 class hs2rig_OT_import_all(hs2rig_OT_import_subset):
@@ -876,6 +941,30 @@ class hs2rig_OT_import_favorites(hs2rig_OT_import_subset):
     def import_check(self, uuid):
         return uuid in preset_favorites
 
+class hs2rig_OT_share_textures(Operator):
+    bl_idname = "object.share_textures"
+    bl_label = "Share identical textures"
+    bl_description = "Merge images loaded from files with identical content and report the texture memory saved by sharing"
+    bl_options = {'REGISTER', 'UNDO'}
+    def execute(self, context):
+        merged, _ = textures.share_images()
+        n, saved = textures.memory_report()
+        self.report({'INFO'}, "%d images merged; %d texture files share existing images, %.1f MB saved" % (merged, n, saved / (1<<20)))
+        return {'FINISHED'}
+
+class hs2rig_OT_texture_resolution(Operator):
+    bl_idname = "object.texture_resolution"
+    bl_label = "Texture resolution"
+    bl_description = "Switch the character between full resolution and proxy textures (rendering always uses full resolution)"
+    bl_options = {'REGISTER', 'UNDO'}
+    resolution: EnumProperty(name="Resolution", items=texture_proxy_options, default="1")
+    def execute(self, context):
+        h = hs2object()
+        if h is None:
+            return {'FINISHED'}
+        proxies.set_resolution(h, int(self.resolution))
+        return {'FINISHED'}
+
 class hs2rig_OT_reload_presets(Operator):
     bl_idname = "object.reload_presets"
     bl_label = "Reload presets"
@@ -973,6 +1062,8 @@ class HS2RIG_PT_ui(Panel):
             box.prop(context.scene.hs2rig_data, "standard_poses")
             row = layout.row(align=True)
             row.operator("object.toggle_clothing")
+            resolution = dict((x[0], x[1]) for x in texture_proxy_options).get(str(arm.get("texture resolution", 1)), "Full resolution")
+            row.operator_menu_enum("object.texture_resolution", "resolution", text="Textures: " + resolution)
             row = layout.row(align=True)
             row.prop(context.scene.hs2rig_data, "finger_curl_scale", slider=True)
             row.prop(context.scene.hs2rig_data, "mouth_open", slider=True)
@@ -1041,7 +1132,15 @@ class HS2RIG_PT_ui(Panel):
         box = layout.box()
         box.label(text="System settings")
         box.prop(context.scene.hs2rig_data, "export_dir")
+        box.prop(context.scene.hs2rig_data, "use_import_cache")
+        box.prop(context.scene.hs2rig_data, "import_workers")
+        box.prop(context.scene.hs2rig_data, "texture_proxy")
+        box.prop(context.scene.hs2rig_data, "defer_textures")
         box.prop(context.scene.hs2rig_data, "presets")
+        box.operator("object.share_textures")
+        status = textures.indexing_status()
+        if status is not None:
+            box.label(text=status)
         row = box.row(align=True)
         row.operator("object.reload_presets")
         row.operator("object.save_presets")
@@ -1082,6 +1181,8 @@ addon_classes = [
     hs2rig_OT_import_favorites,
     hs2rig_OT_save_presets,
     hs2rig_OT_reload_presets,
+    hs2rig_OT_share_textures,
+    hs2rig_OT_texture_resolution,
     hs2rig_OT_add_new_preset,
     hs2rig_OT_delete_preset,
     hs2rig_OT_reset_skin_tone,
@@ -1101,16 +1202,29 @@ def unregister():
             pass
     if hasattr(bpy.types.Scene, 'hs2rig_data'):
         del bpy.types.Scene.hs2rig_data
+    proxies.unregister_handlers()
+    lazy_textures.unregister_handlers()
 
 def register():
     global config_path
     config_path = os.path.dirname(__file__) + "/assets/hs2blender.cfg"
-    load_presets()
     print("Registering...")
     for x in addon_classes:
         bpy.utils.register_class(x)
     bpy.types.Scene.hs2rig_data = PointerProperty(type=hs2rig_props)
     import importlib
+    importlib.reload(weights)
+    importlib.reload(spatial)
+    importlib.reload(mesh_ops)
+    importlib.reload(prefabs)
+    importlib.reload(rig_tables)
+    importlib.reload(textures)
+    importlib.reload(texture_analysis)
+    importlib.reload(proxies)
+    importlib.reload(lazy_textures)
+    importlib.reload(unity_dump)
+    importlib.reload(import_cache)
+    importlib.reload(batch_import)
     importlib.reload(add_extras)
     importlib.reload(attributes)
     importlib.reload(importer)
@@ -1120,6 +1234,10 @@ def register():
     if normalizer_enabled:
         importlib.reload(normalizer)
     importlib.reload(solve_for_deform)
+    proxies.register_handlers()
+    lazy_textures.register_handlers()
+    # After the reloads, so the texture index it loads isn't reset by them
+    load_presets()
 
 if __name__ == "__main__":
     register()
@@ -8,26 +8,22 @@ from mathutils import Matrix, Vector, Euler, Quaternion
 import struct
 import numpy as np
 from .importer import replace_mat, set_tex, set_bump, join_meshes, disconnect_link
+from .weights import get_weight_table, invalidate_weight_table
+from .spatial import PointIndex, world_coordinates
 import time
 import random
 
-from . import armature
+from . import armature, prefabs
 
 from .attributes import set_attr
 
 def clamp01(x):
     return max(0.0, min(1.0, x))
 
+# For each vertex in 'subset2', the position in 'subset1' of the nearest vertex
 def find_nearest_vertices(body, subset1, subset2):
-    cos = np.zeros([len(body.data.vertices)*3], dtype=np.float32)
-    body.data.vertices.foreach_get("co", cos)
-    cos = cos.reshape([-1,3])
-    ys = cos[subset1].reshape([1,-1,3])
-    xs = cos[subset2].reshape([-1,1,3])
-    xy = xs-ys
-    xy *= xy
-    xy = np.sqrt(xy[:,:,0]+xy[:,:,1]+xy[:,:,2])
-    return np.argmin(xy, axis=1)
+    cos = get_vertex_array(body)
+    return PointIndex(cos[subset1]).nearest(cos[subset2])[0]
 
 
 def make_child_bone(arm, parent, name, offset, collection, rotation_mode='XYZ', 
@@ -70,6 +66,32 @@ def make_child_bone(arm, parent, name, offset, collection, rotation_mode='XYZ',
         armature.copy_rotation(arm, name)
 
 
+# Per-vertex attribute ('co', 'normal', 'undeformed_co') of all vertices as a (V,3) array
+def get_vertex_array(body, attr="co"):
+    out = np.zeros([len(body.data.vertices)*3], dtype=np.float32)
+    body.data.vertices.foreach_get(attr, out)
+    return out.reshape([-1,3]).astype(np.float64)
+
+# 'uv1' coordinates of all vertices as a (V,2) array, taken from the lowest-numbered loop
+# of each vertex ((0,0) for loose vertices)
+def get_vertex_uvs(body):
+    mesh = body.data
+    loop_uv = np.zeros([len(mesh.loops)*2], dtype=np.float32)
+    mesh.uv_layers['uv1'].data.foreach_get("uv", loop_uv)
+    loop_vert = np.zeros([len(mesh.loops)], dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", loop_vert)
+    verts, first = np.unique(loop_vert, return_index=True)
+    out = np.zeros([len(mesh.vertices),2])
+    out[verts] = loop_uv.reshape([-1,2])[first]
+    return out
+
+# 'uv1' coordinates of the first loop of each vertex in 'verts'
+def vertex_uvs(bm, verts):
+    lay = bm.loops.layers.uv['uv1']
+    return np.array([bm.verts[x].link_loops[0][lay].uv[:] for x in verts], dtype=np.float64).reshape([-1,2])
+
+# Single-vertex helpers, fine for a handful of lookups. Repaints that touch many vertices
+# should go through a WeightTable instead.
 def get_weight(body, vertex, group):
     if isinstance(group, str):
         group = body.vertex_groups[group].index
@@ -86,9 +108,11 @@ def set_weight(body, vertex, group, weight):
     for g in body.data.vertices[vertex].groups:
         if g.group==group:
             g.weight=weight
+            invalidate_weight_table(body)
             return
     if group>=0:
         body.vertex_groups[group].add([vertex], weight, 'ADD')
+        invalidate_weight_table(body)
 
 def add_weight(body, vertex, group, weight):
     if isinstance(group, tuple) or isinstance(group, list):
@@ -104,36 +128,25 @@ def add_weight(body, vertex, group, weight):
 
     if isinstance(group, str):
         group = body.vertex_groups[group].index
+    invalidate_weight_table(body)
     for g in body.data.vertices[vertex].groups:
         if g.group==group:
             g.weight+=weight
             return
     body.vertex_groups[group].add([vertex], weight, 'ADD')
 
+# Indices of vertices with weight above 'min_wt' in VG 'name' (or in any of a list of VGs), in ascending order
 def vgroup(obj, name, min_wt=None):
-    if min_wt is None:
-        min_wt = 0.0
-    if isinstance(name, list):
-        ids = [obj.vertex_groups[vg].index for vg in name if vg in obj.vertex_groups]
-        return [x for x in range(len(obj.data.vertices)) if any([(g.group==id and g.weight>min_wt) for g in obj.data.vertices[x].groups for id in ids])]
-
-    if not name in obj.vertex_groups:
-        return []
-
-    id=obj.vertex_groups[name].index
-    if min_wt is None:
-        return [x for x in range(len(obj.data.vertices)) if id in [g.group for g in obj.data.vertices[x].groups]]
-    else:
-        return [x for x in range(len(obj.data.vertices)) if any([(g.group==id and g.weight>min_wt) for g in obj.data.vertices[x].groups])]
+    return get_weight_table(obj).members(name, min_wt).tolist()
 
 
-# Calls 'func' for each vertex in 'vg' (which is an index, a string, or a list of vertex groups), to calculate 'wt' (a value in 0 to 1 range).
-# Assigns weight 'wt' to the newly created VG and reduces weights of all other VGs on that vertex, without changing their relative weights.
-def create_functional_vgroup(body, name, vg, func, bm = None):
-    if name in body.vertex_groups:
-        body.vertex_groups.remove(body.vertex_groups[name])
-    new_group = body.vertex_groups.new(name=name)
-    new_id  = new_group.index
+# Evaluates a vertex formula on the vertices 'v' (an index array).
+# Scalar formulas are called once per vertex with uv, vert, co (undeformed), norm and set_id (position in 'v').
+# Vectorized formulas are called once, with the same arguments as arrays: uv (n,2), vert (n,), co (n,3), norm (n,3), set_id (n,).
+def eval_formula(body, v, func, bm=None, vectorized=False):
+    if vectorized:
+        return np.asarray(func(uv=get_vertex_uvs(body)[v], vert=v, co=get_vertex_array(body, "undeformed_co")[v],
+            norm=get_vertex_array(body, "normal")[v], set_id=np.arange(len(v))), dtype=np.float64)
     if bm is None:
         bm = bmesh.new()
         bm.from_mesh(body.data)
@@ -143,78 +156,63 @@ def create_functional_vgroup(body, name, vg, func, bm = None):
     else:
         bm_owned = False
     lay = bm.loops.layers.uv['uv1']
-    v = vgroup(body, vg)
-    for x in v:
-        uv = bm.verts[x].link_loops[0][lay].uv
-        wt = func(uv=uv, vert=x, co=body.data.vertices[x].undeformed_co, norm=body.data.vertices[x].normal)
-        if wt > 0:
-            s = 0
-            for g in body.data.vertices[x].groups:
-                s += g.weight
-            for g in body.data.vertices[x].groups:
-                g.weight *= (1-wt)/s
-            add_weight(body, x, new_id, wt)
+    vs = body.data.vertices
+    out = []
+    for i, x in enumerate(v.tolist()):
+        uv = bm.verts[x].link_loops[0][lay].uv if len(bm.verts[x].link_loops)>0 else (0,0)
+        out.append(func(uv=uv, vert=x, co=vs[x].undeformed_co, norm=vs[x].normal, set_id=i))
     if bm_owned:
         bm.free()
+    return np.array(out, dtype=np.float64)
+
+# Calls 'func' for each vertex in 'vg' (which is an index, a string, or a list of vertex groups), to calculate 'wt' (a value in 0 to 1 range).
+# Assigns weight 'wt' to the newly created VG and reduces weights of all other VGs on that vertex, without changing their relative weights.
+def create_functional_vgroup(body, name, vg, func, bm = None, vectorized=False):
+    table = get_weight_table(body)
+    if name in body.vertex_groups:
+        table.remove_group(name)
+    new_id = table.new_group(name)
+    v = table.members(vg)
+    wt = eval_formula(body, v, func, bm, vectorized)
+    v, wt = v[wt>0], wt[wt>0]
+    table.normalize(v, 1-wt)
+    table.add(v, new_id, wt)
+    table.flush()
 
 # Similar to 'create_functional_vgroup', except that it reduces weights of _only_ vertex groups specified in 'vg'.
-def split_vgroup(body, name, vg, func, bm = None):
-    if not name in body.vertex_groups:
-        body.vertex_groups.new(name=name)
+def split_vgroup(body, name, vg, func, bm = None, vectorized=False):
+    table = get_weight_table(body)
+    new_id = table.new_group(name)
     if isinstance(vg, list):
-        old_id = [body.vertex_groups[x].index for x in vg]
+        old_id = [table.group_index(x) for x in vg]
     else:
-        old_id = [body.vertex_groups[vg].index]
-    new_id = body.vertex_groups[name].index
-    if bm is None:
-        bm = bmesh.new()
-        bm.from_mesh(body.data)
-        bm.verts.ensure_lookup_table()
-        bm.faces.ensure_lookup_table()
-        bm_owned = True
-    else:
-        bm_owned = False
-    lay = bm.loops.layers.uv['uv1']
-    v = vgroup(body, vg)
-    for x in v:
-        uv = bm.verts[x].link_loops[0][lay].uv
-        wold = [get_weight(body, x, y) for y in old_id]
-        frac = func(uv=uv, vert=x, co=body.data.vertices[x].undeformed_co, norm=body.data.vertices[x].normal)
-        for k in range(len(old_id)):
-            set_weight(body, x, old_id[k], wold[k]*(1.-frac))
-        set_weight(body, x, new_id, sum(wold)*frac)
-    if bm_owned:
-        bm.free()
-
-def create_functional_shape_key(body, name, vg, func, on=True, max=1.0, bm=None):
+        old_id = [table.group_index(vg)]
+    v = table.members(vg)
+    frac = eval_formula(body, v, func, bm, vectorized)
+    wold = [table.get(v, y) for y in old_id]
+    for k in range(len(old_id)):
+        table.set(v, old_id[k], wold[k]*(1.-frac))
+    table.set(v, new_id, sum(wold)*frac)
+    table.flush()
+
+# Calls 'func' for each vertex in 'vg' to calculate its offset (a 3-vector) in the new shape key 'name'.
+def create_functional_shape_key(body, name, vg, func, on=True, max=1.0, bm=None, vectorized=False):
     if name in body.data.shape_keys.key_blocks:
         body.shape_key_remove(key=body.data.shape_keys.key_blocks[name])
     sk = body.shape_key_add(name=name)
     sk.interpolation='KEY_LINEAR'
-    for x in range(len(body.data.vertices)):
-        sk.data[x].co = body.data.shape_keys.key_blocks["Basis"].data[x].co
-    if bm is None:
-        bm = bmesh.new()
-        bm.from_mesh(body.data)
-        bm.verts.ensure_lookup_table()
-        bm.faces.ensure_lookup_table()
-        bm_owned = True
-    else:
-        bm_owned = False
-    lay = bm.loops.layers.uv['uv1']
+    co = np.zeros([len(body.data.vertices)*3], dtype=np.float32)
+    body.data.shape_keys.key_blocks["Basis"].data.foreach_get("co", co)
+    co = co.reshape([-1,3])
 
     if isinstance(vg, list) and isinstance(vg[0], int):
-        v = vg
+        v = np.array(vg, dtype=np.int64)
     else:
-        v = vgroup(body, vg)
-
-    for i, x in enumerate(v):        
-        uv = bm.verts[x].link_loops[0][lay].uv if len(bm.verts[x].link_loops)>0 else (0,0)
-        sk.data[x].co += func(uv=uv, vert=x, co=body.data.vertices[x].undeformed_co, norm=body.data.vertices[x].normal, set_id=i)
+        v = get_weight_table(body).members(vg)
+    co[v] += eval_formula(body, v, func, bm, vectorized).reshape([-1,3])
+    sk.data.foreach_set("co", co.reshape([-1]))
     body.data.shape_keys.key_blocks[name].value=0.
     body.data.shape_keys.key_blocks[name].slider_max=max
-    if bm_owned:
-        bm.free()
 
 
 def sigmoid(x, x_full=None, x_min=None):
@@ -332,18 +330,124 @@ def curve_interp(curve, x, xsymm = False, cubic=False, debug=False):
             return interpolate(curve[k][1], curve[k+1][1], curve[k][0], curve[k+1][0], x)
 
 
+#
+# Array versions of the helpers above: same results, but every argument may be a numpy array
+# (broadcast against each other), and the result is an array.
+#
+def np_sigmoid(x, x_full=None, x_min=None):
+    x = np.asarray(x, dtype=np.float64)
+    if x_full is not None:
+        if x_min is None:
+            x = x / x_full
+        else:
+            x = (x-x_full) / np.subtract(x_min, x_full)
+    elif x_min is not None:
+        x = x / x_min
+    return np.where(x<0, 1., np.where(x>1, 0., 0.5*(np.cos(x*3.141526)+1.)))
+
+def np_bump(x, x0, x1, x2, shape='sigmoid'):
+    x = np.asarray(x, dtype=np.float64)
+    lo = np.minimum(x0, x2)
+    hi = np.maximum(x0, x2)
+    if x1 is None:
+        x1 = (lo+hi)/2.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(x<x1, (x-x1) / (x1-lo), (x-x1) / (hi-x1))
+    if shape=='sigmoid':
+        y = 0.5*(np.cos(t*3.141526)+1.)
+    else:
+        y = np.cos(t*3.141526/2.)
+    return np.where((x<lo) | (x>hi), 0.0, y)
+
+def np_interpolate(y1, y2, x1, x2, x):
+    x = np.asarray(x, dtype=np.float64)
+    swap = np.greater(x1, x2)
+    y1, y2 = np.where(swap, y2, y1), np.where(swap, y1, y2)
+    x1, x2 = np.where(swap, x2, x1), np.where(swap, x1, x2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = y1 + (y2-y1) * (x-x1) / (x2-x1)
+    return np.where(x<=x1, y1, np.where(x>=x2, y2, y))
+
+# A UV curve (list of (x, y, ...) points) as arrays, with the per-segment deltas and
+# squared lengths that np_curve_interp and np_curve_find_nearest need precomputed.
+class CurveSegments:
+    def __init__(self, curve):
+        self.points = np.array([p[:2] for p in curve], dtype=np.float64)
+        self.xs = self.points[:,0]
+        self.ys = self.points[:,1]
+        self.delta = self.points[1:]-self.points[:-1]
+        self.length2 = (self.delta*self.delta).sum(axis=1)
+
+_curve_segments = {}
+
+# CurveSegments of 'curve', built once per distinct curve
+def curve_segments(curve):
+    if isinstance(curve, CurveSegments):
+        return curve
+    key = tuple([tuple(p[:2]) for p in curve])
+    if not key in _curve_segments:
+        _curve_segments[key] = CurveSegments(curve)
+    return _curve_segments[key]
+
+def np_curve_interp(curve, x, xsymm = False):
+    x = np.asarray(x, dtype=np.float64)
+    if xsymm:
+        x = np.where(x>0.500, 0.500 - (x-0.500), x)
+
+    if isinstance(curve, list) and isinstance(curve[0], float):
+        c = np.array(curve, dtype=np.float64)
+        k = np.clip(np.floor(x), 0, len(c)-2).astype(np.int64)
+        y = c[k] + (c[k+1]-c[k]) * (x-k)
+        return np.where(x<=0, c[0], np.where(x>=len(c)-1, c[-1], y))
+
+    cs = curve_segments(curve)
+    xs, ys = cs.xs, cs.ys
+    k = np.clip(np.searchsorted(xs, x, side='right')-1, 0, len(xs)-2)
+    y = ys[k] + cs.delta[k,1] * (x-xs[k]) / cs.delta[k,0]
+    return np.where(x<=xs[0], ys[0], np.where(x>=xs[-1], ys[-1], y))
+
+# Same as curve_find_nearest for an (n,2) array of points; returns (pos, t, frac, side, dist)
+# as (n,2), (n,2), (n,), (n,) and (n,) arrays.
+def np_curve_find_nearest(curve, v):
+    cs = curve_segments(curve)
+    p = cs.points
+    v = np.asarray(v, dtype=np.float64).reshape([-1,2])
+    m = len(p)
+    index = np.argmin(((v[:,None,:]-p[None,:,:])**2).sum(axis=2), axis=1)
+    a = p[index]
+    prev = np.maximum(index-1, 0)
+    nxt = np.minimum(index, m-2)
+
+    # closest point on the line through 'a' along 'ab', and its position along ab
+    def project(ab, length2):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = ((v-a)*ab).sum(axis=1) / length2
+        return a + frac[:,None]*ab, frac
+
+    t1 = cs.delta[prev]
+    p1, f1 = project(-cs.delta[prev], cs.length2[prev])
+    ok1 = (index>0) & (f1>=0) & (f1<1.0)
+    p1 = np.where(ok1[:,None], p1, a)
+    frac1 = np.where(ok1, index-f1, index)
+
+    p2, f2 = project(cs.delta[nxt], cs.length2[nxt])
+    ok2 = (index+1<m) & (f2>=0) & (f2<1.0)
+    t2 = np.where(ok2[:,None], cs.delta[nxt], t1)
+    p2 = np.where(ok2[:,None], p2, a)
+    frac2 = np.where(ok2, index+f2, index)
+
+    use1 = ((p1-v)**2).sum(axis=1) < ((p2-v)**2).sum(axis=1)
+    pos = np.where(use1[:,None], p1, p2)
+    t = np.where(use1[:,None], t1, t2)
+    frac = np.where(use1, frac1, frac2)
+    side = (pos[:,0]-v[:,0])*t[:,1] - (pos[:,1]-v[:,1])*t[:,0]
+    dist = np.sqrt(((pos-v)**2).sum(axis=1))
+    return pos, t, frac, side, dist
+
 def weighted_center(body, name):
-    id=body.vertex_groups[name].index
-    mesh=body.data
-    vs=vgroup(body, name)
-    s=Vector()
-    wt=0.0
-    for x in vs:
-        for y in mesh.vertices[x].groups:
-            if y.group==id:
-                s+=mesh.vertices[x].co*y.weight
-                wt+=y.weight
-    return s*(1.0/wt)
+    vs, wt = get_weight_table(body).column(name)
+    co = get_vertex_array(body)[vs]
+    return Vector((co*wt[:,None]).sum(axis=0) / wt.sum())
 
 #
 #
@@ -365,9 +469,9 @@ def eye_shape(arm, body, bm, on=True):
     #for x in range(len(body.data.vertices)):
     #    sk.data[x].co = body.data.shape_keys.key_blocks["Basis"].data[x].co
 
-    eyeball_center_x = sum([body.data.vertices[y].co.x for y in eyeball])/len(eyeball)
-    eyeball_center_y = sum([body.data.vertices[y].co.y for y in eyeball])/len(eyeball)
-    eyeball_center = Vector([eyeball_center_x,eyeball_center_y,0])
+    vco = get_vertex_array(body)
+    vnorm = get_vertex_array(body, "normal")
+    eyeball_center = Vector(list(vco[eyeball,:2].mean(axis=0))+[0])
     #print("Eyeball center:", eyeball_center)
 
     #if 'Eye near' in body.vertex_groups:
@@ -396,45 +500,28 @@ def eye_shape(arm, body, bm, on=True):
     nearest_eye_verts = find_nearest_vertices(body, eyeball, eye_soft)
     print(len(nearest_eye_verts), len(eye_soft))
 
-    def formula(vert, co, norm, uv, set_id, **kwargs):#for x in set(list(v)):
-        x=vert
-        sign = -1 if co[0]>0 else 1
-
-        if co[0]>0:
-            co=Vector((co[0]*-1., co[1], co[2]))
-        #y = min(eyeball, key=lambda z: (co-body.data.vertices[z].co).length)
-        y = eyeball[nearest_eye_verts[set_id]]
-        r = co-body.data.vertices[y].co
-        n = body.data.vertices[y].normal
-        dot = n.dot(r)
-        effect = Vector([0,0,0])
-
-        d = body.data.vertices[x].normal.dot(n)
+    def formula(vert, co, norm, uv, set_id, **kwargs):
+        sign = np.where(co[:,0]>0, -1.0, 1.0)
+        co = co.copy()
+        co[:,0] = np.where(co[:,0]>0, -co[:,0], co[:,0])
+        y = np.array(eyeball)[nearest_eye_verts[set_id]]
+        r = co-vco[y]
+        n = vnorm[y]
+        dot = (n*r).sum(axis=1)
+        d = (norm*n).sum(axis=1)
 
         # if we are <0.01 from eyeball surface and <0.10 from the nearest eyeball vertex, 
         # push the vertex perpendicular to eyeball surface, tucking it under the eyelid
         r_range = 0.010
-        if r.length<0.10 and dot<=0.010:
-            effect = body.data.vertices[x].normal.copy()
-            effect -= n*d
-            effect.normalize()
-            effect *= - sigmoid(d, 0.50, 1.0)
-            effect *= interpolate(0.0075, 0, 0.0, r_range, dot)
-            effect[0] *= sign
-
-        """
-        # pull back the inner corner of the lower eyelid, forming a crease at 45 degree angle
-        if uv[0]>0.500:
-            uv=(1-uv[0],uv[1])
-        if uv[0]>=0.383 and uv[0]<=0.441 and uv[1]<0.518:
-            lower_lid_fold = curve_interp(lower_lid_low_curve, uv[0])
-            w_x = bump(uv[0], 0.383, 0.408, 0.441, shape='cos')
-            w_y = max(0, 1.-abs(uv[1]-lower_lid_fold)/(0.518-lower_lid_fold))
-            effect[2] += -0.01*w_x*w_y
-        """
-        return effect
+        effect = norm - n*d[:,None]
+        length = np.sqrt((effect*effect).sum(axis=1))
+        effect /= np.where(length>0, length, 1.0)[:,None]
+        effect *= (-np_sigmoid(d, 0.50, 1.0) * np_interpolate(0.0075, 0, 0.0, r_range, dot))[:,None]
+        effect[:,0] *= sign
+        near = (np.sqrt((r*r).sum(axis=1))<0.10) & (dot<=0.010)
+        return np.where(near[:,None], effect, 0.0)
 
-    create_functional_shape_key(body, 'Eye shape', eye_soft, formula, on = on, bm = bm)
+    create_functional_shape_key(body, 'Eye shape', eye_soft, formula, on = on, bm = bm, vectorized=True)
 
 def tweak_nose(arm, body, bm, on):
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -459,16 +546,15 @@ def tweak_nose(arm, body, bm, on):
     normals_y = [x[3] for x in curve]
 
     def formula(co, vert, uv, norm, **kwargs):
-        sign = 1 if uv[0]<0.5 else -1
-        if uv[0]>0.500:
-            uv=(1-uv[0],uv[1])
-        pos, t, coord, side, dist = curve_find_nearest(curve, uv, debug=(vert==21185 or vert==32309))
-        n = Vector([curve_interp(normals_x, coord)*sign, curve_interp(normals_y, coord), -1])
-        n.normalize()
-        effect = n * sigmoid(dist, 0, 0.01) * 0.008
+        sign = np.where(uv[:,0]<0.5, 1.0, -1.0)
+        uv = np.stack([np.where(uv[:,0]>0.500, 1-uv[:,0], uv[:,0]), uv[:,1]], axis=1)
+        pos, t, coord, side, dist = np_curve_find_nearest(curve, uv)
+        n = np.stack([np_curve_interp(normals_x, coord)*sign, np_curve_interp(normals_y, coord), -np.ones(len(uv))], axis=1)
+        n /= np.sqrt((n*n).sum(axis=1))[:,None]
+        effect = n * (np_sigmoid(dist, 0, 0.01) * 0.008)[:,None]
         return effect
 
-    create_functional_shape_key(body, 'Nostril pinch', ['cf_J_Nose_tip','cf_J_Nose_t','cf_J_NoseBase_s'], formula, max=2.0)
+    create_functional_shape_key(body, 'Nostril pinch', ['cf_J_Nose_tip','cf_J_Nose_t','cf_J_NoseBase_s'], formula, max=2.0, vectorized=True)
 
 def add_mouth_blendshape(body, bm):
     if not 'cf_J_CheekLow_L' in body.vertex_groups: # custom head
@@ -604,10 +690,10 @@ def add_mouth_blendshape(body, bm):
 
 def adams_apple_delete(arm, body, bm):
     def formula(uv, **kwargs):
-        if uv[0]>=0.115 and uv[0]<=0.135 and uv[1]>=0.970 and uv[1]<=0.991:
-            return Vector([0,0,-0.02-0.02*bump(uv[1],0.970,0.980,0.990)])
-        return Vector([0,0,0])
-    create_functional_shape_key(body, 'Adams apple delete', ['cf_J_Neck_s'], formula, on=False, bm=bm)
+        inside = (uv[:,0]>=0.115) & (uv[:,0]<=0.135) & (uv[:,1]>=0.970) & (uv[:,1]<=0.991)
+        dz = np.where(inside, -0.02-0.02*np_bump(uv[:,1],0.970,0.980,0.990), 0.0)
+        return np.stack([np.zeros(len(dz)), np.zeros(len(dz)), dz], axis=1)
+    create_functional_shape_key(body, 'Adams apple delete', ['cf_J_Neck_s'], formula, on=False, bm=bm, vectorized=True)
 
 
 # Pushes the flesh between the upper lip and the nose smoothly toward the skull, creating a trough.
@@ -617,11 +703,11 @@ def upper_lip_shapekey(arm, body, bm, on=True):
         (0.442,0.352),
         (0.485,0.371),
         ]
-        wx = sigmoid(uv[0],0.470,0.440) * sigmoid(uv[0], 0.530, 0.560)
-        effect1 = wx * bump(uv[1], curve_interp(curve, uv[0], xsymm=True), None, 0.399, shape='cos') * Vector([0, -0.01, -0.01])
+        wx = np_sigmoid(uv[:,0],0.470,0.440) * np_sigmoid(uv[:,0], 0.530, 0.560)
+        effect1 = (wx * np_bump(uv[:,1], np_curve_interp(curve, uv[:,0], xsymm=True), None, 0.399, shape='cos'))[:,None] * np.array([0, -0.01, -0.01])
         return effect1
     boy = (body['Boy']>0.0)
-    create_functional_shape_key(body, 'Upper lip trough', ['cf_J_Mouthup','cf_J_MouthBase_s_s'], formula, on = on and (not boy), bm = bm)
+    create_functional_shape_key(body, 'Upper lip trough', ['cf_J_Mouthup','cf_J_MouthBase_s_s'], formula, on = on and (not boy), bm = bm, vectorized=True)
 
 # Smoothly arches the lips
 def lip_arch_shapekey(arm, body, bm, on=True):
@@ -707,23 +793,19 @@ def lip_arch_shapekey(arm, body, bm, on=True):
 
     def formula(vert, uv, norm, **kwargs):
         # The effect is at full strength in the center, at zero above lip corners
-        wx = bump(uv[0],0.434,None,0.566,shape='cos')
-        upper = (uv[1]>0.335) or (uv[1]>0.330 and norm[1]<0)
-        if upper: 
-            center = curve_interp(curve_upper, uv[0], xsymm = True)
-            y_pos = max(0.001, (uv[1]-0.332)/(center-0.332))
-            #if y_pos<1.0:
-            #   set_weight(body, vert, vgl.index, y_pos)
-            #else:
-            #set_weight(body, vert, vgl.index, y_pos*0.1)
-        else:
-            center = curve_interp(curve_lower, uv[0], xsymm = True)
-            y_pos = min(-0.001, (uv[1]-0.330)/(0.330-center))
-            #set_weight(body, vert, vgl.index, max(0, -y_pos*0.1))
-        #set_weight(body, vert, vglx.index, wx)
-        return wx*Vector([0, 0.01*curve_interp(spread_curve, y_pos), 0.01*curve_interp(push_curve, y_pos)]) + Vector([0, 0, 0.0075*(bump(uv[0],0.432,None,0.500)+bump(uv[0],0.500,None,0.568)) * bump(y_pos, -4.0, -2.0, 0.0)])
+        wx = np_bump(uv[:,0],0.434,None,0.566,shape='cos')
+        upper = (uv[:,1]>0.335) | ((uv[:,1]>0.330) & (norm[:,1]<0))
+        center = np_curve_interp(curve_upper, uv[:,0], xsymm = True)
+        y_upper = np.maximum(0.001, (uv[:,1]-0.332)/(center-0.332))
+        center = np_curve_interp(curve_lower, uv[:,0], xsymm = True)
+        y_lower = np.minimum(-0.001, (uv[:,1]-0.330)/(0.330-center))
+        y_pos = np.where(upper, y_upper, y_lower)
+        zero = np.zeros(len(uv))
+        arch = np.stack([zero, 0.01*np_curve_interp(spread_curve, y_pos), 0.01*np_curve_interp(push_curve, y_pos)], axis=1)
+        corners = 0.0075*(np_bump(uv[:,0],0.432,None,0.500)+np_bump(uv[:,0],0.500,None,0.568)) * np_bump(y_pos, -4.0, -2.0, 0.0)
+        return wx[:,None]*arch + np.stack([zero, zero, corners], axis=1)
     create_functional_shape_key(body, 'Lip arch', ['cf_J_Mouthup','cf_J_MouthLow', 'cf_J_ChinTip_s', 'cf_J_MouthBase_s_s'], formula,
-            max=2.0, on=on and not boy, bm = bm)
+            max=2.0, on=on and not boy, bm = bm, vectorized=True)
 
 def eyelid_crease(arm, body, bm, on=True):
     curve_upper = [
@@ -740,21 +822,15 @@ def eyelid_crease(arm, body, bm, on=True):
     (0.439,0.5447),
     ]
     def formula(uv, **kwargs):
-        if uv[0]>0.5:
-            uv=(1-uv[0],uv[1])
-        if uv[0]<curve_upper[0][0] or uv[0]>=curve_upper[-1][0]:
-            return Vector([0.0, 0.0, 0.0])
-        if uv[0]<curve_upper[1][0]:
-            wx = sigmoid(uv[0], curve_upper[1][0], curve_upper[0][0])
-        elif uv[0]>curve_upper[-2][0]:
-            wx = sigmoid(uv[0], curve_upper[-2][0], curve_upper[1][0])
-        else:
-            wx=1.0
-        ynear=curve_interp(curve_upper,uv[0])
-        wy = bump(uv[1], ynear-0.002, ynear, ynear+0.002)
-        return Vector([0,0,-wx*wy*0.02])
+        x = np.where(uv[:,0]>0.5, 1-uv[:,0], uv[:,0])
+        wx = np.where(x<curve_upper[1][0], np_sigmoid(x, curve_upper[1][0], curve_upper[0][0]),
+            np.where(x>curve_upper[-2][0], np_sigmoid(x, curve_upper[-2][0], curve_upper[1][0]), 1.0))
+        ynear = np_curve_interp(curve_upper, x)
+        wy = np_bump(uv[:,1], ynear-0.002, ynear, ynear+0.002)
+        dz = np.where((x<curve_upper[0][0]) | (x>=curve_upper[-1][0]), 0.0, -wx*wy*0.02)
+        return np.stack([np.zeros(len(dz)), np.zeros(len(dz)), dz], axis=1)
 
-    create_functional_shape_key(body, 'Eyelid crease', ['cf_J_Eye02_s_L','cf_J_Eye02_s_R'], formula, on=on, bm=bm)
+    create_functional_shape_key(body, 'Eyelid crease', ['cf_J_Eye02_s_L','cf_J_Eye02_s_R'], formula, on=on, bm=bm, vectorized=True)
 
 
 def forehead_flatten(arm, body, bm, on=True):
@@ -762,33 +838,29 @@ def forehead_flatten(arm, body, bm, on=True):
         return
     ftz_id = body.vertex_groups["cf_J_FaceUp_tz"].index
     def formula(uv, vert, norm, co, **kwargs):
-        #w = get_weight(body, vert, ftz_id)
-        w = min(1.0, 2*abs(co[0])-0.2)*0.06
-        w *= bump(uv[1], 0.580, 0.620, 0.90)
-        w *= sigmoid(norm[2], 1.0, 0.2)
-        return Vector([0,0,w])
+        w = np.minimum(1.0, 2*np.abs(co[:,0])-0.2)*0.06
+        w *= np_bump(uv[:,1], 0.580, 0.620, 0.90)
+        w *= np_sigmoid(norm[:,2], 1.0, 0.2)
+        return np.stack([np.zeros(len(w)), np.zeros(len(w)), w], axis=1)
 
-    create_functional_shape_key(body, 'Forehead flatten', ['cf_J_FaceUp_tz','cf_J_FaceUpFront_ty'], formula, on=on, bm=bm)
+    create_functional_shape_key(body, 'Forehead flatten', ['cf_J_FaceUp_tz','cf_J_FaceUpFront_ty'], formula, on=on, bm=bm, vectorized=True)
 
 def temple_depress(arm, body, bm, on=True):
     def formula(uv, **kwargs):
-        if uv[0]>0.500:
-            uv=(1-uv[0], uv[1])
-            sign = -1.0
-        else:
-            sign = 1.0
+        sign = np.where(uv[:,0]>0.500, -1.0, 1.0)
+        uv = np.stack([np.where(uv[:,0]>0.500, 1-uv[:,0], uv[:,0]), uv[:,1]], axis=1)
         # Push vertices on the temple inward, creating a depression
-        r=Vector(uv)-Vector([0.253,0.585])
-        r[1]*=0.5
+        r = uv-np.array([0.253,0.585])
+        r[:,1]*=0.5
 
         # Pull the outer edge of the eye socket outward
-        r2 = Vector(uv)-Vector([0.316, 0.540])
-        if r2[1]<0.0:
-            r2[1]=min(0.0, r2[1]+0.05)
-        r2[1]*=0.5
-        return (sigmoid(r.length, 0, 0.08)-sigmoid(r2.length,0,0.025)*0.5) * Vector([0.025*sign, 0, 0])
+        r2 = uv-np.array([0.316, 0.540])
+        r2[:,1] = np.where(r2[:,1]<0.0, np.minimum(0.0, r2[:,1]+0.05), r2[:,1])
+        r2[:,1]*=0.5
+        w = np_sigmoid(np.sqrt((r*r).sum(axis=1)), 0, 0.08)-np_sigmoid(np.sqrt((r2*r2).sum(axis=1)),0,0.025)*0.5
+        return (w*sign*0.025)[:,None] * np.array([1.0, 0, 0])
 
-    create_functional_shape_key(body, 'Temple depress', ['cf_J_FaceUp_tz','cf_J_CheekUp_L','cf_J_CheekUp_R'], formula, on=on, bm = bm)
+    create_functional_shape_key(body, 'Temple depress', ['cf_J_FaceUp_tz','cf_J_CheekUp_L','cf_J_CheekUp_R'], formula, on=on, bm = bm, vectorized=True)
 
 def jaw_soften(arm, body, bm, on=True):
     curve_m=[
@@ -805,15 +877,14 @@ def jaw_soften(arm, body, bm, on=True):
     ]
     curve = curve_m if body["Boy"]>0 else curve_f
     def formula(uv, vert, norm, co, **kwargs):
-        pos = uv[1] - curve_interp(curve, uv[0], xsymm=True)
-        if uv[0]>0.5:
-            uv=(1-uv[0],uv[1])
-        effect = bump(pos, -2*width, 0, width, shape='cos') * (1. + bump(uv[0], 0.43, 0.46, 0.49, shape='cos')) * sigmoid(uv[0], 0.225, 0.150)
-        return norm * -0.01 * effect
+        pos = uv[:,1] - np_curve_interp(curve, uv[:,0], xsymm=True)
+        x = np.where(uv[:,0]>0.5, 1-uv[:,0], uv[:,0])
+        effect = np_bump(pos, -2*width, 0, width, shape='cos') * (1. + np_bump(x, 0.43, 0.46, 0.49, shape='cos')) * np_sigmoid(x, 0.225, 0.150)
+        return norm * -0.01 * effect[:,None]
     width = 0.035
-    create_functional_shape_key(body, 'Jaw soften', ['cf_J_Chin_rs', 'cf_J_ChinLow','cf_J_ChinFront_s'], formula, on=False, bm=bm)
+    create_functional_shape_key(body, 'Jaw soften', ['cf_J_Chin_rs', 'cf_J_ChinLow','cf_J_ChinFront_s'], formula, on=False, bm=bm, vectorized=True)
     width = 0.060
-    create_functional_shape_key(body, 'Jaw soften more', ['cf_J_Chin_rs', 'cf_J_ChinLow','cf_J_ChinFront_s'], formula, on=on, bm=bm)
+    create_functional_shape_key(body, 'Jaw soften more', ['cf_J_Chin_rs', 'cf_J_ChinLow','cf_J_ChinFront_s'], formula, on=on, bm=bm, vectorized=True)
 
 # Explicitly subdivide the mesh before trying to build new shape keys.
 # Necessary to produce good quality shape keys in sensitive areas (e.g. around the nose).
@@ -1005,6 +1076,7 @@ def add_shape_keys(arm, body, on):
     nasolabial_crease(arm, body, bm)
     bm.free()
     t2=time.time()
+    print("nasolabial_crease: %.3f s" % (t2-t1))
     print("%.3f s to add shape keys" % (t2-t0))
 #
 #
@@ -1028,9 +1100,11 @@ def repaint_mouth_cavity(x):
     else:
         face_id = get_or_create_id(x, 'cf_J_FaceLow_s')
 
-    v=vgroup(x, 'cf_J_MouthCavity')
-    v2=vgroup(x, 'cf_J_MouthBase_s')
-    vnose=vgroup(x, 'cf_J_NoseBase_s')
+    table = get_weight_table(x)
+    v=table.members('cf_J_MouthCavity')
+    v2=table.members('cf_J_MouthBase_s')
+    vnose=set(table.members('cf_J_NoseBase_s').tolist())
+    normals = get_vertex_array(x, "normal")
 
     bm = bmesh.new()
     bm.from_mesh(x.data)
@@ -1039,42 +1113,35 @@ def repaint_mouth_cavity(x):
 
     # Retag as 'mouth cavity' any verts in 'cf_J_MouthBase_s' with normals pointing toward char's back
     # (this corrects several verts inside mouth corners)
-    for y in v2:
+    retag = []
+    for y in v2.tolist():
         if y in vnose:
             continue
         min_dot=1.0
         for i in bm.verts[y].link_faces:
             for j in bm.verts[y].link_faces:
                 min_dot =min(min_dot, i.normal.dot(j.normal))
-        if x.data.vertices[y].normal[2]<0.0 or min_dot<0.0:
-            v.append(y)
-            #if not y in x.vertex_groups['cf_J_MouthCavity']:
-            x.vertex_groups['cf_J_MouthCavity'].add([y], 1.0, 'ADD')
-
-    for y in v:
-        old_chw = 0.0
-
-        lip = False
-        for z in x.data.vertices[y].groups:
-            if z.group==mouth2_id and z.weight>0.001:
-                lip = True
-
-        chw = x.data.vertices[y].normal[1]
-        if lip:
-            chw = min(chw, 0.5)
-        if chw<0.0:
-            chw=0.0
-
-        for z in x.data.vertices[y].groups:
-            if z.group==chin_id:
-                old_chw = z.weight
-                z.weight=chw
-            elif z.group==mouth_id:
-                z.weight=1.-chw
-            else:
-                z.weight = 0.0
-        if old_chw==0.0 and chw>0.0:
-            x.vertex_groups['cf_J_Chin_rs'].add([y], chw, 'ADD')
+        if normals[y,2]<0.0 or min_dot<0.0:
+            retag.append(y)
+    bm.free()
+    table.set(retag, mouth_id, 1.0)
+    v = np.union1d(v, retag).astype(np.int64)
+
+    lip = table.get(v, mouth2_id)>0.001
+    chw = normals[v,1]
+    chw = np.where(lip, np.minimum(chw, 0.5), chw)
+    chw = np.maximum(chw, 0.0)
+
+    had_chin = table.has(v, chin_id)
+    old_chw = table.get(v, chin_id)
+    had_mouth = table.has(v, mouth_id)
+    table.scale(v, 0.0)
+    table.set(v[had_chin], chin_id, chw[had_chin])
+    table.set(v[had_mouth], mouth_id, 1.-chw[had_mouth])
+    # 'ADD' on top of whatever was just set (zero, if the vertex wasn't in the group yet)
+    add_chin = (old_chw==0.0) & (chw>0.0)
+    table.add(v[add_chin], chin_id, chw[add_chin])
+    table.flush()
 
 def patch_cheekup_transitions(arm, body, bm):
     print("patch_cheekup_transitions")
@@ -1123,98 +1190,86 @@ def patch_cheekup_transitions(arm, body, bm):
         if slot.material in [body["eyelash_mat"], body["eye_mat"], body["eyeshadow_mat"]]:
             body.active_material_index = i
             bpy.ops.object.material_slot_select()
-    eyelash_mask = [False]*len(body.data.vertices)
+    eyelash_mask = np.zeros([len(body.data.vertices)], dtype=bool)
     bpy.ops.object.mode_set(mode='OBJECT')
     body.data.vertices.foreach_get("select", eyelash_mask)
 
     def cheek_excess_fraction(uv, co, vert, **kwargs):
-        if vert==13717:
-            print("cheek_excess_fraction", vert, eyelash_mask[vert])
-        if eyelash_mask[vert]:
-            return 0
-        eye_dist = curve_interp(lower_eyelid_curve, uv[0], xsymm=True)-uv[1]
-        eye_dist = clamp01(eye_dist / 0.060)
-        w_cheek = get_weight(body, vert, id_upl if uv[0]>0.500 else id_upr)
-        if w_cheek < 0.001:
-            return 0
-        cap_y = math.sin(eye_dist*3.14159/2)
-        cap_x = clamp01(6*(abs(co[0])-0.16))
-        w_cheek_max = 0.4 * cap_x * cap_y #max(0.0, min(0.5*cap_y, 0.5*cap_x))
-        if uv[0]>0.500:
-            uv=(1-uv[0],uv[1])
-        cap_x2 = curve_interp(curve_nl, uv[1]) - uv[0]
-        cap_x2 = 0.4 * sigmoid(cap_x2, 0.08, 0.0)
-        w_cheek_max = min(w_cheek_max, cap_x2)
-        return max(0.0, w_cheek - w_cheek_max) / w_cheek
-
-    split_vgroup(body, 'cf_J_CheekUp2_L', 'cf_J_CheekUp_L', cheek_excess_fraction, bm=bm)
-    split_vgroup(body, 'cf_J_CheekUp2_R', 'cf_J_CheekUp_R', cheek_excess_fraction, bm=bm)
+        eye_dist = np_curve_interp(lower_eyelid_curve, uv[:,0], xsymm=True)-uv[:,1]
+        eye_dist = np.clip(eye_dist / 0.060, 0, 1)
+        w_cheek = get_weight_table(body).get(vert, np.where(uv[:,0]>0.500, id_upl, id_upr))
+        cap_y = np.sin(eye_dist*3.14159/2)
+        cap_x = np.clip(6*(np.abs(co[:,0])-0.16), 0, 1)
+        w_cheek_max = 0.4 * cap_x * cap_y
+        x = np.where(uv[:,0]>0.500, 1-uv[:,0], uv[:,0])
+        cap_x2 = np_curve_interp(curve_nl, uv[:,1]) - x
+        cap_x2 = 0.4 * np_sigmoid(cap_x2, 0.08, 0.0)
+        w_cheek_max = np.minimum(w_cheek_max, cap_x2)
+        excess = np.maximum(0.0, w_cheek - w_cheek_max) / np.where(w_cheek<0.001, 1.0, w_cheek)
+        return np.where(eyelash_mask[vert] | (w_cheek<0.001), 0.0, excess)
+
+    split_vgroup(body, 'cf_J_CheekUp2_L', 'cf_J_CheekUp_L', cheek_excess_fraction, vectorized=True)
+    split_vgroup(body, 'cf_J_CheekUp2_R', 'cf_J_CheekUp_R', cheek_excess_fraction, vectorized=True)
     make_child_bone(arm, 'cf_J_FaceLow_s', 'cf_J_CheekUp2_L', Vector([0.32, 0.40, 0.19]), "Cheeks")
     make_child_bone(arm, 'cf_J_FaceLow_s', 'cf_J_CheekUp2_R', Vector([-0.32, 0.40, 0.19]), "Constrained - soft", copy='lrs')
 
 def patch_cheekup_transitions_part2(arm, body, bm):
-    lay = bm.loops.layers.uv['uv1']
+    table = get_weight_table(body)
     # Touch up weights of CheekLow at the cheek / nose boundary
-    v_l=vgroup(body, ['cf_J_CheekUp_L','cf_J_CheekUp_R'])
-    id = body.vertex_groups['cf_J_FaceLow_s'].index
-    for x in v_l:
-        uv = bm.verts[x].link_loops[0][lay].uv
-        if uv[0]>0.500:
-            g='cf_J_CheekLow_L'
-            uv=(1.-uv[0], uv[1])
-        else:
-            g='cf_J_CheekLow_R'
-        tx = uv[0]+uv[1]*0.5
-        ty = uv[1]-uv[0]-0.017
-        if tx > 0.630:
-            old_weight = get_weight(body, x, g)
-            new_weight = max(0.0, 0.125 - 3*(tx-0.622) - 34*ty*ty)
-            if new_weight > old_weight:
-                delta = new_weight - old_weight
-                wfl = get_weight(body, x, id)
-                delta = min(delta, wfl)
-                set_weight(body, x, g, old_weight + delta)
-                set_weight(body, x, id, wfl + delta)
+    v_l=table.members(['cf_J_CheekUp_L','cf_J_CheekUp_R'])
+    id = table.group_index('cf_J_FaceLow_s')
+    uv = vertex_uvs(bm, v_l)
+    left = uv[:,0]>0.500
+    g = np.where(left, table.group_index('cf_J_CheekLow_L'), table.group_index('cf_J_CheekLow_R'))
+    uv[left,0] = 1.-uv[left,0]
+    tx = uv[:,0]+uv[:,1]*0.5
+    ty = uv[:,1]-uv[:,0]-0.017
+    old_weight = table.get(v_l, g)
+    new_weight = np.maximum(0.0, 0.125 - 3*(tx-0.622) - 34*ty*ty)
+    sel = (tx > 0.630) & (new_weight > old_weight)
+    x, g, old_weight = v_l[sel], g[sel], old_weight[sel]
+    wfl = table.get(x, id)
+    delta = np.minimum(new_weight[sel] - old_weight, wfl)
+    table.set(x, g, old_weight + delta)
+    table.set(x, id, wfl + delta)
+    table.flush()
 
 def patch_cheeklow_transitions(arm, body, bm):
-    lay = bm.loops.layers.uv['uv1']
+    table = get_weight_table(body)
     # Touch up weights of CheekLow at the cheek / chin boundary
-    v_l=vgroup(body, ['cf_J_CheekLow_L','cf_J_CheekLow_R'])
-    for x in v_l:
-        uv = bm.verts[x].link_loops[0][lay].uv
-        if uv[0]>0.500:
-            g='cf_J_CheekLow_L'
-        else:
-            g='cf_J_CheekLow_R'
-            uv=(1.-uv[0], uv[1])
-        t = uv[0]-0.581+(uv[1]-0.292)*1.2
-        if t<0.002:
-            old_weight = get_weight(body, x, g)
-            new_weight = max(0., 0.095+t*3)
-            set_weight(body, x, g, min(old_weight, new_weight))
+    v_l=table.members(['cf_J_CheekLow_L','cf_J_CheekLow_R'])
+    uv = vertex_uvs(bm, v_l)
+    left = uv[:,0]>0.500
+    g = np.where(left, table.group_index('cf_J_CheekLow_L'), table.group_index('cf_J_CheekLow_R'))
+    uv[~left,0] = 1.-uv[~left,0]
+    t = uv[:,0]-0.581+(uv[:,1]-0.292)*1.2
+    sel = t<0.002
+    x, g = v_l[sel], g[sel]
+    old_weight = table.get(x, g)
+    new_weight = np.maximum(0., 0.095+t[sel]*3)
+    table.set(x, g, np.minimum(old_weight, new_weight))
+    table.flush()
 
 def create_cheekmid(arm, body, bm):
-    vs = body.data.vertices
-    v_r=vgroup(body, 'cf_J_CheekUp_R', min_wt=0.01)
-    hl = [vs[y].co[1]+0.5*abs(vs[y].co[0]) for y in v_r]
-    hl.sort()
+    co = get_vertex_array(body)[get_weight_table(body).members('cf_J_CheekUp_R', min_wt=0.01)]
+    hl = np.sort(co[:,1]+0.5*np.abs(co[:,0]))
     minpos = hl[0]
     midpos = hl[len(hl)//2]
     maxpos = hl[-1]
     def mid_fraction(co, vert, **kwargs):
-        h = co[1]+0.5*abs(co[0])
-        return clamp01(1.5-2.*(h-minpos)/(maxpos-minpos))
+        h = co[:,1]+0.5*np.abs(co[:,0])
+        return np.clip(1.5-2.*(h-minpos)/(maxpos-minpos), 0, 1)
 
-    split_vgroup(body, 'cf_J_CheekMid_L', 'cf_J_CheekUp_L', mid_fraction, bm=bm)
-    split_vgroup(body, 'cf_J_CheekMid_R', 'cf_J_CheekUp_R', mid_fraction, bm=bm)
+    split_vgroup(body, 'cf_J_CheekMid_L', 'cf_J_CheekUp_L', mid_fraction, vectorized=True)
+    split_vgroup(body, 'cf_J_CheekMid_R', 'cf_J_CheekUp_R', mid_fraction, vectorized=True)
     make_child_bone(arm, 'cf_J_CheekUp_L', 'cf_J_CheekMid_L', Vector([-0.1, 0, 0]), "Cheeks")
     make_child_bone(arm, 'cf_J_CheekUp_R', 'cf_J_CheekMid_R', Vector([0.1, 0, 0]), "Constrained - soft", copy='lrs')
 
 def add_skull_soft_neutral(arm, body):
     vs = body.data.vertices
-    split_vgroup(body, "cf_J_ChinFront_s", 'cf_J_Chin_rs', lambda co, **kwargs: sigmoid(co[2], 0.40, 0.15))
-    split_vgroup(body, "cf_J_FaceUpFront_ty", 'cf_J_FaceUp_ty', lambda co, **kwargs: max(0,min(0.5,(co[2]+0.25)*2.)))
-    split_vgroup(body, 'cf_J_FaceRoot_r_s', "cf_J_FaceRoot_s", lambda co, **kwargs: 1.-max(0,min(1,(co[2]+0.25)*2.)))
+    split_vgroup(body, "cf_J_ChinFront_s", 'cf_J_Chin_rs', lambda co, **kwargs: np_sigmoid(co[:,2], 0.40, 0.15), vectorized=True)
+    split_vgroup(body, "cf_J_FaceUpFront_ty", 'cf_J_FaceUp_ty', lambda co, **kwargs: np.clip((co[:,2]+0.25)*2., 0, 0.5), vectorized=True)
+    split_vgroup(body, 'cf_J_FaceRoot_r_s', "cf_J_FaceRoot_s", lambda co, **kwargs: 1.-np.clip((co[:,2]+0.25)*2., 0, 1), vectorized=True)
     make_child_bone(arm, 'cf_J_Chin_rs', 'cf_J_ChinFront_s', Vector([0,0,0.02]), "Chin")
     make_child_bone(arm, 'cf_J_FaceUp_ty', 'cf_J_FaceUpFront_ty', Vector([0,0,0.02]), "Head internal")
     make_child_bone(arm, 'cf_J_FaceRoot_s', 'cf_J_FaceRoot_r_s', Vector([0,0,-0.02]), "Head internal")
@@ -1252,33 +1307,35 @@ def add_skull_soft_neutral(arm, body):
 # Above pupil level, partially transfer nose weight to faceup 
 # (because, as painted, NoseBridge's effect extends well into the forehead)
 def repaint_nose_bridge(arm, body):
-    id_nose_t = body.vertex_groups['cf_J_Nose_t_s'].index
-    id_base = body.vertex_groups['cf_J_NoseBase_s'].index
-    id_bridge = body.vertex_groups['cf_J_NoseBridge_s'].index
-    id_faceup = body.vertex_groups['cf_J_FaceUp_tz'].index
-
-    for v in range(len(body.data.vertices)):
-        co = body.data.vertices[v].co
-        #t = co[1]-co[2]
-        #if t>=15.75 and co[1]-0.5*abs(co[0])>=16.45:
-        if co[1]>16.30:
-            wold = get_weight(body, v, id_bridge)
-            wbase = get_weight(body, v, id_base)
-            wt = get_weight(body, v, id_nose_t)
-            base_transition = sigmoid(co[1], 16.60, 16.30)
-            wold += wbase*base_transition
-            wold += wt*base_transition
-            set_weight(body, v, id_base, wbase*(1-base_transition))
-            set_weight(body, v, id_nose_t, wt*(1-base_transition))
-            wb = min(wold, sigmoid(co[1], 16.45, 16.70))
-            set_weight(body, v, id_bridge, wb)
-            add_weight(body, v, id_faceup, wold-wb)
+    table = get_weight_table(body)
+    id_nose_t = table.group_index('cf_J_Nose_t_s')
+    id_base = table.group_index('cf_J_NoseBase_s')
+    id_bridge = table.group_index('cf_J_NoseBridge_s')
+    id_faceup = table.group_index('cf_J_FaceUp_tz')
+
+    co = get_vertex_array(body)
+    #t = co[1]-co[2]
+    #if t>=15.75 and co[1]-0.5*abs(co[0])>=16.45:
+    v = np.nonzero(co[:,1]>16.30)[0]
+    h = co[v,1]
+    wold = table.get(v, id_bridge)
+    wbase = table.get(v, id_base)
+    wt = table.get(v, id_nose_t)
+    base_transition = np_sigmoid(h, 16.60, 16.30)
+    wold += wbase*base_transition
+    wold += wt*base_transition
+    table.set(v, id_base, wbase*(1-base_transition))
+    table.set(v, id_nose_t, wt*(1-base_transition))
+    wb = np.minimum(wold, np_sigmoid(h, 16.45, 16.70))
+    table.set(v, id_bridge, wb)
+    table.add(v, id_faceup, wold-wb)
+    table.flush()
 
 def repaint_torso(body):
     for n in ['1','2','3']:
-        split_vgroup(body, 'cf_J_Spine0'+n+'_r_s', 'cf_J_Spine0'+n+'_s', lambda co,**kwargs: 1.-max(0,min(1,(co[2]+0.5)*2.)))
-    split_vgroup(body, 'cf_J_NeckUp_s', 'cf_J_Neck_s', lambda co,**kwargs:  max(0,min(1,(co[1]+co[2]*0.44-15.30)/0.6+0.5)))
-    split_vgroup(body, 'cf_J_NeckFront_s', 'cf_J_Neck_s', lambda co,**kwargs:  max(0,min(1,(co[2]+0.25)*2.)))
+        split_vgroup(body, 'cf_J_Spine0'+n+'_r_s', 'cf_J_Spine0'+n+'_s', lambda co,**kwargs: 1.-np.clip((co[:,2]+0.5)*2., 0, 1), vectorized=True)
+    split_vgroup(body, 'cf_J_NeckUp_s', 'cf_J_Neck_s', lambda co,**kwargs:  np.clip((co[:,1]+co[:,2]*0.44-15.30)/0.6+0.5, 0, 1), vectorized=True)
+    split_vgroup(body, 'cf_J_NeckFront_s', 'cf_J_Neck_s', lambda co,**kwargs:  np.clip((co[:,2]+0.25)*2., 0, 1), vectorized=True)
 
 def add_spine_rear_soft(arm, body):
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -1320,11 +1377,11 @@ def add_spine_rear_soft(arm, body):
         (0.250, 0.690),
     ]
     def front_belly_lower_weight(co, uv, vert, **kwargs):
-        return sigmoid(uv[1]-curve_interp(iliac_curve, uv[0]), 0.02, -0.02) * max(0,min(1,(co[2]+0.5)*2.))
+        return np_sigmoid(uv[:,1]-np_curve_interp(iliac_curve, uv[:,0]), 0.02, -0.02) * np.clip((co[:,2]+0.5)*2., 0, 1)
     def front_belly_upper_weight(co, uv, vert, **kwargs):
-        return sigmoid(uv[1]-curve_interp(rib_curve, uv[0]), -0.02, 0.02) * max(0,min(1,(co[2]+0.5)*2.))
-    split_vgroup(body, 'cf_J_Kosi01_f_s', 'cf_J_Kosi01_s', front_belly_lower_weight)
-    split_vgroup(body, 'cf_J_Spine01_f_s', 'cf_J_Spine01_s', front_belly_upper_weight)
+        return np_sigmoid(uv[:,1]-np_curve_interp(rib_curve, uv[:,0]), -0.02, 0.02) * np.clip((co[:,2]+0.5)*2., 0, 1)
+    split_vgroup(body, 'cf_J_Kosi01_f_s', 'cf_J_Kosi01_s', front_belly_lower_weight, vectorized=True)
+    split_vgroup(body, 'cf_J_Spine01_f_s', 'cf_J_Spine01_s', front_belly_upper_weight, vectorized=True)
     make_child_bone(arm, 'cf_J_Kosi01_s', 'cf_J_Kosi01_f_s', Vector([0,-0.1,0.04]), "Spine - soft")
     make_child_bone(arm, 'cf_J_Spine01_s', 'cf_J_Spine01_f_s', Vector([0,0.1,0.04]), "Spine - soft")
 
@@ -1340,8 +1397,8 @@ def repaint_mouth_minimal(arm, body, bm):
             x.vertex_groups.new(name='cf_J_MouthCavity')
         if 'Lower jaw' in x.vertex_groups:
             x.vertex_groups['Lower jaw'].name='cf_J_LowerJaw'
-        for y in x.data.vertices:
-            x.vertex_groups['cf_J_MouthCavity'].add([y.index], 1.0, 'ADD')
+        x.vertex_groups['cf_J_MouthCavity'].add(list(range(len(x.data.vertices))), 1.0, 'ADD')
+        invalidate_weight_table(x)
 
         make_child_bone(arm, "cf_J_MouthCavity", "cf_J_LowerJaw", Vector([0,0,-0.05]), "Mouth", tail_offset=Vector([0,0,0.1]))
     tongue=[x for x in arm.children if x.name.startswith('o_tang')]
@@ -1349,80 +1406,67 @@ def repaint_mouth_minimal(arm, body, bm):
         tongue[0].vertex_groups[0].name='cf_J_MouthCavity'
     if not 'cf_J_Mouth_L' in body.vertex_groups:
         return
-    mcands = set(vgroup(body, ['cf_J_MouthLow','cf_J_Mouthup']))
-    coord = {}
+    table = get_weight_table(body)
+    mcands = table.members(['cf_J_MouthLow','cf_J_Mouthup'])
+    normals = get_vertex_array(body, "normal")
 
-    lay = bm.loops.layers.uv['uv1']
-    for n in mcands:
-        uv = bm.verts[n].link_loops[0][lay].uv
-        upper = (uv[1]>0.335) or (uv[1]>0.330 and body.data.vertices[n].normal[1]<0)
-        if uv[1]>0.315 and uv[1]<0.355 and uv[0]>0.432 and uv[0]<0.568:
-            wud=get_weight(body, n, "cf_J_MouthLow")+get_weight(body, n, "cf_J_Mouthup")
-            set_weight(body, n, "cf_J_MouthLow", 0 if upper else wud)
-            set_weight(body, n, "cf_J_Mouthup", wud if upper else 0)
+    uv = vertex_uvs(bm, mcands)
+    upper = (uv[:,1]>0.335) | ((uv[:,1]>0.330) & (normals[mcands,1]<0))
+    sel = (uv[:,1]>0.315) & (uv[:,1]<0.355) & (uv[:,0]>0.432) & (uv[:,0]<0.568)
+    n, upper = mcands[sel], upper[sel]
+    wud=table.get(n, "cf_J_MouthLow")+table.get(n, "cf_J_Mouthup")
+    table.set(n, "cf_J_MouthLow", np.where(upper, 0, wud))
+    table.set(n, "cf_J_Mouthup", np.where(upper, wud, 0))
+    table.flush()
 
 
 def dissolve_facelow_s(arm, body, bm):
     print("dissolve_facelow_s")
+    table = get_weight_table(body)
     for vg in ['cf_J_CheekLow_L', 'cf_J_CheekLow_R', 'cf_J_CheekUp_L', 'cf_J_CheekUp_R', 'cf_J_CheekMid_L', 'cf_J_CheekMid_R', 
         'cf_J_Chin_rs', 'cf_J_ChinTip_s', 'cf_J_ChinLow']:
-        v = vgroup(body, vg, min_wt=0.01)
-        min_facelow_ratio = 10.0
-        for x in v:
-            w1 = get_weight(body, x, vg)
-            w2 = max(get_weight(body, x, 'cf_J_FaceLow_s_s'), 0.02)
-            min_facelow_ratio = min(min_facelow_ratio, w2/w1)
-        for x in v:
-            w1 = get_weight(body, x, vg)
-            w2 = get_weight(body, x, 'cf_J_FaceLow_s_s')
-            delta = min(w2, w1*min_facelow_ratio)
-            set_weight(body, x, vg, w1+delta)
-            set_weight(body, x, 'cf_J_FaceLow_s_s', w2-delta)
-
-    v = vgroup(body, 'cf_J_FaceLow_s_s', min_wt=0.001)
+        v = table.members(vg, min_wt=0.01)
+        if len(v)==0:
+            continue
+        w1 = table.get(v, vg)
+        w2 = table.get(v, 'cf_J_FaceLow_s_s')
+        min_facelow_ratio = min(10.0, np.min(np.maximum(w2, 0.02)/w1))
+        delta = np.minimum(w2, w1*min_facelow_ratio)
+        table.set(v, vg, w1+delta)
+        table.set(v, 'cf_J_FaceLow_s_s', w2-delta)
+
+    v = table.members('cf_J_FaceLow_s_s', min_wt=0.001)
 
     t1=time.time()
-    facelow_id = body.vertex_groups['cf_J_FaceLow_s_s'].index
-    all_add_weights={}
-    for y in v:
+    facelow_id = table.group_index('cf_J_FaceLow_s_s')
+    cos = get_vertex_array(body)
+    links = [[e.other_vert(z).index for e in z.link_edges] for z in bm.verts]
+    add_verts, add_groups, add_weights = [], [], []
+    for y in v.tolist():
         geom = {y}
         total_geom = {y}
         for it in range(3):
-            edges = [e for z in geom for e in bm.verts[z].link_edges]
-            verts = [z.index for e in edges for z in e.verts]
-            verts = set(verts) - total_geom
+            verts = set([z for x in geom for z in links[x]]) - total_geom
             total_geom = total_geom | verts
             geom = verts
-
-        yco = body.data.vertices[y].co
-        wylow = get_weight(body, y, facelow_id)
-        add_weights={}
-
-        for it in total_geom:
-            vert = body.data.vertices[it]
-            co = vert.co
-            wt = sigmoid((co-yco).length, 0, 0.3)
-            wlow = 0.001
-            for g in vert.groups:
-                if g.group == facelow_id:
-                    wlow = g.weight
-            for g in vert.groups:
-                if g.group != facelow_id:
-                    w = g.weight * wt / (1-wlow)
-                    if g.group in add_weights:
-                        add_weights[g.group]+=w
-                    else:
-                        add_weights[g.group]=w
-        norm = sum(add_weights.values())
-        all_add_weights[y]={z:add_weights[z]*wylow/norm for z in add_weights}
-    #bm.free()
-    for y in v:
-        #wlow = get_weight(body, y, facelow_id)
-        add_weights = all_add_weights[y]
-        #norm = sum(add_weights.values())
-        for z in add_weights:
-            add_weight(body, y, z, add_weights[z])
-        set_weight(body, y, facelow_id, 0.0)
+        total_geom = np.array(sorted(total_geom))
+
+        wt = (np.linalg.norm(cos[total_geom]-cos[y], axis=1)) / 0.3
+        wt = np.where(wt>1, 0.0, 0.5*(np.cos(wt*3.141526)+1.))
+        wlow = np.where(table.has(total_geom, facelow_id), table.get(total_geom, facelow_id), 0.001)
+        owner, groups, w = table.rows(total_geom)
+        other = groups != facelow_id
+        owner, groups, w = owner[other], groups[other], w[other] * wt[owner[other]] / (1-wlow[owner[other]])
+        groups, inv = np.unique(groups, return_inverse=True)
+        w = np.bincount(inv, weights=w, minlength=len(groups))
+        wylow = table.get([y], facelow_id)[0]
+        add_verts.append(np.full(len(groups), y))
+        add_groups.append(groups)
+        add_weights.append(w*wylow/w.sum())
+    if len(v)>0:
+        table.add(np.concatenate(add_verts), np.concatenate(add_groups), np.concatenate(add_weights))
+    table.set(v, facelow_id, 0.0)
+    table.flush()
     t2=time.time()
     print("%3f s to dissolve facelow" % (t2-t1))
 
@@ -1435,55 +1479,48 @@ def create_nasolabial(arm, body, bm):
     ]
     # VG with support along the lines from lip corners to nose corners
     def weight_nasolabial(vert, uv, **kwargs):
-        y_weight = bump(uv[1], 0.332, 0.391, 0.450, shape='cos')
-        fold = curve_interp(curve, uv[1])
-        if uv[0]>=0.5:
-            uv=(1.0-uv[0], uv[1])
-        if uv[0]>fold:
-            x_weight = max(0.0, 1.-abs(uv[0]-fold)/(0.500-fold))
-        else:
-            x_weight = max(0.0, 1.-abs(uv[0]-fold)/0.060)
+        y_weight = np_bump(uv[:,1], 0.332, 0.391, 0.450, shape='cos')
+        fold = np_curve_interp(curve, uv[:,1])
+        x = np.where(uv[:,0]>=0.5, 1.0-uv[:,0], uv[:,0])
+        x_weight = np.maximum(0.0, 1.-np.abs(x-fold)/np.where(x>fold, 0.500-fold, 0.060))
         return x_weight * x_weight * y_weight * 0.5
-    create_functional_vgroup(body, "cf_J_Nasolabial_s", ["cf_J_NoseBase_s", "cf_J_MouthBase_s_s"], weight_nasolabial, bm=bm)
+    create_functional_vgroup(body, "cf_J_Nasolabial_s", ["cf_J_NoseBase_s", "cf_J_MouthBase_s_s"], weight_nasolabial, vectorized=True)
     make_child_bone(arm, 'cf_J_FaceBase', 'cf_J_Nasolabial_s', Vector([0,-0.15,0.8]), "Nose", tail_offset=Vector([0, 0.1, 0]))
 
 def create_nose_cheek(arm, body, bm):
     #print("Creating cf_J_NoseCheek_s")
     def weight_nose_cheek(co, vert, **kwargs):
-        return sigmoid(1-6.0*abs(co[0]), 0, 1) * sigmoid(co[1], 16.2, 16.0) * sigmoid(co[1], 16.4, 16.6)
-    split_vgroup(body, 'cf_J_NoseCheek_s', ['cf_J_NoseBase_s','cf_J_NoseBridge_s'], weight_nose_cheek, bm = bm)
+        return np_sigmoid(1-6.0*np.abs(co[:,0]), 0, 1) * np_sigmoid(co[:,1], 16.2, 16.0) * np_sigmoid(co[:,1], 16.4, 16.6)
+    split_vgroup(body, 'cf_J_NoseCheek_s', ['cf_J_NoseBase_s','cf_J_NoseBridge_s'], weight_nose_cheek, vectorized=True)
     make_child_bone(arm, 'cf_J_NoseBase_s', 'cf_J_NoseCheek_s', Vector([0, 0.2, 0.01]), "Nose")
 
 def restrict_nosebase(arm, body, bm):
     # Remove verts outside nasolabial folds from cf_J_NoseBase_s
-    id_base = body.vertex_groups['cf_J_NoseBase_s'].index
-    v=vgroup(body, 'cf_J_NoseBase_s', min_wt=0.001)
-    vs=body.data.vertices
-    for y in v:
-        co = vs[y].co
-        wmax = sigmoid(abs(co[0]), 0.16, 0.24)
-        old_weight = get_weight(body, y, id_base)
-        if old_weight>wmax:
-            for g in vs[y].groups:
-                if g.group==id_base:
-                    g.weight = wmax
-                else:
-                    g.weight *= (1.-wmax) / (1.-old_weight)
+    table = get_weight_table(body)
+    id_base = table.group_index('cf_J_NoseBase_s')
+    v=table.members('cf_J_NoseBase_s', min_wt=0.001)
+    co = get_vertex_array(body)
+    wmax = np_sigmoid(np.abs(co[v,0]), 0.16, 0.24)
+    old_weight = table.get(v, id_base)
+    sel = old_weight>wmax
+    v, wmax, old_weight = v[sel], wmax[sel], old_weight[sel]
+    table.scale(v, (1.-wmax) / (1.-old_weight))
+    table.set(v, id_base, wmax)
+    table.flush()
 
 
 def clean_cheeks(arm, body):
-    id_l = body.vertex_groups['cf_J_CheekUp_L'].index
-    id_r = body.vertex_groups['cf_J_CheekUp_R'].index
+    table = get_weight_table(body)
+    id_l = table.group_index('cf_J_CheekUp_L')
+    id_r = table.group_index('cf_J_CheekUp_R')
+    co = get_vertex_array(body)
 
     # Correct these two WGs by making sure they are only present on their respective sides
-    v_l=vgroup(body, 'cf_J_CheekUp_L')
-    for x in v_l:
-        if body.data.vertices[x].co[0]<0:
-            set_weight(body, x, id_l, 0.0)
-    v_r=vgroup(body, 'cf_J_CheekUp_R')
-    for x in v_r:
-        if body.data.vertices[x].co[0]>0:
-            set_weight(body, x, id_r, 0.0)
+    v_l=table.members(id_l)
+    table.set(v_l[co[v_l,0]<0], id_l, 0.0)
+    v_r=table.members(id_r)
+    table.set(v_r[co[v_r,0]>0], id_r, 0.0)
+    table.flush()
 
 def jaw_edge(arm, body, bm):
     curve=[
@@ -1505,61 +1542,56 @@ def jaw_edge(arm, body, bm):
     (0.212, 0.339),
     ]
 
-    id_chin = body.vertex_groups['cf_J_Chin_rs'].index
-    id_chinlow = body.vertex_groups['cf_J_ChinLow'].index
-    id_root = body.vertex_groups['cf_J_FaceRoot_s'].index
-    id_root_r = body.vertex_groups['cf_J_FaceRoot_r_s'].index
-    v=vgroup(body, ['cf_J_Chin_rs','cf_J_ChinLow'], min_wt=0.001)
-    vs=body.data.vertices
-    lay = bm.loops.layers.uv['uv1']
-    for y in v:
-        uv = bm.verts[y].link_loops[0][lay].uv
-        if uv[0]>0.500:
-            uv=(1-uv[0],uv[1])
-        fold = curve_interp(curve, uv[1])
-        pos, t, coord, side, dist = curve_find_nearest(curve2, uv)
-        if side>0:
-            decay_rate = 12.0 * (0.33 + 0.67*sigmoid(coord, 3, 1))
-            max_chin = max(0.0, 1 - 0.3*sigmoid(coord, 5, 3) - dist*decay_rate)
-            old_chin = get_weight(body, y, id_chin)
-            old_low = get_weight(body, y, id_chinlow)
-            old_root = get_weight(body, y, id_root)
-            old_root_r = get_weight(body, y, id_root_r)
-            delta = old_chin+old_low-max_chin
-            if delta>0:
-                add_weight(body, y, id_chin, -delta*old_chin/(old_chin+old_low))
-                add_weight(body, y, id_chinlow, -delta*old_low/(old_chin+old_low))
-                frac = 1.-max(0,min(1,(vs[y].co[2]+0.25)*2))
-                add_weight(body, y, id_root, delta*(1-frac))
-                add_weight(body, y, id_root_r, delta*frac)
+    table = get_weight_table(body)
+    id_chin = table.group_index('cf_J_Chin_rs')
+    id_chinlow = table.group_index('cf_J_ChinLow')
+    id_root = table.group_index('cf_J_FaceRoot_s')
+    id_root_r = table.group_index('cf_J_FaceRoot_r_s')
+    v=table.members(['cf_J_Chin_rs','cf_J_ChinLow'], min_wt=0.001)
+    co = get_vertex_array(body)
+    uv = vertex_uvs(bm, v)
+    uv[:,0] = np.where(uv[:,0]>0.500, 1-uv[:,0], uv[:,0])
+    pos, t, coord, side, dist = np_curve_find_nearest(curve2, uv)
+    decay_rate = 12.0 * (0.33 + 0.67*np_sigmoid(coord, 3, 1))
+    max_chin = np.where(side>0, np.maximum(0.0, 1 - 0.3*np_sigmoid(coord, 5, 3) - dist*decay_rate), np.inf)
+    old_chin = table.get(v, id_chin)
+    old_low = table.get(v, id_chinlow)
+    delta = old_chin+old_low-max_chin
+    sel = delta>0
+    y, delta, old_chin, old_low = v[sel], delta[sel], old_chin[sel], old_low[sel]
+    table.add(y, id_chin, -delta*old_chin/(old_chin+old_low))
+    table.add(y, id_chinlow, -delta*old_low/(old_chin+old_low))
+    frac = 1.-np.clip((co[y,2]+0.25)*2, 0, 1)
+    table.add(y, id_root, delta*(1-frac))
+    table.add(y, id_root_r, delta*frac)
+    table.flush()
 
 def reassign_cheekup2(arm, body, bm):
-    id_2l = body.vertex_groups['cf_J_CheekUp2_L'].index
-    id_2r = body.vertex_groups['cf_J_CheekUp2_R'].index
-    v_l=vgroup(body, ['cf_J_CheekUp2_L','cf_J_CheekUp2_R'])
-    id_nasolabial = body.vertex_groups['cf_J_Nasolabial_s'].index
-    id_nosecheek = body.vertex_groups['cf_J_NoseCheek_s'].index
-    lay = bm.loops.layers.uv['uv1']
-    for x in v_l:
-        uv = bm.verts[x].link_loops[0][lay].uv
-        wnl = get_weight(body, x, id_nasolabial)
-        wnc = get_weight(body, x, id_nosecheek)
-        if wnl+wnc>0.002:
-            old_weight = get_weight(body, x, [id_2l,id_2r])
-            set_weight(body, x, id_nasolabial, wnl+old_weight*wnl/(wnl+wnc))
-            set_weight(body, x, id_nosecheek, wnc+old_weight*wnc/(wnl+wnc))
-            set_weight(body, x, id_2l, 0)
-            set_weight(body, x, id_2r, 0)
+    table = get_weight_table(body)
+    id_2l = table.group_index('cf_J_CheekUp2_L')
+    id_2r = table.group_index('cf_J_CheekUp2_R')
+    v_l=table.members(['cf_J_CheekUp2_L','cf_J_CheekUp2_R'])
+    id_nasolabial = table.group_index('cf_J_Nasolabial_s')
+    id_nosecheek = table.group_index('cf_J_NoseCheek_s')
+    wnl = table.get(v_l, id_nasolabial)
+    wnc = table.get(v_l, id_nosecheek)
+    sel = wnl+wnc>0.002
+    x, wnl, wnc = v_l[sel], wnl[sel], wnc[sel]
+    old_weight = table.get(x, [id_2l,id_2r])
+    table.set(x, id_nasolabial, wnl+old_weight*wnl/(wnl+wnc))
+    table.set(x, id_nosecheek, wnc+old_weight*wnc/(wnl+wnc))
+    table.set(x, id_2l, 0)
+    table.set(x, id_2r, 0)
+    table.flush()
 
 
 def create_chin_cheek(arm, body, bm):
     def weight_chin_cheek(uv, co, vert, **kwargs):
-        if uv[0]>0.500:
-            uv=(1-uv[0],uv[1])
-        uv=(uv[0]-0.415,uv[1]-0.300)
-        return sigmoid(math.sqrt(uv[0]*uv[0]+0.5*uv[1]*uv[1]-0.25*uv[0]*uv[1]), 0.0, 0.04)
+        x = np.where(uv[:,0]>0.500, 1-uv[:,0], uv[:,0])-0.415
+        y = uv[:,1]-0.300
+        return np_sigmoid(np.sqrt(x*x+0.5*y*y-0.25*x*y), 0.0, 0.04)
     #create_functional_vgroup(body, 'cf_J_ChinCheek_s', 'cf_J_ChinFront_s', weight_chin_cheek, bm = bm)
-    split_vgroup(body, 'cf_J_ChinCheek_s', 'cf_J_ChinFront_s', weight_chin_cheek, bm = bm)
+    split_vgroup(body, 'cf_J_ChinCheek_s', 'cf_J_ChinFront_s', weight_chin_cheek, vectorized=True)
     make_child_bone(arm, 'cf_J_ChinFront_s', 'cf_J_ChinCheek_s', Vector([0,0,0.02]), "Chin")
 
 
@@ -1585,37 +1617,19 @@ def nasolabial_crease(arm, body, bm):
     (6, 0.2),
     ]
     def weight_nasolabial_crease(uv, co, vert, **kwargs):
-        if uv[0]>0.500:
-            uv=(1-uv[0],uv[1])
-        pos, t, coord, side, dist = curve_find_nearest(curve, uv, debug=(vert==12693 or vert==93711 or vert==56446))
-        #side = (pos[0]-uv[0])*t[1] - (pos[1]-uv[1])*t[0]
-        def func(coord, pos, uv, dist):
-            #distance = math.sqrt((pos[0]-uv[0])*(pos[0]-uv[0])+(pos[1]-uv[1])*(pos[1]-uv[1]))
-            y_weight = curve_interp(weight_curve, coord) #bump(coord, 0, (len(curve)-1)/2., len(curve)-1, shape='cos')
-            if y_weight<0.002:
-                return 0.0
-            x = dist * (20.0 if side<0.0 else 10.0) / y_weight
-            if side>0.0 and uv[0]>pos[0]:
-                x *= 2.
-            if side<0.0:
-                x *= 0.5 + 0.5*sigmoid(coord, 4, 2)
-            if vert==12693 or vert==93711:
-                print("Vert", vert, "coord", coord, "pos", pos, "uv", uv, "dist", dist, "side", side, "x", x)
-            x = max(0.0, 1. - x)
-            return y_weight * (-0.5 + x*x) * sigmoid(1.-x)
-        effect = func(coord, pos, uv, dist)
-        """
-        for i, k in enumerate(curve):
-            dist2 = math.sqrt((k[0]-uv[0])*(k[0]-uv[0])+(k[1]-uv[1])*(k[1]-uv[1]))
-            effect2 = func(i, k, uv, dist2)
-            if dist2<1.6*dist and effect2<effect:
-                effect=effect2
-        """
-        return Vector([0, 0, -0.05*effect])
+        uv = np.stack([np.where(uv[:,0]>0.500, 1-uv[:,0], uv[:,0]), uv[:,1]], axis=1)
+        pos, t, coord, side, dist = np_curve_find_nearest(curve, uv)
+        y_weight = np_curve_interp(weight_curve, coord)
+        x = dist * np.where(side<0.0, 20.0, 10.0) / np.maximum(y_weight, 0.002)
+        x *= np.where((side>0.0) & (uv[:,0]>pos[:,0]), 2., 1.)
+        x *= np.where(side<0.0, 0.5 + 0.5*np_sigmoid(coord, 4, 2), 1.)
+        x = np.maximum(0.0, 1. - x)
+        effect = np.where(y_weight<0.002, 0.0, y_weight * (-0.5 + x*x) * np_sigmoid(1.-x))
+        return np.stack([np.zeros(len(effect)), np.zeros(len(effect)), -0.05*effect], axis=1)
 
     create_functional_shape_key(body, 'Nasolabial crease', ['cf_J_FaceLow_s_s','cf_J_MouthBase_s_s', 'cf_J_NoseBase_s',
         'cf_J_NoseWing_tx_L', 'cf_J_NoseWing_tx_R','cf_J_Mouth_L','cf_J_Mouth_R'], weight_nasolabial_crease, 
-        on = True, bm = None)
+        on = True, vectorized=True)
     body.data.shape_keys.key_blocks['Nasolabial crease'].value=1.
 
 def clone_object(x):
@@ -1666,10 +1680,9 @@ def test_alignment(body, mesh):
                 v.add(vc)
 
     #print("Body:", body, len(body.data.vertices))
-    #boundary=[min([Vector((body.matrix_world @ y.co)-z).length for z in v])<0.0015 for y in body.data.vertices]
-    boundary = [min([Vector((body.matrix_world @ y.co)-z).length for y in body.data.vertices])<0.0015 for z in v]
-    print("Candidate mesh:", mesh.name, "boundary", sum(boundary), "/", len(v), "verts")
-    marked = sum(boundary)
+    boundary = PointIndex(world_coordinates(body)).within([z[:] for z in v], 0.0015)
+    marked = int(boundary.sum())
+    print("Candidate mesh:", mesh.name, "boundary", marked, "/", len(v), "verts")
     bmd.free()
     return float(marked)/len(v)
 
@@ -1714,24 +1727,25 @@ def uv_stitch(body, mesh):
     stitch_verts=[]
     t1 = time.time()
 
-    cos = np.zeros([len(body.data.vertices)*3], dtype=np.float32)
-    body.data.vertices.foreach_get("co", cos)
-    cos = cos.reshape([-1,3])
-    xs = cos[v].reshape([-1,1,3])
+    cos = get_vertex_array(body)
     main_mesh_list = [z for z in main_mesh]
-    ys = cos[main_mesh_list].reshape([1,-1,3])
-    xy = xs-ys
-    xy *= xy
-    xy = np.sqrt(xy[:,:,0]+xy[:,:,1]+xy[:,:,2])
-    v_nearest = np.argmin(xy, axis=1)
+    v_nearest, v_dist = PointIndex(cos[main_mesh_list], main_mesh_list).nearest(cos[v])
     t2 = time.time()
+    uv_index = None
     for i, x in enumerate(v):
-        nearest_xyz = main_mesh_list[v_nearest[i]]
-        if (bmd.verts[x].co-bmd.verts[nearest_xyz].co).length < 0.002:
-            nearest = nearest_xyz
+        if v_dist[i] < 0.002:
+            nearest = int(v_nearest[i])
         else:
-            nearest_uv = min([z for z in main_mesh], key=lambda y: min([(uv(y,k)-uv(x,0)).length for k in range(6)]))
-            nearest = nearest_uv
+            # no vertex close enough in 3D, match by UV instead (against the first 6 loops of each vertex)
+            if uv_index is None:
+                uv_points = []
+                uv_ids = []
+                for y in main_mesh_list:
+                    for k in range(6):
+                        uv_points.append(uv(y,k)[:])
+                        uv_ids.append(y)
+                uv_index = PointIndex(np.array(uv_points).reshape([-1,2]), uv_ids)
+            nearest = int(uv_index.nearest([uv(x,0)[:]])[0][0])
         stitch.append([x,nearest])
         stitch_verts.append(bmd.verts[x])
         stitch_verts.append(bmd.verts[nearest])
@@ -1780,6 +1794,7 @@ def uv_stitch(body, mesh):
 
     body.vertex_groups.remove(body.vertex_groups["Stitch Boundary"])
     body.vertex_groups.remove(body.vertex_groups["Stitch Mesh"])
+    invalidate_weight_table(body)
 
 
 # stitch=True: merge into the body even if there's no edge alignment
@@ -1813,8 +1828,9 @@ def excise_neuter_mesh(body, injector_mesh, stitch=False):
 
     #print("Body:", body, len(body.data.vertices))
     #print("New mesh: 
-    boundary=[min([Vector((body.matrix_world @ y.co)-z).length for z in v])<0.0015 for y in body.data.vertices]
-    marked = sum(boundary)
+    excision_index = PointIndex([z[:] for z in v])
+    boundary = excision_index.within(world_coordinates(body), 0.0015)
+    marked = int(boundary.sum())
     print(marked, "/", len(v), "excision vertices found")
     #if marked > 0 and marked < len(v):
     #    for z in v:
@@ -1854,16 +1870,11 @@ def excise_neuter_mesh(body, injector_mesh, stitch=False):
                 vc.freeze()
                 new_boundary.add(vc)
 
-        boundary=[min([Vector((body.matrix_world @ y.co)-z).length for z in v])<0.0015 for y in body.data.vertices]
-        print("Near the slit:", sum(boundary), "verts")
+        boundary = excision_index.within(world_coordinates(body), 0.0015)
+        print("Near the slit:", int(boundary.sum()), "verts")
         
-        for x in range(len(body.data.vertices)):
-            if not boundary[x]:
-                continue
-            y=body.data.vertices[x].co
-            if min([Vector(y-z).length for z in new_boundary])>0.00001:
-                boundary[x]=False
-        print("Boundary:", sum(boundary), "verts")
+        boundary &= PointIndex([z[:] for z in new_boundary]).within(get_vertex_array(body), 0.00001)
+        print("Boundary:", int(boundary.sum()), "verts")
 
         body.data.vertices.foreach_set('select', boundary)
 
@@ -1879,8 +1890,9 @@ def excise_neuter_mesh(body, injector_mesh, stitch=False):
 def attach_exhaust(arm, body):
     print("Attaching exhaust...")
     t1=time.time()
-    with bpy.data.libraries.load(os.path.dirname(__file__)+"/assets/prefab_materials_meshexporter.blend") as (data_from, data_to):
-        data_to.objects = data_from.objects
+    prefab = prefabs.load(
+        objects=['Prefab exhaust pipe', 'Prefab exhaust pipe Adapter Female', 'Prefab exhaust pipe Adapter Male'],
+        materials=['Exhaust Material'])
 
     bpy.ops.object.mode_set(mode='OBJECT')
     #arm.data.pose_position='REST'
@@ -1922,7 +1934,7 @@ def attach_exhaust(arm, body):
         if L.length<0.4:
             set_weight(body, x, id_ana, 0.8*sigmoid(L.length,0,0.4))
     """
-    mat=bpy.data.materials["Exhaust Material"].copy()
+    mat=prefab['materials']["Exhaust Material"].copy()
     mat.name = 'Exhaust_' + arm.name
     #replace_mat(mesh, mat)
 
@@ -1933,38 +1945,32 @@ def attach_exhaust(arm, body):
         ('Prefab exhaust pipe Adapter Male', Vector([0,0,-0.003])),
         ]:
         #bpy.data.objects['Prefab exhaust pipe'].hide_set(False)
-        m=clone_object(bpy.data.objects['Prefab exhaust pipe'])
+        m=clone_object(prefab['objects']['Prefab exhaust pipe'])
         m.data.materials[0] = mat
         m.location = opts[1]
         m.vertex_groups.new(name='cf_J_Exhaust')
 
 
-        v = vgroup(m, 'cf_J_Perineum')
-        for x in v:
-            # Weights in the prefab are somewhat messed up, 
-            # this is easier than properly repainting it
-            w = 0
-            for g in m.data.vertices[x].groups:
-                w += g.weight
-            if w<1:
-                add_weight(m, x, 'cf_J_ExhaustValve', 1-w)
-            elif w>1:
-                wc = get_weight(m, x, "cf_J_ExhaustClench")
-                wc -= w-1
-                if wc<0:
-                    wc=0
-                set_weight(m, x, "cf_J_ExhaustClench", wc)
-
-            # Reassign the mass of the exhaust pipe (above the valve) from Perineum to Exhaust
-            if m.data.vertices[x].co[2]<9.52:
-                continue
-            w = get_weight(m, x, 'cf_J_Perineum')
-            ws =sigmoid(m.data.vertices[x].co[2], 9.6, 9.85)
-            set_weight(m, x, 'cf_J_Perineum', w*(1-ws))
-            set_weight(m, x, 'cf_J_Exhaust', w*ws)
+        table = get_weight_table(m)
+        v = table.members('cf_J_Perineum')
+        # Weights in the prefab are somewhat messed up, 
+        # this is easier than properly repainting it
+        w = table.row_sum(v)
+        table.add(v[w<1], 'cf_J_ExhaustValve', 1-w[w<1])
+        wc = table.get(v[w>1], "cf_J_ExhaustClench") - (w[w>1]-1)
+        table.set(v[w>1], "cf_J_ExhaustClench", np.maximum(wc, 0))
+
+        # Reassign the mass of the exhaust pipe (above the valve) from Perineum to Exhaust
+        z = get_vertex_array(m)[v,2]
+        v, z = v[z>=9.52], z[z>=9.52]
+        w = table.get(v, 'cf_J_Perineum')
+        ws = np_sigmoid(z, 9.6, 9.85)
+        table.set(v, 'cf_J_Perineum', w*(1-ws))
+        table.set(v, 'cf_J_Exhaust', w*ws)
+        table.flush()
 
         if opts[0] is not None:
-            adapter=clone_object(bpy.data.objects[opts[0]])
+            adapter=clone_object(prefab['objects'][opts[0]])
             #adapter.location = Vector([0,0,0.001])
             #adapter.location = opts[1]
             adapter.data.materials[0] = mat
@@ -2076,13 +2082,13 @@ def attach_injector(arm, body):
     print("Attaching injector...")
     t1=time.time()
     bpy.ops.object.mode_set(mode='OBJECT')
-    with bpy.data.libraries.load(os.path.dirname(__file__)+"/assets/prefab_materials_meshexporter.blend") as (data_from, data_to):
-        data_to.objects = data_from.objects
-        data_to.node_groups = data_from.node_groups
-    injector=clone_object(bpy.data.objects['Prefab Dongle'])
-    injector_mesh=clone_object(bpy.data.objects['Prefab Dongle Mesh'])
+    prefab = prefabs.load(
+        objects=['Prefab Dongle', 'Prefab Dongle Mesh', 'Prefab Dongle Skirt'],
+        node_groups=['HS2 Injector Copy attributes'])
+    injector=clone_object(prefab['objects']['Prefab Dongle'])
+    injector_mesh=clone_object(prefab['objects']['Prefab Dongle Mesh'])
     injector_mesh.name='Injector'
-    injector_sheath=clone_object(bpy.data.objects["Prefab Dongle Skirt"])
+    injector_sheath=clone_object(prefab['objects']["Prefab Dongle Skirt"])
     injector_sheath.name='Sheath'
     injector_mesh.add_rest_position_attribute=True
     injector_sheath.add_rest_position_attribute=True
@@ -2138,7 +2144,7 @@ def attach_injector(arm, body):
 
     # For some reason, vertex groups already on the mesh aren't always visible to the material.
     # Possibly a bug in Blender. Adding a geonode tree to make sure.
-    mod.node_group=bpy.data.node_groups['HS2 Injector Copy attributes']
+    mod.node_group=prefab['node_groups']['HS2 Injector Copy attributes']
 
     # Correct the colors of the injector mesh for color-match the torso mesh.
     w = maintex.size[0]
@@ -2181,25 +2187,22 @@ def attach_injector(arm, body):
 
 def paint_scalp(arm, body):
     vg=body.vertex_groups.new(name="Scalp")
-    faceup = vgroup(body,"cf_J_FaceUp_ty")
-    ignore = set(vgroup(body,['cf_J_EarLow_L','cf_J_EarLow_R',
+    table = get_weight_table(body)
+    faceup = table.members("cf_J_FaceUp_ty")
+    ignore = table.members(['cf_J_EarLow_L','cf_J_EarLow_R',
 #        'cf_J_EarBase_s_L','cf_J_EarBase_s_R',
         'cf_J_FaceLow_s', 'cf_J_FaceLow_s_s', 'cf_J_Chin_rs',
         'cf_J_CheekUp_L', 'cf_J_CheekUp_R',
         'cf_J_Eye01_s_L','cf_J_Eye02_s_L','cf_J_Eye03_s_L',
-        'cf_J_Eye01_s_R','cf_J_Eye02_s_R','cf_J_Eye03_s_R']))
-    for v in faceup:
-        if v in ignore:
-            continue
-        if get_weight(body, v, "cf_J_FaceUp_tz")>0.1:
-            continue
-        if get_weight(body, v, "cf_J_EarBase_s_L")>0.2:
-            continue
-        if get_weight(body, v, "cf_J_EarBase_s_R")>0.2:
-            continue
-        if get_weight(body, v, "cf_J_FaceRoot_s")>0.0 and body.data.vertices[v].co[2]>-0.5:
-            continue
-        vg.add([v], 1.0, 'ADD')
+        'cf_J_Eye01_s_R','cf_J_Eye02_s_R','cf_J_Eye03_s_R'])
+    co = get_vertex_array(body)
+    keep = ~np.isin(faceup, ignore)
+    keep &= table.get(faceup, "cf_J_FaceUp_tz")<=0.1
+    keep &= table.get(faceup, "cf_J_EarBase_s_L")<=0.2
+    keep &= table.get(faceup, "cf_J_EarBase_s_R")<=0.2
+    keep &= ~((table.get(faceup, "cf_J_FaceRoot_s")>0.0) & (co[faceup,2]>-0.5))
+    table.set(faceup[keep], vg.index, 1.0)
+    table.flush()
 
 def mesh_hair_to_curves(body, hair):
     #paint_scalp(body)
@@ -2230,80 +2233,74 @@ def mesh_hair_to_curves(body, hair):
 
 
 def paint_nostrils(arm, body, bm):
-    id_l=body.vertex_groups['cf_J_Nostril_L'].index
-    id_r=body.vertex_groups['cf_J_Nostril_R'].index
-    id_c=body.vertex_groups['cf_J_Nose_Septum'].index
-    id_t=body.vertex_groups['cf_J_Nose_tip'].index
-    #id_b=body.vertex_groups['cf_J_NoseBridge2_s'].index
-    id_tt=body.vertex_groups['cf_J_Nose_t_s'].index
-
-    id_wl = body.vertex_groups['cf_J_NoseWing_tx_L'].index
-    id_wr = body.vertex_groups['cf_J_NoseWing_tx_R'].index
-    id_base = body.vertex_groups['cf_J_NoseBase_s'].index
-
-    v = vgroup(body,['cf_J_NoseWing_tx_L','cf_J_NoseWing_tx_R','cf_J_Nose_tip',
+    table = get_weight_table(body)
+    id_l=table.group_index('cf_J_Nostril_L')
+    id_r=table.group_index('cf_J_Nostril_R')
+    id_c=table.group_index('cf_J_Nose_Septum')
+    id_t=table.group_index('cf_J_Nose_tip')
+    #id_b=table.group_index('cf_J_NoseBridge2_s')
+    id_tt=table.group_index('cf_J_Nose_t_s')
+
+    id_wl = table.group_index('cf_J_NoseWing_tx_L')
+    id_wr = table.group_index('cf_J_NoseWing_tx_R')
+    id_base = table.group_index('cf_J_NoseBase_s')
+
+    v = table.members(['cf_J_NoseWing_tx_L','cf_J_NoseWing_tx_R','cf_J_Nose_tip',
         'cf_J_Nose_t_s',
         'cf_J_Nostril_L','cf_J_Nostril_R',
         'cf_J_Nose_Septum', 'cf_J_NoseBase_s'])
 
-    lay = bm.loops.layers.uv['uv1']
-
     #print(len(v), "candidate nostril verts")
     boy = (body['Boy']>0.0)
     uv_skew = 0.0 if boy else 0.7
-    for x in v:
-        uv = bm.verts[x].link_loops[0][lay].uv
-        septum_bump = bump(uv[0], 0.490, 0.500, 0.510)
-        # 'cf_J_Nostril_*' support: ovals around (0.4826,0.4195) 
-        # (geometry is slightly different between M and F)
-
-        r = (uv-Vector([1-0.4826,0.4195]))
-        r = math.sqrt(r[0]*r[0] + r[1]*r[1] + uv_skew*r[0]*r[1])
-        wtl = sigmoid(r, 0.006, 0.018) * (1-septum_bump)
-
-        r2 = uv-Vector([0.4826,0.4195])
-        r2 = math.sqrt(r2[0]*r2[0] + r2[1]*r2[1] - uv_skew*r2[0]*r2[1])
-        wtr = sigmoid(r2, 0.006, 0.018) * (1-septum_bump)
-
-        # 'cf_J_Nose_Septum' support: oval around (0.500,0.406) .. (0.500,0.418) 
-        r3 = uv-Vector([0.5000,0.418])
-        if r3[1]<0.0:
-            r3[1] = min(0.0, r3[1]+0.012)
-        else:
-            r3[1] *= 2.0
-        wtc = sigmoid(r3.length, 0.000, 0.036)
+    uv = vertex_uvs(bm, v)
+    septum_bump = np_bump(uv[:,0], 0.490, 0.500, 0.510)
+    # 'cf_J_Nostril_*' support: ovals around (0.4826,0.4195) 
+    # (geometry is slightly different between M and F)
+
+    r = uv-np.array([1-0.4826,0.4195])
+    r = np.sqrt(r[:,0]*r[:,0] + r[:,1]*r[:,1] + uv_skew*r[:,0]*r[:,1])
+    wtl = np_sigmoid(r, 0.006, 0.018) * (1-septum_bump)
+
+    r2 = uv-np.array([0.4826,0.4195])
+    r2 = np.sqrt(r2[:,0]*r2[:,0] + r2[:,1]*r2[:,1] - uv_skew*r2[:,0]*r2[:,1])
+    wtr = np_sigmoid(r2, 0.006, 0.018) * (1-septum_bump)
 
-        w_nose_t = get_weight(body, x, id_tt)
-        w_nose_wl = get_weight(body, x, id_wl)
-        w_nose_wr = get_weight(body, x, id_wr)
-        w_nose_base = get_weight(body, x, id_base)
-        w_nose_tip = get_weight(body, x, id_t)
+    # 'cf_J_Nose_Septum' support: oval around (0.500,0.406) .. (0.500,0.418) 
+    r3 = uv-np.array([0.5000,0.418])
+    r3[:,1] = np.where(r3[:,1]<0.0, np.minimum(0.0, r3[:,1]+0.012), r3[:,1]*2.0)
+    wtc = np_sigmoid(np.sqrt((r3*r3).sum(axis=1)), 0.000, 0.036)
 
-        effect = wtl+wtr+wtc
+    transfer_tt_base = np_sigmoid(uv[:,1], 0.395, 0.420)
+    transfer_base_tt = np_sigmoid(uv[:,1], 0.475, 0.450)
 
-        transfer_tt_base = sigmoid(uv[1], 0.395, 0.420)
-        transfer_base_tt = sigmoid(uv[1], 0.475, 0.450)
+    w_nose_t = table.get(v, id_tt)
+    w_nose_wl = table.get(v, id_wl)
+    w_nose_wr = table.get(v, id_wr)
+    w_nose_base = table.get(v, id_base)
+    w_nose_tip = table.get(v, id_t)
 
-        w_nose_t, w_nose_base = w_nose_t-w_nose_t*transfer_tt_base+w_nose_base*transfer_base_tt, w_nose_base+w_nose_t*transfer_tt_base-+w_nose_base*transfer_base_tt
+    effect = wtl+wtr+wtc
 
-        budget = w_nose_t+w_nose_base+w_nose_wl+w_nose_wr+w_nose_tip
+    w_nose_t, w_nose_base = w_nose_t-w_nose_t*transfer_tt_base+w_nose_base*transfer_base_tt, w_nose_base+w_nose_t*transfer_tt_base-w_nose_base*transfer_base_tt
 
-        if effect>1:
-            wtl,wtr,wtc = [y/effect for y in (wtl,wtr,wtc)]
-            effect = 1
+    over = effect>1
+    wtl,wtr,wtc = [np.where(over, y/np.where(over, effect, 1.), y) for y in (wtl,wtr,wtc)]
+    effect = np.minimum(effect, 1)
 
-        budget = w_nose_t+w_nose_base+w_nose_tip+w_nose_wl+w_nose_wr
-        wtl,wtr,wtc = [y*budget for y in (wtl,wtr,wtc)]
-        w_nose_t,w_nose_base,w_nose_tip,w_nose_wl,w_nose_wr = [y*(1-effect) for y in (w_nose_t,w_nose_base,w_nose_tip,w_nose_wl,w_nose_wr)]
+    budget = w_nose_t+w_nose_base+w_nose_tip+w_nose_wl+w_nose_wr
+    wtl,wtr,wtc = [y*budget for y in (wtl,wtr,wtc)]
+    w_nose_t,w_nose_base,w_nose_tip,w_nose_wl,w_nose_wr = [y*(1-effect) for y in (w_nose_t,w_nose_base,w_nose_tip,w_nose_wl,w_nose_wr)]
 
-        set_weight(body, x, id_l, wtl)
-        set_weight(body, x, id_r, wtr)
-        set_weight(body, x, id_c, wtc)
-        set_weight(body, x, id_t, w_nose_tip)
-        set_weight(body, x, id_wl, w_nose_wl)
-        set_weight(body, x, id_wr, w_nose_wr)
-        set_weight(body, x, id_base, w_nose_base)
-        set_weight(body, x, id_tt, w_nose_t)
+    table.set(v, id_l, wtl)
+    table.set(v, id_r, wtr)
+    table.set(v, id_c, wtc)
+    table.set(v, id_t, w_nose_tip)
+    table.set(v, id_wl, w_nose_wl)
+    table.set(v, id_wr, w_nose_wr)
+    table.set(v, id_base, w_nose_base)
+    table.set(v, id_tt, w_nose_t)
+    table.flush()
 
 
 def add_nostrils(arm, body, bm):
@@ -2322,12 +2319,14 @@ def add_nostrils(arm, body, bm):
     vgl = body.vertex_groups.new(name='cf_J_Nostril_L')
     vgr = body.vertex_groups.new(name='cf_J_Nostril_R')
     vgs = body.vertex_groups.new(name='cf_J_Nose_Septum')
+    invalidate_weight_table(body)
     paint_nostrils(arm, body, bm)
 
     bpy.context.view_layer.objects.active = body
     bpy.ops.paint.weight_paint_toggle()
     bpy.ops.object.vertex_group_clean(group_select_mode='ALL', limit=0.002)
     bpy.ops.paint.weight_paint_toggle()
+    invalidate_weight_table(body)
 
 # memorize coordinates and normals of all verts in T-pose (used by the skin generator, 
 # to correctly distribute skin pores and to tan upward-facing skin)
@@ -2652,18 +2651,20 @@ def add_helper_jc_bones(arm):
     bpy.ops.object.mode_set(mode='OBJECT')
 
 def repaint_upper_neck(arm, body):
-    vg = vgroup(body, ["cf_J_Head_s","cf_J_FaceRoot_s","cf_J_FaceRoot_r_s"])
-    for x in vg:
-        wf = get_weight(body, x, "cf_J_FaceRoot_s") 
-        wr = get_weight(body, x, "cf_J_FaceRoot_r_s")
-        w = get_weight(body, x, "cf_J_Head_s") + wf + wr
-        co = body.data.vertices[x].co
-        z = co[1]-15.348+(co[2]-0.08128)*0.2
-        span = 0.40 - 0.40*co[2]
-        set_weight(body, x, "cf_J_Head_s", w*sigmoid(z, 0, span))
-        rear_ratio = 1.-max(0,min(1,(co[2]+0.25)*2.))
-        set_weight(body, x, "cf_J_FaceRoot_s", w*(1.-sigmoid(z, 0, span))*(1.-rear_ratio))
-        set_weight(body, x, "cf_J_FaceRoot_r_s", w*(1.-sigmoid(z, 0, span))*rear_ratio)
+    table = get_weight_table(body)
+    vg = table.members(["cf_J_Head_s","cf_J_FaceRoot_s","cf_J_FaceRoot_r_s"])
+    wf = table.get(vg, "cf_J_FaceRoot_s") 
+    wr = table.get(vg, "cf_J_FaceRoot_r_s")
+    w = table.get(vg, "cf_J_Head_s") + wf + wr
+    co = get_vertex_array(body)[vg]
+    z = co[:,1]-15.348+(co[:,2]-0.08128)*0.2
+    span = 0.40 - 0.40*co[:,2]
+    s = np_sigmoid(z, 0, span)
+    table.set(vg, "cf_J_Head_s", w*s)
+    rear_ratio = 1.-np.clip((co[:,2]+0.25)*2., 0, 1)
+    table.set(vg, "cf_J_FaceRoot_s", w*(1.-s)*(1.-rear_ratio))
+    table.set(vg, "cf_J_FaceRoot_r_s", w*(1.-s)*rear_ratio)
+    table.flush()
 
 
 def repaint_head(arm, body):
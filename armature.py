@@ -9,7 +9,7 @@ from mathutils import Matrix, Vector, Euler, Quaternion
 import struct
 import numpy
 #from .solve_for_deform import try_load_solution_cache, solve_for_deform, save_solution_cache
-from . import add_extras, importer, solve_for_deform
+from . import add_extras, importer, solve_for_deform, unity_dump, prefabs, rig_tables
 
 def recompose(v):
         T = Matrix.Translation(v[0])
@@ -356,6 +356,50 @@ def bone_class(x, comp=None):
         print('Invalid bone class component ', comp, 'requested')
         return None
 
+# Bone classes of an armature's bones, compiled into per-component flags: a structured array
+# aligned with arm.pose.bones, each field a (7,) bool per bone (offset x/y/z, rotation, scale x/y/z)
+bone_class_dtype = numpy.dtype([
+    ('shape', '?', 7),       # s, S
+    ('ignored', '?', 7),     # i
+    ('unexplained', '?', 7), # u
+    ('fk', '?', 7),          # f
+    ('constrained', '?', 7), # c
+    ('locked', '?', 7),      # x
+    ('unknown', '?', 7),     # ?
+    ('excluded', '?'),       # cf_J_Vagina*, cf_J_Legsk*: '???????' whatever the component asked for
+])
+_bone_class_letters = {'shape': 'sS', 'ignored': 'i', 'unexplained': 'u', 'fk': 'f', 'constrained': 'c', 'locked': 'x', 'unknown': '?'}
+
+# bone names -> (table, {name: row})
+_bone_class_tables = {}
+
+def compile_bone_classes(arm):
+    names = tuple(arm.pose.bones.keys())
+    if names in _bone_class_tables:
+        return _bone_class_tables[names]
+    codes = numpy.array([list(bone_class(x)) for x in names], dtype='U1').reshape([-1, 7])
+    table = numpy.zeros(len(names), dtype=bone_class_dtype)
+    for field, letters in _bone_class_letters.items():
+        table[field] = numpy.isin(codes, list(letters))
+    table['excluded'] = [x.startswith('cf_J_Vagina') or x.startswith('cf_J_Legsk') for x in names]
+    _bone_class_tables[names] = (table, {x: k for k, x in enumerate(names)})
+    return _bone_class_tables[names]
+
+def bone_class_table(arm):
+    return compile_bone_classes(arm)[0]
+
+# (N,7) mask of components that are part of the character's shape (s, S, i, u)
+def shape_components(table):
+    return table['shape'] | table['ignored'] | table['unexplained']
+
+# (N,3) mask of bones having any offset, the rotation, any scale component set in mask
+def any_component(mask):
+    return numpy.stack([mask[:, 0:3].any(1), mask[:, 3], mask[:, 4:7].any(1)], 1)
+
+# Position in the 7 bone class components of component n of offset (y=0), rotation (y=1), scale (y=2)
+def component_index(y, n):
+    return n if y==0 else (3 if y==1 else 4+n)
+
 
 rot_mode='YZX'
 
@@ -1016,54 +1060,115 @@ def matrix_world(armature_ob, bone_name):
             print('ERROR: non invertible matrix in matrix_world', bone_name, parent_local)
             return mw @ local @ basis
 
-def assert_bone_class_compliance(x, decomp, scale):
+# 'checks' is the bone's pair of 7-component masks from compliance_checks(); without it, they are
+# worked out from the bone's class
+def assert_bone_class_compliance(x, decomp, scale, checks=None):
     if 'Vagina' in x:
         return
     if 'hair' in x:
         return
     if 'Legsk' in x:
         return
-    bc = bone_class(x)
-    if bc is not None:
-        for k in range(7):
-            large=False
-            if k<3:
-                val = (abs(decomp[0][k]) > 1e-4)
-                large = (abs(decomp[0][k]) > 0.01)
-            elif k==3:
-                #val = (decomp[1] != Quaternion([1,0,0,0]))
-                ampl = abs(decomp[1][1])+abs(decomp[1][2])+abs(decomp[1][3])
-                val = (ampl > 1e-4)
-                large = (ampl > 0.01)
-            else:
-                val = (abs(decomp[2][k-4]-1)>1e-4)
-                large = (abs(decomp[2][k-4]-1)>0.01)
-            if (val and (bc[k] in 'ux')) or (large and bc[k]=='i'):
-                print("Setting unclassified bone component:", x, k, "class", bc[k], "value", decomp)
+    if checks is None:
+        bc = bone_class(x)
+        checks = ([c in 'ux' for c in bc], [c=='i' for c in bc])
+    strict, loose = checks
+    for k in range(7):
+        if not (strict[k] or loose[k]):
+            continue
+        large=False
+        if k<3:
+            val = (abs(decomp[0][k]) > 1e-4)
+            large = (abs(decomp[0][k]) > 0.01)
+        elif k==3:
+            #val = (decomp[1] != Quaternion([1,0,0,0]))
+            ampl = abs(decomp[1][1])+abs(decomp[1][2])+abs(decomp[1][3])
+            val = (ampl > 1e-4)
+            large = (ampl > 0.01)
+        else:
+            val = (abs(decomp[2][k-4]-1)>1e-4)
+            large = (abs(decomp[2][k-4]-1)>0.01)
+        if (val and strict[k]) or (large and loose[k]):
+            print("Setting unclassified bone component:", x, k, "class", bone_class(x)[k], "value", decomp)
+
+# Per bone (strict, loose) lists of 7 flags: strict components (x, u) shouldn't be set at all,
+# loose ones (i) shouldn't be set to large values
+def compliance_checks(table):
+    return list(zip((table['locked'] | table['unexplained']).tolist(), table['ignored'].tolist()))
+
+# (n,4,4) row-major copies of a 4x4 matrix property of all items of a bone collection.
+# foreach_get/foreach_set see Blender's column-major storage, hence the transposes.
+def get_matrices(coll, prop):
+    v = numpy.zeros([len(coll)*16], dtype=numpy.float32)
+    coll.foreach_get(prop, v)
+    return v.reshape([-1, 4, 4]).transpose(0, 2, 1)
+
+def set_matrices(coll, prop, m):
+    v = numpy.ascontiguousarray(numpy.asarray(m, dtype=numpy.float32).transpose(0, 2, 1))
+    coll.foreach_set(prop, v.ravel())
+
+# Bone 'b' and all its descendants, parents before children (depth first, children in order)
+def topological_order(b):
+    order = []
+    stack = [b]
+    while len(stack):
+        x = stack.pop()
+        order.append(x)
+        stack.extend(reversed(x.children))
+    return order
 
 bone_transforms={}
+# Sets matrix_basis of bone 'x' and its descendants so that their armature space matrices match
+# 'dic' (bone name -> Matrix). One top-down pass: each bone's matrix is its parent's (already
+# reshaped) times its own, computed exactly as matrix_world() does, and the new matrix_basis
+# values are written in bulk at the end.
 def reshape_armature_one_bone(x, arm, dic=None):
     global bone_transforms
-    b = arm.data.bones[x]
     if dic==None:
         dic=bone_pos
-    if x in dic:
-        bpy.context.object.data.bones.active = b
-        local = arm.data.bones[x].matrix_local
-        mw = matrix_world(arm, x)
-        target = Matrix(dic[x])
-        decomp = snap((arm.pose.bones[x].matrix_basis @ mw.inverted() @ target).decompose())
-        #print(decomp)
-        arm.pose.bones[x].matrix_basis = recompose(decomp)
-        if not x.endswith('_R'):
-            assert_bone_class_compliance(x, decomp, arm.pose.bones[x].matrix[0][0])
-
-    for x in b.children.keys():
-        reshape_armature_one_bone(x, arm, dic)
-
+    order = topological_order(arm.data.bones[x])
+    pose = arm.pose.bones
+    index = {b.name: i for i, b in enumerate(pose)}
+    checks = compliance_checks(bone_class_table(arm))
+    basis = get_matrices(pose, "matrix_basis")
+    world = {}
+    last = None
+    for b in order:
+        x = b.name
+        i = index[x]
+        local = b.matrix_local
+        mat = Matrix(basis[i])
+        # matrix_world(arm, x) = pre @ matrix_basis
+        if b.parent is None:
+            pre = local
+        else:
+            parent_local = b.parent.matrix_local
+            pw = world.get(b.parent.name)
+            if pw is None:
+                pw = matrix_world(arm, b.parent.name)
+            try:
+                pre = pw @ (parent_local.inverted() @ local)
+            except:
+                print('ERROR: non invertible matrix in matrix_world', x, parent_local)
+                pre = pw @ local
+        mw = pre @ mat
+        if x in dic:
+            target = Matrix(dic[x])
+            decomp = snap((mat @ mw.inverted() @ target).decompose())
+            #print(decomp)
+            new = recompose(decomp)
+            basis[i] = new
+            mw = pre @ new
+            if not x.endswith('_R'):
+                assert_bone_class_compliance(x, decomp, pose[x].matrix[0][0], checks[i])
+            last = b
+        world[x] = mw
+    set_matrices(pose, "matrix_basis", basis)
+    if last is not None:
+        arm.data.bones.active = last
 
 def read_rigfile_from_textblock(x):
-    txt=bpy.data.texts[x].lines
+    txt=prefabs.get('texts', x, link=True).lines
     f=[x.body.strip().split() for x in txt]
     f=[[x[0], [float(x[y]) for y in range(1, 17)]] for x in f]
     f={x[0]:Matrix([x[1][:4],x[1][4:8],x[1][8:12],x[1][12:16]]) for x in f}
@@ -1088,72 +1193,10 @@ def write_rigfile(v, x):
         of.write(s)        
     of.close()
 
+# World matrices of the bones in a Unity dump, as a unity_dump.UnityDump
+# (which also works as a {name: Matrix} dict). Local matrices are available through local_dict().
 def load_unity_dump(dump):
-    bone_pos={}
-    bone_w2l={}
-    bone_parent={}
-    root_pos=[0,0,0]
-    local_pos={}
-    name=''
-    f=open(dump,'r').readlines()
-    hash = hashlib.md5(''.join(f).encode('utf-8')).digest()
-    f=[x.strip() for x in f]
-    if 'cf_J_Root' in f[0]:
-        f[0]='cf_J_Root--UnityEngine.GameObject'
-    elif 'CommonSpace' in f[0]:
-        f[0]='CommonSpace--UnityEngine.GameObject'
-    else:
-        print(f[0])
-        #raise ImportException('ERROR: Could not parse the dump file')
-
-    for n in range(len(f)):
-        x=f[n]
-        if x.endswith('--UnityEngine.GameObject'):
-           name=x.split('-')[0]
-           #print(name)
-        elif x.startswith('@parent<Transform>'):
-            parent=None
-            if len(x.split())>2:
-                parent=x.split()[2]
-            bone_parent[name]=parent
-        elif (x.startswith('@localToWorldMatrix<Matrix4x4>') \
-            or x.startswith('@worldToLocalMatrix<Matrix4x4>')):
-            if not name.startswith('cf_') \
-                and not name.startswith('cm_') \
-                and not name.startswith('p_c'):
-                continue
-            m=[
-                x.split()[-4:],
-                f[n+1].split()[-4:],
-                f[n+2].split()[-4:],
-                f[n+3].split()[-4:] ]
-            m=[[float(y) for y in z] for z in m]
-            if x.startswith('@worldToLocalMatrix'):
-                bone_w2l[name]=m
-            else:
-                if name=='cf_J_Root':
-                    root_pos = [m[0][3],m[1][3],m[2][3]]
-                m[0][3]-=root_pos[0]
-                m[1][3]-=root_pos[1]
-                m[2][3]-=root_pos[2]
-                m[0][1]*=-1
-                m[0][2]*=-1
-                m[0][3]*=-1
-                m[1][0]*=-1
-                m[2][0]*=-1
-                m[3][0]*=-1
-                if m[0][0]==0.0 and m[0][1]==0.0 and m[0][2]==0.0:
-                    m[0][0]=0.0010
-                if m[1][0]==0.0 and m[1][1]==0.0 and m[1][2]==0.0:
-                    m[1][1]=0.0010
-                if m[2][0]==0.0 and m[2][1]==0.0 and m[2][2]==0.0:
-                    m[2][2]=0.0010
-                bone_pos[name]=Matrix(m)
-                if bone_parent[name] in bone_pos:
-                    local_pos[name]=bone_pos[bone_parent[name]].inverted() @ bone_pos[name]
-                else:
-                    local_pos[name] = bone_pos[name]
-    return bone_pos, local_pos, hash
+    return unity_dump.load_dump(dump)
 
 solver_flags = 0
 
@@ -1162,16 +1205,9 @@ def reshape_armature(path, arm, body, fallback, dumpfilename):
     bpy.ops.object.mode_set(mode='OBJECT')
     bpy.ops.object.mode_set(mode='EDIT')
 
-    with bpy.data.libraries.load(os.path.dirname(__file__)+"/assets/prefab_materials_meshexporter.blend") as (data_from, data_to):
-        data_to.texts = data_from.texts
-
-    default_rig = read_rigfile_from_textblock('Rig_Male' if boy else 'Rig_Female')
-    default_rig_head = read_rigfile_from_textblock('Rig_Male_Head' if boy else ('Rig_Female_Head1' if 'cf_J_pupil_s_R' in arm.data.edit_bones else 'Rig_Female_Head0'))
-    for x in default_rig_head:
-        m=default_rig_head[x]
-        m[1][3]+=15.935
-        m[2][3]+=-0.23
-        default_rig[x]=m
+    # Body and head rig (with the head offset applied), from the compiled rig tables
+    default_rig = rig_tables.load_rig('Rig_Male' if boy else 'Rig_Female',
+        'Rig_Male_Head' if boy else ('Rig_Female_Head1' if 'cf_J_pupil_s_R' in arm.data.edit_bones else 'Rig_Female_Head0')).to_dict()
 
     #for b in ['Hallux', 'Long', 'Middle', 'Ring', 'Pinky']:
     #    name = 'cf_J_Toes_' + b + '1_L'
@@ -1234,24 +1270,11 @@ def reshape_armature(path, arm, body, fallback, dumpfilename):
     #        print("Nontrivial roll:", b.name, b.roll)
     body_parts=arm.children 
 
-    # duplicate each item 
+    # snapshot the shape of each item (and of each of its shape keys)
     bpy.ops.object.mode_set(mode='OBJECT')
-    for x in body_parts:
-        bpy.ops.object.select_all(action='DESELECT')
-        x.select_set(True)
-        bpy.context.view_layer.objects.active = x
-        bpy.ops.object.duplicate()
-        dup = bpy.context.object
-        x["ref"] = dup.name
-
-        # unparent duplicate from the rig
-        bpy.ops.object.select_all(action='DESELECT')
-        dup.select_set(True)
-        bpy.context.view_layer.objects.active = dup
-        bpy.ops.object.parent_clear(type='CLEAR')  
-
-
-    bone_pos, _, md5sum = load_unity_dump(dumpfilename)
+    refs = [solve_for_deform.snapshot(x.data) for x in body_parts]
+
+    bone_pos = load_unity_dump(dumpfilename)
     if bone_pos==None:
         raise importer.ImportException("Failed to load the unity dump, aborting")
 
@@ -1269,28 +1292,22 @@ def reshape_armature(path, arm, body, fallback, dumpfilename):
     bpy.ops.object.mode_set(mode='OBJECT')  
     # Solve for undeformed mesh shape
     t1 = time.time()
-    with bpy.data.libraries.load(os.path.dirname(__file__)+"/assets/prefab_materials_meshexporter.blend") as (data_from, data_to):
-        data_to.meshes = data_from.meshes
     bpy.ops.object.mode_set(mode='OBJECT')
-    for b in body_parts:
+    for b, ref in zip(body_parts, refs):
         bpy.context.view_layer.objects.active = b
         b.data.update()
-        b2 = bpy.data.objects[b["ref"]]
-        solve_for_deform.solve_for_deform(arm, b, b2)
+        solve_for_deform.solve_for_deform(arm, b, ref)
 
     t2 = time.time()
     print("Rest position calculated in %.3f s" % (t2-t1)) 
     bpy.ops.object.select_all(action='DESELECT')
-    for x in body_parts:
-        bpy.data.objects[x["ref"]].select_set(True)
-    bpy.ops.object.delete(use_global=False)
     prettify_armature(arm, body)
     return True
 
 def reshape_armature_fallback(arm, body, dumpfilename): 
     arm["default_rig"]=None
     
-    bone_pos, _, _ = load_unity_dump(dumpfilename)
+    bone_pos = load_unity_dump(dumpfilename)
     if bone_pos==None:
         raise importer.ImportException("Failed to load the unity dump, aborting")
     #print(bone_pos)
@@ -1319,7 +1336,7 @@ def load_pose_file(arm, fn):
             print("No such file:", path.dirname(__file__)+"/"+fn)
             return {}
     if 'UnityEngine' in f[0]:
-        _, v, _ =load_unity_dump(fn)
+        v = load_unity_dump(fn).local_dict()
         default_rig = arm["default_rig"]
         for x in v:
             if x in default_rig \
@@ -1359,30 +1376,34 @@ def load_pose(a, fn, flags=3):
     #print(f)
     null_pose=(Vector(), Quaternion(), Vector([1,1,1]))
     ch=('offset','rotation','scale')
-    for x in arm.pose.bones.keys():
-        #print(x)
-        pose = list(arm.pose.bones[x].matrix_basis.decompose())
-        for y in range(3):
-            known=False
-            if (x,ch[y]) in f:
-                #print(f[(x,ch[y])])
-                known=True
-                op = f[(x,ch[y])]
-            else:
-                #print(x, ch[y], "not in file")
-                op = null_pose[y]               
-            c=bone_class(x, ch[y])
-            for n in range(len(op)):
-                if (flags&4) or (c=='?') or (c==None) \
-                    or ((flags&1) and c[n if y!=1 else 0] in ('f',)) \
-                    or ((flags&2) and c[n if y!=1 else 0] in ('s','i','u')):
-                        #if known:
-                        #    print(x,y,n,op[n])
+    # Components set from the file (or reset), per bone
+    table = bone_class_table(arm)
+    settable = numpy.full([len(table), 7], bool(flags&4))
+    if flags & 1:
+        settable |= table['fk']
+    if flags & 2:
+        settable |= shape_components(table)
+    # unclassified bones always get their rotation
+    settable[:, 3] |= table['unknown'][:, 3] & ~table['excluded']
+    settable = settable.tolist()
+    for k, b in enumerate(arm.pose.bones):
+        x = b.name
+        if any(settable[k]):
+            pose = list(b.matrix_basis.decompose())
+            for y in range(3):
+                if (x,ch[y]) in f:
+                    #print(f[(x,ch[y])])
+                    op = f[(x,ch[y])]
+                else:
+                    #print(x, ch[y], "not in file")
+                    op = null_pose[y]
+                for n in range(len(op)):
+                    if settable[k][component_index(y, n)]:
                         pose[y][n]=op[n]
-        arm.pose.bones[x].matrix_basis=recompose(pose)
+            b.matrix_basis=recompose(pose)
         if flags & 2:
             # todo: ideally, deformed_rig should exclude FK bones (but that's too much work) 
-            deformed_rig[x]=arm.pose.bones[x].matrix_basis.copy()
+            deformed_rig[x]=b.matrix_basis.copy()
             
 def snap(x):
     for y in range(2):
@@ -1397,9 +1418,17 @@ def snap(x):
     return x
 
 
-def rescale_one_bone(x, default_rig, deformed_rig, z, rig_delta={}, delta_z=0.0):
+# 'classes' is passed down to the children: the per bone lists of the bone class components that
+# are scaled (s, S, i, u, c) and interpolated (s, S, i, u), and the {name: row} index of the lists
+def rescale_one_bone(x, default_rig, deformed_rig, z, rig_delta={}, delta_z=0.0, classes=None):
     if not x.name in deformed_rig:
         return
+    if classes is None:
+        table, index = compile_bone_classes(x.id_data)
+        soft = shape_components(table)
+        classes = ((soft | table['constrained']).tolist(), soft.tolist(), index)
+    scaled, soft, index = classes
+    k = index[x.name]
     offset, rotation, scale = Matrix(deformed_rig[x.name]).decompose()
     #print(x.name, "Deformed rig: ", offset, rotation, scale)
     #print(x.name, "matrix_basis: ", x.matrix_basis.decompose())
@@ -1407,23 +1436,21 @@ def rescale_one_bone(x, default_rig, deformed_rig, z, rig_delta={}, delta_z=0.0)
     _, fk_rotation, _ = x.matrix_basis.decompose()
     #max_deform = Matrix(deformed_rig[x.name]).decompose()
     #offset, rotation, scale = deformed_delta.decompose()
-    bc = bone_class(x.name, 'offset')
-    if bc!='?' and bc!=None:
-        for c in range(3):
-            if abs(offset[c])>0.0001 and not (bc[c] in ('s','i','u', 'c')):
-                print("Nontrivial offset in bone", x.name, c)
-            if (bc[c] in ('s','i','u','c')):
-                offset[c] = offset[c]*z
+    for c in range(3):
+        if abs(offset[c])>0.0001 and not scaled[k][c]:
+            print("Nontrivial offset in bone", x.name, c)
+        if scaled[k][c]:
+            offset[c] = offset[c]*z
 
     if (x.name, "offset") in rig_delta:
         offset += Vector(rig_delta[(x.name, "offset")])*delta_z
 
     #if Vector(offset).length > 0.001:
     #    print(x.name, offset)
-    bc = bone_class(x.name, 'rotation')
+    soft_rotation = soft[k][3]
     if x=='cf_J_Chin_rs' and 'cf_J_LowerJaw' in deformed_rig:
-        bc = 'f'
-    if bc in ('s','i','u'):
+        soft_rotation = False
+    if soft_rotation:
         #print(x.name, "rotation", z, rotation)
         rotation = Quaternion([1,0,0,0])*(1.-z) + rotation*z
         if (x.name, "rotation") in rig_delta:
@@ -1432,22 +1459,20 @@ def rescale_one_bone(x, default_rig, deformed_rig, z, rig_delta={}, delta_z=0.0)
         if delta_z>0 and ((x.name, "rotation") in rig_delta) and rig_delta[(x.name, "rotation")]!=Quaternion([1,0,0,0]):
             print("Ignoring rig_delta rotation", x.name, rig_delta[(x.name, "rotation")])
         rotation = fk_rotation
-    bc=bone_class(x.name, 'scale')
-    if bc!='?' and bc!=None:
-        for c in range(3):
-            if abs(scale[c]-1)>0.001 and not (bc[c] in ('s','i','u','c')):
-                print("Nontrivial scale in bone", x.name, c)
-            if (bc[c] in ('s','i','u','c')):
-                scale[c]=math.pow(scale[c], z)
-                if (x.name,"scale") in rig_delta:
-                    #print(x.name, "scale", c, ":", math.pow(scale[c], z), "+", rig_delta[(x.name,"scale")][c]-1., "*", delta_z, "=>", scale[c] + (rig_delta[(x.name,"scale")][c]-1.)*delta_z)
-                    scale[c] += (rig_delta[(x.name,"scale")][c]-1.)*delta_z
-                    if scale[c]<0.01:
-                        scale[c] = 0.01
-            else:
-                if delta_z>0 and ((x.name,"scale") in rig_delta) and rig_delta[(x.name,"scale")][c]!=1.0:
-                    print("Ignoring rig delta scale", x.name, c, rig_delta[(x.name,"scale")][c])
-                    #print(x.name, c, 'scale', scale[c], '^', z)
+    for c in range(3):
+        if abs(scale[c]-1)>0.001 and not scaled[k][4+c]:
+            print("Nontrivial scale in bone", x.name, c)
+        if scaled[k][4+c]:
+            scale[c]=math.pow(scale[c], z)
+            if (x.name,"scale") in rig_delta:
+                #print(x.name, "scale", c, ":", math.pow(scale[c], z), "+", rig_delta[(x.name,"scale")][c]-1., "*", delta_z, "=>", scale[c] + (rig_delta[(x.name,"scale")][c]-1.)*delta_z)
+                scale[c] += (rig_delta[(x.name,"scale")][c]-1.)*delta_z
+                if scale[c]<0.01:
+                    scale[c] = 0.01
+        else:
+            if delta_z>0 and ((x.name,"scale") in rig_delta) and rig_delta[(x.name,"scale")][c]!=1.0:
+                print("Ignoring rig delta scale", x.name, c, rig_delta[(x.name,"scale")][c])
+                #print(x.name, c, 'scale', scale[c], '^', z)
     #if (scale-Vector([1,1,1])).length>0.001:
     #    print(x.name, scale)
     T = Matrix.Translation(offset)
@@ -1456,11 +1481,18 @@ def rescale_one_bone(x, default_rig, deformed_rig, z, rig_delta={}, delta_z=0.0)
     x.matrix_basis=(T @ R @ S)
 
     for c in x.children:
-        rescale_one_bone(c, default_rig, deformed_rig, z, rig_delta=rig_delta, delta_z=delta_z)
+        rescale_one_bone(c, default_rig, deformed_rig, z, rig_delta=rig_delta, delta_z=delta_z, classes=classes)
 
 
-def dump_pose(a, of, x='cf_J_Root', flags=3):
+# 'classes' is passed down to the children: the per bone compliance checks, whether the rotation
+# is locked (c, x) or FK, and the {name: row} index of the lists
+def dump_pose(a, of, x='cf_J_Root', flags=3, classes=None):
     arm = bpy.data.objects[a]
+    if classes is None:
+        table, index = compile_bone_classes(arm)
+        classes = (compliance_checks(table), (table['constrained'] | table['locked'])[:, 3].tolist(), table['fk'][:, 3].tolist(), index)
+    checks, locked_rotation, fk_rotation, index = classes
+    k = index[x]
     b = arm.data.bones[x]
     bpy.context.object.data.bones.active = b
     local = arm.pose.bones[x].matrix_basis
@@ -1479,20 +1511,16 @@ def dump_pose(a, of, x='cf_J_Root', flags=3):
             changes[n+4]=1
         if abs(local[2][n]-1)>=0.010:
             changes[n+4]=2
-    assert_bone_class_compliance(x, local, arm.pose.bones[x].matrix[0][0])
-    comp_name=('offset','rotation','scale')
+    assert_bone_class_compliance(x, local, arm.pose.bones[x].matrix[0][0], checks[k])
     if not (x.endswith("_R") and (flags==2)):
-        for comp in range(3):
-            c = bone_class(x, comp_name[comp])
         if (flags & 2) and local[0]!=Vector():
             s=x+' offset %.4f %.4f %.4f\n' % (local[0][0], local[0][1], local[0][2])
             of.write(s)        
         if local[1]!=Quaternion():
-            bc = bone_class(x, 'rotation')
-            if bc in ['c','x']:
+            if locked_rotation[k]:
                 print("Not saving", x, "rotation")
             else:
-                fk = (bc == 'f')
+                fk = fk_rotation[k]
                 if ((flags & 1) and fk) or ((flags & 2) and not fk):
                     s=x+' rotation %.4f %.4f %.4f %.4f\n' % (local[1][0], local[1][1], local[1][2], local[1][3])
                     of.write(s)
@@ -1504,14 +1532,15 @@ def dump_pose(a, of, x='cf_J_Root', flags=3):
     #            local[2][0], local[2][1], local[2][2], local[2][3],
     #            local[3][0], local[3][1], local[3][2], local[3][3]))
     for x in b.children.keys():
-        dump_pose(a, of, x, flags)
+        dump_pose(a, of, x, flags, classes)
 
 
 def set_fk_pose(arm, v):
     if "deformed_rig" in arm:
         deformed_rig = arm["deformed_rig"]
-        for x in arm.pose.bones:
-            if x.name in deformed_rig and bone_class(x.name, 'rotation')=='f':
+        fk = numpy.flatnonzero(bone_class_table(arm)['fk'][:, 3])
+        for x in [arm.pose.bones[k] for k in fk.tolist()]:
+            if x.name in deformed_rig:
                 default_rig = Matrix(deformed_rig[x.name]).decompose()
                 current_rig = x.matrix_basis.decompose()
                 current_rig = (current_rig[0], default_rig[1], current_rig[2])
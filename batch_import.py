@@ -0,0 +1,129 @@
+import bpy
+import os
+import json
+import time
+import shutil
+import tempfile
+import traceback
+import subprocess
+from . import importer, import_cache
+
+#
+# Imports a list of characters in parallel, each in its own headless Blender
+# (see batch_worker.py), which writes the character to a .blend of its own.
+#
+# 'jobs' is a list of import_body keyword argument dicts. Call poll() regularly; it starts
+# workers as slots become free and returns the indices of jobs that have finished since the
+# last call. result(k) is then the .blend to append (or None if the import failed) and
+# status[k] the worker's report. A crashing worker only fails its own job.
+#
+class BatchImport:
+    def __init__(self, jobs, workers=4):
+        self.jobs = jobs
+        self.workers = max(1, workers)
+        self.dir = tempfile.mkdtemp(prefix="hs2_batch_")
+        self.pending = list(range(len(jobs)))
+        self.running = {}
+        self.status = [None] * len(jobs)
+
+    def job_file(self, k, ext):
+        return os.path.join(self.dir, "%04d%s" % (k, ext))
+
+    def start(self, k):
+        job = {
+            "args": self.jobs[k],
+            "output": self.job_file(k, ".blend"),
+            "status": self.job_file(k, ".json"),
+        }
+        with open(self.job_file(k, ".job"), 'w') as f:
+            json.dump(job, f)
+        log = open(self.job_file(k, ".log"), 'w')
+        cmd = [bpy.app.binary_path, "--background", "--factory-startup", "--python-exit-code", "1",
+               "--python", worker_script, "--", self.job_file(k, ".job")]
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        self.running[k] = (proc, log, time.time())
+        print("Batch import: started", self.jobs[k]["name"])
+
+    def finish(self, k, proc, log, t1):
+        log.close()
+        status = None
+        try:
+            with open(self.job_file(k, ".json")) as f:
+                status = json.load(f)
+        except Exception:
+            pass
+        if status is None:
+            status = {"name": self.jobs[k]["name"], "ok": False, "error": "Worker exited with code %d" % proc.returncode}
+        status["wall_time"] = time.time() - t1
+        if not status["ok"] or not os.path.exists(self.job_file(k, ".blend")):
+            status["ok"] = False
+            print("Batch import: %s failed: %s (log: %s)" % (status["name"], status.get("error"), self.job_file(k, ".log")))
+        else:
+            print("Batch import: %s done in %.3f s" % (status["name"], status["wall_time"]))
+        self.status[k] = status
+
+    def poll(self):
+        finished = []
+        for k in list(self.running):
+            proc, log, t1 = self.running[k]
+            if proc.poll() is not None:
+                del self.running[k]
+                self.finish(k, proc, log, t1)
+                finished.append(k)
+        while self.pending and len(self.running) < self.workers:
+            self.start(self.pending.pop(0))
+        return finished
+
+    def done(self):
+        return not self.pending and not self.running
+
+    def finished_count(self):
+        return sum(x is not None for x in self.status)
+
+    def result(self, k):
+        if self.status[k] is None or not self.status[k]["ok"]:
+            return None
+        return self.job_file(k, ".blend")
+
+    def cancel(self):
+        for k in self.running:
+            proc, log, t1 = self.running[k]
+            proc.kill()
+            proc.wait()
+            log.close()
+        self.running = {}
+        self.pending = []
+
+    # Removes the per-character .blend files, unless some failed, in which case the logs are kept
+    def cleanup(self):
+        if all(x is not None and x["ok"] for x in self.status):
+            shutil.rmtree(self.dir, ignore_errors=True)
+        else:
+            for k in range(len(self.jobs)):
+                if os.path.exists(self.job_file(k, ".blend")):
+                    os.remove(self.job_file(k, ".blend"))
+
+worker_script = os.path.join(os.path.dirname(__file__), "batch_worker.py")
+
+# Worker side: runs one job file written by BatchImport.start
+def run_job(job_file):
+    with open(job_file) as f:
+        job = json.load(f)
+    args = job["args"]
+    status = {"name": args["name"], "ok": False}
+    t1 = time.time()
+    try:
+        arm = importer.import_body(**args)
+        status["message"] = importer.last_import_status
+        if arm is None or not importer.last_import_status.startswith('Import successful'):
+            status["error"] = importer.last_import_status
+        else:
+            import_cache.write_character(job["output"], arm)
+            status["ok"] = True
+    except Exception:
+        status["error"] = traceback.format_exc()
+        print(status["error"])
+    status["time"] = time.time() - t1
+    with open(job["status"], 'w') as f:
+        json.dump(status, f)
+    return status["ok"]
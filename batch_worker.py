@@ -0,0 +1,13 @@
+#
+# Worker process of batch_import.BatchImport; imports one character and writes it to a .blend:
+#   blender --background --factory-startup --python batch_worker.py -- job.json
+#
+import os
+import sys
+import importlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+hs2 = importlib.import_module(os.path.basename(here))
+hs2.textures.load_index()
+hs2.batch_import.run_job(sys.argv[sys.argv.index("--")+1])
@@ -0,0 +1,79 @@
+#
+# Times normalize_meshes against the per-mesh edit mode loops it replaced (kept below as the
+# reference) on the meshes of a freshly imported character FBX, and checks that both leave the
+# same sharp edges and normals.
+#
+# Pick a character with many accessories (30+ meshes) and run
+#   blender --background --python benchmarks/bench_normalize_meshes.py -- path/to/character.fbx
+# The FBX is imported into an empty file before each run, so both runs start from the same state.
+#
+import bpy
+import os
+import sys
+import time
+import importlib
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(here)))
+hs2 = importlib.import_module(os.path.basename(os.path.dirname(here)))
+importer = hs2.importer
+
+fbx = sys.argv[sys.argv.index('--')+1]
+
+def import_meshes():
+    bpy.ops.wm.read_homefile(use_empty=True)
+    bpy.ops.import_scene.fbx(filepath=fbx)
+    arm = [x for x in bpy.data.objects if x.type=='ARMATURE'][0]
+    return [x for x in arm.children if x.type=='MESH']
+
+# The edit mode version: mark_sharp(clear=True) in import_bodyparts and normals_tools(mode='RESET')
+# in load_child_textures, one edit mode round trip per mesh each
+def reference(objs):
+    for y in objs:
+        bpy.ops.object.select_all(action='DESELECT')
+        bpy.context.view_layer.objects.active = y
+        bpy.ops.object.mode_set(mode='EDIT')
+        bpy.ops.mesh.select_all(action='SELECT')
+        bpy.ops.mesh.mark_sharp(clear=True)
+        bpy.ops.object.mode_set(mode='OBJECT')
+    for y in objs:
+        bpy.ops.object.select_all(action='DESELECT')
+        bpy.ops.object.mode_set(mode='OBJECT')
+        bpy.context.view_layer.objects.active = y
+        bpy.ops.object.mode_set(mode='EDIT')
+        bpy.ops.mesh.select_all(action='SELECT')
+        bpy.ops.mesh.normals_tools(mode='RESET')
+        bpy.ops.object.mode_set(mode='OBJECT')
+
+# {mesh name: (sharp edges, (loops,3) normals)}
+def state(objs):
+    v = {}
+    for y in objs:
+        mesh = y.data
+        sharp = np.zeros([len(mesh.edges)], dtype=bool)
+        mesh.edges.foreach_get('use_edge_sharp', sharp)
+        normals = np.zeros([len(mesh.loops)*3], dtype=np.float32)
+        if hasattr(mesh, "corner_normals"):
+            mesh.corner_normals.foreach_get('vector', normals)
+        else:
+            mesh.calc_normals_split()
+            mesh.loops.foreach_get('normal', normals)
+        v[mesh.name] = (sharp, normals.reshape([-1, 3]))
+    return v
+
+results = {}
+for name, func in [("edit mode", reference), ("data pass", importer.normalize_meshes)]:
+    objs = import_meshes()
+    t1 = time.time()
+    func(objs)
+    t2 = time.time()
+    results[name] = (t2-t1, state(objs))
+    print("%-10s %d meshes, %.3f s" % (name, len(objs), t2-t1))
+
+a = results["edit mode"]
+b = results["data pass"]
+print("Same meshes: %s" % (sorted(a[1])==sorted(b[1])))
+print("Sharp edge differences: %d" % sum(int((a[1][x][0]!=b[1][x][0]).sum()) for x in a[1] if x in b[1]))
+print("Max normal difference: %g" % max([np.abs(a[1][x][1]-b[1][x][1]).max(initial=0.0) for x in a[1] if x in b[1]] + [0.0]))
+print("Speedup: %.2fx" % (a[0] / b[0]))
@@ -0,0 +1,64 @@
+#
+# Times reshape_armature_one_bone against the recursive version it replaced (kept below as the
+# reference) on the full HS2 rig, and checks that both produce the same matrix_basis values.
+#
+# Import a character, save it, then run
+#   blender --background character.blend --python benchmarks/bench_reshape_armature.py
+# The file is reverted before each run, so both runs start from the same state.
+#
+import bpy
+import os
+import sys
+import time
+import importlib
+import numpy as np
+from mathutils import Matrix
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(here)))
+hs2 = importlib.import_module(os.path.basename(os.path.dirname(here)))
+armature = hs2.armature
+
+def find_character():
+    for x in bpy.data.objects:
+        if x.type=='ARMATURE' and 'body' in x:
+            return x
+    raise Exception("No imported character in " + bpy.data.filepath)
+
+def dump_file(arm):
+    path = arm["dump_dir"]
+    dumps = [x for x in os.listdir(path) if x.endswith('.txt') and not x.startswith('pose_')]
+    return os.path.join(path, dumps[0])
+
+# The recursive version: matrix_world() walks up to the root for every bone
+def reference(x, arm, dic):
+    b = arm.data.bones[x]
+    if x in dic:
+        bpy.context.object.data.bones.active = b
+        mw = armature.matrix_world(arm, x)
+        target = Matrix(dic[x])
+        decomp = armature.snap((arm.pose.bones[x].matrix_basis @ mw.inverted() @ target).decompose())
+        arm.pose.bones[x].matrix_basis = armature.recompose(decomp)
+    for x in b.children.keys():
+        reference(x, arm, dic)
+
+results = {}
+for name, func in [("recursive", reference), ("single pass", armature.reshape_armature_one_bone)]:
+    bpy.ops.wm.revert_mainfile()
+    arm = find_character()
+    bone_pos = armature.load_unity_dump(dump_file(arm))
+    bpy.context.view_layer.objects.active = arm
+    bpy.ops.object.mode_set(mode='POSE')
+    # Start from the rest pose, as during import
+    for b in arm.pose.bones:
+        b.matrix_basis = Matrix()
+    t1 = time.time()
+    func('cf_J_Root', arm, bone_pos)
+    t2 = time.time()
+    results[name] = (t2-t1, armature.get_matrices(arm.pose.bones, "matrix_basis").copy())
+    print("%-12s %d bones, %.3f s" % (name, len(arm.pose.bones), t2-t1))
+
+a = results["recursive"]
+b = results["single pass"]
+print("Max matrix_basis difference: %g" % np.abs(a[1]-b[1]).max())
+print("Speedup: %.2fx" % (a[0] / b[0]))
@@ -0,0 +1,63 @@
+#
+# Times getting the default rigs by parsing their text blocks (as reshape_armature did before)
+# against loading the compiled rig tables, and checks that both give the same matrices.
+#
+# Needs no character:
+#   blender --background --python benchmarks/bench_rig_tables.py
+#
+import bpy
+import os
+import sys
+import time
+import importlib
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(here)))
+hs2 = importlib.import_module(os.path.basename(os.path.dirname(here)))
+armature = hs2.armature
+rig_tables = hs2.rig_tables
+
+rigs = [('Rig_Male', 'Rig_Male_Head'), ('Rig_Female', 'Rig_Female_Head0'), ('Rig_Female', 'Rig_Female_Head1')]
+runs = 10
+
+# The text block version
+def parse(body, head):
+    default_rig = armature.read_rigfile_from_textblock(body)
+    default_rig_head = armature.read_rigfile_from_textblock(head)
+    for x in default_rig_head:
+        m=default_rig_head[x]
+        m[1][3]+=15.935
+        m[2][3]+=-0.23
+        default_rig[x]=m
+    return default_rig
+
+def table(body, head):
+    return rig_tables.load_rig(body, head).to_dict()
+
+# Reads the text blocks from the library once, so that isn't timed
+for body, head in rigs:
+    hs2.prefabs.load(link=True, texts=[body, head])
+
+def timed(func, body, head, cold=None):
+    t = 0.0
+    for i in range(runs):
+        if cold is not None:
+            cold()
+        t1 = time.time()
+        rig = func(body, head)
+        t += time.time()-t1
+    return t / runs * 1000, rig
+
+def from_disk():
+    rig_tables.clear_rig_cache()
+
+for body, head in rigs:
+    # Builds the table if it isn't cached yet
+    rig_tables.load_rig(body, head)
+    t_parse, a = timed(parse, body, head)
+    t_disk, b = timed(table, body, head, from_disk)
+    t_mem, b = timed(table, body, head)
+    diff = max(np.abs(np.array(a[x]) - np.array(b[x])).max() for x in a)
+    print("%s + %s: %d bones, parse %.2f ms, table from disk %.2f ms, in memory %.2f ms, same names/order: %s, max difference %g" % (
+        body, head, len(a), t_parse, t_disk, t_mem, list(a)==list(b), diff))
@@ -0,0 +1,51 @@
+#
+# Times add_shape_keys + add_skull_soft_neutral with and without the cached weight table.
+#
+# Import a character with 'Extend safe' turned off, save it, then run
+#   blender --background character.blend --python benchmarks/bench_vgroup_index.py
+# The file is reverted before each run, so both runs start from the same state.
+#
+import bpy
+import os
+import sys
+import time
+import importlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(here)))
+hs2 = importlib.import_module(os.path.basename(os.path.dirname(here)))
+add_extras = hs2.add_extras
+weights = hs2.weights
+
+def find_character():
+    for x in bpy.data.objects:
+        if x.type=='ARMATURE' and 'body' in x:
+            return x, x['body']
+    raise Exception("No imported character in " + bpy.data.filepath)
+
+results = {}
+for cached in [False, True]:
+    bpy.ops.wm.revert_mainfile()
+    arm, body = find_character()
+    weights.use_cache = cached
+    weights.clear_weight_tables()
+    bpy.context.view_layer.objects.active = arm
+    bpy.ops.object.mode_set(mode='POSE')
+
+    # Within a caching pass, as during import
+    weights.begin_caching()
+    try:
+        t1 = time.time()
+        add_extras.add_shape_keys(arm, body, False)
+        t2 = time.time()
+        add_extras.add_skull_soft_neutral(arm, body)
+        t3 = time.time()
+    finally:
+        weights.end_caching()
+    results[cached] = (t2-t1, t3-t2)
+
+weights.use_cache = True
+for cached in [False, True]:
+    t = results[cached]
+    print("%-12s add_shape_keys %.3f s, add_skull_soft_neutral %.3f s, total %.3f s" % ("cached" if cached else "uncached", t[0], t[1], t[0]+t[1]))
+print("Speedup: %.2fx" % (sum(results[False]) / sum(results[True])))
@@ -0,0 +1,79 @@
+#
+# Compares the array helpers of add_extras (np_sigmoid, np_bump, np_interpolate, np_curve_interp,
+# np_curve_find_nearest) with the scalar versions they replace on random input, and times both.
+# Raises AssertionError on a mismatch.
+#
+# curve_find_nearest needs mathutils, so this runs in Blender; no character is needed:
+#   blender --background --python benchmarks/check_array_helpers.py
+#
+import os
+import sys
+import time
+import importlib
+import numpy as np
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(os.path.dirname(here)))
+hs2 = importlib.import_module(os.path.basename(os.path.dirname(here)))
+add_extras = hs2.add_extras
+
+n = 5000
+rng = np.random.default_rng(0)
+x = rng.uniform(-0.5, 1.5, n)
+a = rng.uniform(-0.5, 1.5, n)
+b = rng.uniform(-0.5, 1.5, n)
+uv = rng.uniform(0.25, 0.55, [n,2])
+curve = [
+(0.420, 0.332),
+(0.421, 0.362),
+(0.433, 0.394),
+(0.448, 0.438),
+(0.458, 0.448),
+(0.468, 0.453),
+(0.475, 0.449),
+]
+fcurve = [0.0, 0.5, 1.0, 0.4, 0.3]
+
+# scalar() and array() compute the same values; returns both, and prints their times
+def timed(name, scalar, array):
+    t1 = time.time()
+    expected = scalar()
+    t2 = time.time()
+    got = array()
+    t3 = time.time()
+    print("%-28s scalar %8.2f ms, array %7.2f ms" % (name, (t2-t1)*1000, (t3-t2)*1000))
+    return expected, got
+
+def check(name, scalar, array, tol=1e-9):
+    expected, got = timed(name, scalar, array)
+    err = np.abs(np.array(expected, dtype=np.float64)-np.asarray(got, dtype=np.float64)).max()
+    assert err<=tol, "%s: array version differs by %g" % (name, err)
+
+check("sigmoid", lambda: [add_extras.sigmoid(y) for y in x], lambda: add_extras.np_sigmoid(x))
+check("sigmoid(x_full)", lambda: [add_extras.sigmoid(y, 0.7) for y in x], lambda: add_extras.np_sigmoid(x, 0.7))
+check("sigmoid(x_full, x_min)", lambda: [add_extras.sigmoid(y, p, q) for y, p, q in zip(x, a, b)], lambda: add_extras.np_sigmoid(x, a, b))
+check("sigmoid(None, x_min)", lambda: [add_extras.sigmoid(y, None, -0.3) for y in x], lambda: add_extras.np_sigmoid(x, None, -0.3))
+for shape in ['sigmoid', 'cos']:
+    check("bump "+shape, lambda: [add_extras.bump(y, p, None, q, shape=shape) for y, p, q in zip(x, a, b)],
+        lambda: add_extras.np_bump(x, a, None, b, shape=shape))
+    check("bump(x1) "+shape, lambda: [add_extras.bump(y, -0.2, 0.1, 1.2, shape=shape) for y in x],
+        lambda: add_extras.np_bump(x, -0.2, 0.1, 1.2, shape=shape))
+check("interpolate", lambda: [add_extras.interpolate(0.3, -0.2, p, q, y) for y, p, q in zip(x, a, b)],
+    lambda: add_extras.np_interpolate(0.3, -0.2, a, b, x))
+check("curve_interp", lambda: [add_extras.curve_interp(curve, y) for y in uv[:,0]],
+    lambda: add_extras.np_curve_interp(curve, uv[:,0]))
+check("curve_interp xsymm", lambda: [add_extras.curve_interp(curve, 1.0-y, xsymm=True) for y in uv[:,0]],
+    lambda: add_extras.np_curve_interp(curve, 1.0-uv[:,0], xsymm=True))
+check("curve_interp float", lambda: [add_extras.curve_interp(fcurve, 6*y-1) for y in x],
+    lambda: add_extras.np_curve_interp(fcurve, 6*x-1))
+
+# mathutils works in single precision
+expected, got = timed("curve_find_nearest", lambda: [add_extras.curve_find_nearest(curve, tuple(y)) for y in uv],
+    lambda: add_extras.np_curve_find_nearest(curve, uv))
+pos, t, frac, side, dist = got
+for k, name, v, tol in [(0, "pos", pos, 1e-6), (1, "t", t, 1e-6), (2, "frac", frac, 1e-4), (3, "side", side, 1e-6), (4, "dist", dist, 1e-6)]:
+    e = [y[k][:] if k==0 else y[k] for y in expected]
+    err = np.abs(np.array(e, dtype=np.float64)-np.asarray(v, dtype=np.float64)).max()
+    assert err<=tol, "curve_find_nearest %s: array version differs by %g" % (name, err)
+
+print("Array helpers match their scalar versions (%d samples)" % n)
@@ -0,0 +1,181 @@
+#
+# Imports characters without the UI and saves each one to its own .blend:
+#   blender --background --python cli.py -- [options] INPUT...
+#
+# INPUT is a dump directory (the one holding the .fbx and the Unity dump) or a preset file
+# such as assets/hs2blender.json, in which case all its presets are imported.
+# Writes <out>/<name>.blend per character and a JSON report with the status and time of
+# each one (rewritten after every character). Exits with 1 if any import failed.
+#
+# Example:
+#   blender --background --python cli.py -- --out /data/blends --workers 4 --no-subdivide assets/hs2blender.json
+#
+import bpy
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import traceback
+import importlib
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+hs2 = importlib.import_module(os.path.basename(here))
+importer = hs2.importer
+import_cache = hs2.import_cache
+batch_import = hs2.batch_import
+
+def parse_args():
+    argv = sys.argv[sys.argv.index("--")+1:] if "--" in sys.argv else []
+    parser = argparse.ArgumentParser(prog="cli.py", description="HS2 character batch importer")
+    parser.add_argument("inputs", nargs="+", help="dump directories and/or hs2blender.json preset files")
+    parser.add_argument("--out", default=".", help="directory for the .blend files (default: current directory)")
+    parser.add_argument("--report", default=None, help="JSON report file (default: <out>/import_report.json)")
+    parser.add_argument("--workers", type=int, default=1, help="number of Blender processes importing in parallel (default: 1)")
+    parser.add_argument("--favorites", action="store_true", help="only import the favorites of preset files")
+    def flag(name, default, help):
+        parser.add_argument("--" + name.replace('_', '-'), dest=name, action="store_true", default=default, help=help)
+        parser.add_argument("--no-" + name.replace('_', '-'), dest=name, action="store_false")
+    flag("refactor", True, "refactor armature (default: on)")
+    flag("extend_safe", True, "extend (safe) (default: on)")
+    flag("extend_full", False, "extend (full) (default: off)")
+    flag("subdivide", True, "subdivide (default: on)")
+    flag("exhaust", True, "add an exhaust (default: on)")
+    flag("replace_teeth", True, "replace teeth (default: on)")
+    flag("reweight_clothing", True, "transfer torso weights to clothing (default: on)")
+    flag("cache", True, "use the import cache (default: on)")
+    flag("defer_textures", False, "save clothing hidden, with hair and clothing textures loaded when first shown or rendered (default: off)")
+    parser.add_argument("--injector", choices=["Auto", "Yes", "No"], default="Auto", help="add an injector (default: Auto)")
+    return parser.parse_args(argv)
+
+# Name of a character imported from a dump directory, as used by the Import operator
+def dir_name(s):
+    while len(s) and (s[-1] == '/' or s[-1] == '\\'):
+        s = s[:-1]
+    if os.path.basename(s).lower() == "textures":
+        s = os.path.dirname(s)
+    name = os.path.basename(s)
+    while len(name) and (name[0].isdigit() or name[0] == '_'):
+        name = name[1:]
+    return s, name
+
+# (dump dir, name, eye color, hair color, customization) of all characters to import
+def collect(args):
+    v = []
+    for x in args.inputs:
+        if os.path.isfile(x) and x.endswith('.json'):
+            with open(x, "r") as fp:
+                cfg = json.load(fp)
+            hs2.waifus_path = cfg["waifus_path"]
+            favorites = set(cfg.get("favorites", []))
+            for k in sorted(cfg["presets"], key=int):
+                p = cfg["presets"][k]
+                p = hs2.convert_preset(p) if isinstance(p, list) else hs2.convert_preset_from_dict(p)
+                if args.favorites and p["uuid"] not in favorites:
+                    continue
+                v.append((p.get_path(), p.name, p.eye_color, p.hair_color, p.get("customization")))
+        else:
+            path, name = dir_name(x)
+            v.append((path, name, (0.0, 0.0, 0.8), (0.8, 0.8, 0.5), None))
+    return v
+
+def import_args(args, x):
+    return dict(
+        input=x[0],
+        refactor=args.refactor,
+        do_extend_safe=args.extend_safe,
+        do_extend_full=args.extend_full,
+        replace_teeth=args.replace_teeth,
+        add_injector=args.injector,
+        add_exhaust=args.exhaust,
+        subdivide=args.subdivide,
+        c_eye=[float(y) for y in x[2]],
+        c_hair=[float(y) for y in x[3]],
+        name=x[1],
+        customization=x[4],
+        reweight_clothing=args.reweight_clothing,
+        use_cache=args.cache,
+        defer_textures=args.defer_textures
+    )
+
+def output_file(args, name, used):
+    s = "".join(c if c.isalnum() or c in "-_. " else "_" for c in name).strip() or "character"
+    fn = s
+    n = 1
+    while fn in used:
+        n += 1
+        fn = "%s_%d" % (s, n)
+    used.add(fn)
+    return os.path.join(args.out, fn + ".blend")
+
+def write_report(fn, report, t0):
+    with open(fn, 'w') as f:
+        json.dump({
+            "total_time": time.time() - t0,
+            "succeeded": sum(x["ok"] for x in report),
+            "failed": sum(not x["ok"] for x in report),
+            "characters": report,
+        }, f, indent=1)
+
+def run_serial(args, jobs, outputs, report, report_fn, t0):
+    for job, fn in zip(jobs, outputs):
+        status = {"name": job["name"], "input": job["input"], "ok": False}
+        t1 = time.time()
+        try:
+            bpy.ops.wm.read_factory_settings(use_empty=True)
+            arm = importer.import_body(**job)
+            status["message"] = importer.last_import_status
+            if arm is None or not importer.last_import_status.startswith('Import successful'):
+                status["error"] = importer.last_import_status
+            else:
+                import_cache.write_character(fn, arm)
+                status["ok"] = True
+                status["output"] = fn
+        except Exception:
+            status["error"] = traceback.format_exc()
+            print(status["error"])
+        status["time"] = time.time() - t1
+        print("%s: %s in %.3f s" % (job["name"], "done" if status["ok"] else "FAILED", status["time"]))
+        report.append(status)
+        write_report(report_fn, report, t0)
+
+def run_parallel(args, jobs, outputs, report, report_fn, t0):
+    batch = batch_import.BatchImport(jobs, args.workers)
+    while not batch.done():
+        for k in batch.poll():
+            status = batch.status[k]
+            status["input"] = jobs[k]["input"]
+            if batch.result(k) is not None:
+                shutil.move(batch.result(k), outputs[k])
+                status["output"] = outputs[k]
+            else:
+                status["log"] = batch.job_file(k, ".log")
+            report.append(status)
+            write_report(report_fn, report, t0)
+        time.sleep(0.5)
+    batch.cleanup()
+
+def main():
+    args = parse_args()
+    t0 = time.time()
+    os.makedirs(args.out, exist_ok=True)
+    report_fn = args.report or os.path.join(args.out, "import_report.json")
+    hs2.textures.load_index()
+    characters = collect(args)
+    jobs = [import_args(args, x) for x in characters]
+    used = set()
+    outputs = [output_file(args, x["name"], used) for x in jobs]
+    print("Importing %d characters" % len(jobs))
+    report = []
+    if args.workers > 1 and len(jobs) > 1:
+        run_parallel(args, jobs, outputs, report, report_fn, t0)
+    else:
+        run_serial(args, jobs, outputs, report, report_fn, t0)
+    write_report(report_fn, report, t0)
+    failed = sum(not x["ok"] for x in report)
+    print("Imported %d of %d characters in %.3f s, report in %s" % (len(report) - failed, len(jobs), time.time() - t0, report_fn))
+    sys.exit(1 if failed else 0)
+
+main()
@@ -0,0 +1,111 @@
+import bpy
+import os
+import time
+import json
+import hashlib
+from . import unity_dump, textures, lazy_textures
+
+# Fully imported characters are saved here as .blend files, named after a hash of everything
+# the import depends on (see cache_key), so that loading the same preset again only has to
+# append the saved objects.
+cache_dir = os.path.join(os.path.dirname(__file__), "cache", "imports")
+CACHE_VERSION = 1
+
+_source_digest = None
+
+def file_hash(path):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            h.update(chunk)
+    return h.digest()
+
+# Digest of the add-on's own .py files, so that caches made by a different version of the code are never used
+def source_digest():
+    global _source_digest
+    if _source_digest is None:
+        from . import bl_info
+        h = hashlib.md5(str(bl_info["version"]).encode('utf-8'))
+        root = os.path.dirname(__file__)
+        for x in sorted(os.listdir(root)):
+            if x.endswith('.py'):
+                h.update(x.encode('utf-8'))
+                h.update(file_hash(os.path.join(root, x)))
+        _source_digest = h.digest()
+    return _source_digest
+
+# Hash of the FBX, the Unity dump, any extra input files that exist (e.g. customization),
+# the texture files in 'texture_dir', the import options and the add-on version
+def cache_key(fbx, dumpfilename, extra_files, options, texture_dir):
+    h = hashlib.md5(("v%d" % CACHE_VERSION).encode('utf-8'))
+    h.update(source_digest())
+    h.update(file_hash(fbx))
+    h.update(unity_dump.dump_hash(dumpfilename))
+    for x in extra_files:
+        if os.path.exists(x):
+            h.update(os.path.basename(x).encode('utf-8'))
+            h.update(file_hash(x))
+    # Bump map analysis, skin tone etc. are saved with the character, so every texture the
+    # import may pick (all those textures.TextureIndex lists) is part of the key
+    index = textures.TextureIndex(texture_dir)
+    for x in sorted(y for v in index.kinds.values() for y in v):
+        h.update(x.encode('utf-8'))
+        h.update(textures.file_hash(index.path + x).encode('utf-8'))
+    h.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    return h.hexdigest()
+
+def cache_path(key):
+    return os.path.join(cache_dir, key + ".blend")
+
+# Appends all objects of a character .blend (as written by write_character) to the current
+# scene and returns the armature
+def append_character(fn):
+    with bpy.data.libraries.load(fn, link=False) as (data_from, data_to):
+        data_to.objects = data_from.objects
+    arm = None
+    for x in data_to.objects:
+        if x is None:
+            continue
+        bpy.context.collection.objects.link(x)
+        if x.type=='ARMATURE' and x.parent is None and 'body' in x:
+            arm = x
+    # Appended images are new datablocks even if the scene already has the same textures
+    textures.share_images()
+    lazy_textures.scan()
+    return arm
+
+# Writes the armature and all its children (with everything they use) to 'fn'
+def write_character(fn, arm):
+    tmp = fn + ".tmp%d.blend" % os.getpid()
+    bpy.data.libraries.write(tmp, set([arm] + list(arm.children_recursive)), path_remap='ABSOLUTE', fake_user=False)
+    os.replace(tmp, fn)
+
+# Appends the objects of a cached import to the current scene and returns the armature,
+# or None if there's nothing cached under 'key'
+def load(key):
+    fn = cache_path(key)
+    if not os.path.exists(fn):
+        return None
+    t1 = time.time()
+    arm = append_character(fn)
+    t2 = time.time()
+    print("Restored", fn, "in %.3f s" % (t2-t1))
+    return arm
+
+def save(key, arm):
+    t1 = time.time()
+    fn = cache_path(key)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        write_character(fn, arm)
+    except Exception as e:
+        print("Failed to write import cache", fn, e)
+        return
+    t2 = time.time()
+    print("Saved", fn, "in %.3f s" % (t2-t1))
+
+def clear():
+    if os.path.isdir(cache_dir):
+        for x in os.listdir(cache_dir):
+            if x.endswith('.blend'):
+                os.remove(os.path.join(cache_dir, x))
@@ -18,7 +18,7 @@ from bpy.props import (
     FloatVectorProperty
 )
 
-from . import add_extras, armature, attributes
+from . import add_extras, armature, attributes, weights, import_cache, textures, texture_analysis, proxies, lazy_textures, mesh_ops, prefabs
 
 class ImportException(Exception):
     def __init__(self, text):
@@ -38,17 +38,15 @@ bodyparts=[
 #    path+='\\'
 path=""
 
-hash_to_file_map={}
-
 def find_tex(x1, x2):
-    f=os.listdir(path)
-    for y in f:
-        if (x1+'_' in y) and y.endswith("_"+x2+".png"):
-            md5=hashlib.md5(open(path+y,'rb').read()).hexdigest()
-            if md5 in hash_to_file_map:
-                return hash_to_file_map[md5]
-            return path+y
-    return None
+    tex=textures.get_index(path).find(x1, x2)
+    if tex is not None:
+        tex=textures.canonical_file(tex)
+    return tex
+
+# When set (by load_textures, for clothing and accessories), textures not loaded yet
+# are bound to a placeholder and loaded later, see lazy_textures
+deferring = False
 
 def set_tex(obj, node, x, y, alpha=None, csp=None):
     #global chara
@@ -57,49 +55,36 @@ def set_tex(obj, node, x, y, alpha=None, csp=None):
     if tex==None:
         #print('Warning: failed to find texture ', x, y)
         return None
-    for t in bpy.data.images:
-        if t.filepath == tex:
-            #print("Reusing", t.filepath)
-            if isinstance(obj, bpy.types.Material):
-                obj.node_tree.nodes[node].image=t
-            else:
-                obj.data.materials[0].node_tree.nodes[node].image=t
-            return t
-    tex=bpy.data.images.load(tex, check_existing=True)
+    if isinstance(obj, bpy.types.Material):
+        mat=obj
+    else:
+        mat=obj.data.materials[0]
+    # Images loaded from identical content are reused, wherever they came from
+    if deferring and textures.shared_image(tex, alpha, csp) is None:
+        return lazy_textures.defer(mat, node, tex, alpha, csp)
+    fn=tex
+    tex=textures.load_image(fn, alpha, csp)
     if tex==None:
         print('Warning: failed to load texture ', x, y)
         return None
-    if alpha!=None:
-        tex.alpha_mode='NONE'
-    if csp!=None:
-        tex.colorspace_settings.name=csp
-    if isinstance(obj, bpy.types.Material):
-        obj.node_tree.nodes[node].image=tex
-    else:
-        obj.data.materials[0].node_tree.nodes[node].image=tex
+    mat.node_tree.nodes[node].image=tex
     return tex
 
 #sc = bpy.data.scenes[0]
 
-def bbox(x):
-     rv=[[x[0].co[0],x[0].co[1],x[0].co[2]],
-         [x[0].co[0],x[0].co[1],x[0].co[2]]]
-     for y in x:
-         for n in range(3):
-             rv[0][n]=min(rv[0][n], y.co[n])
-             rv[1][n]=max(rv[1][n], y.co[n])
-     return rv
-
+# Joins the objects into the first one. The join operator runs on exactly these objects
+# (through a context override), whatever the selection; the result is left active.
 def join_meshes(v, name=None):
     if len(v)==0:
         return
-    bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.ops.object.select_all(action='DESELECT')
-    for x in v:
-        bpy.data.objects[x].select_set(True)
-    bpy.context.view_layer.objects.active = bpy.data.objects[v[0]] 
-    bpy.ops.object.join()
-    final=bpy.data.objects[v[0]]
+    mesh_ops.object_mode()
+    objs=[bpy.data.objects[x] for x in v]
+    if len(objs)>1:
+        with bpy.context.temp_override(active_object=objs[0], object=objs[0], selected_objects=objs, selected_editable_objects=objs):
+            bpy.ops.object.join()
+    final=objs[0]
+    bpy.context.view_layer.objects.active = final
+    final.select_set(True)
     if name is not None:
         final.name=name
     return final
@@ -108,54 +93,29 @@ def join_meshes(v, name=None):
 # we have to work out which parts are which by looking at their coordinates
 def rebuild_torso(arm, body):
     #global chara
-    bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.ops.object.select_all(action='DESELECT')
-    #body=bpy.data.objects[body.]
-    bpy.context.view_layer.objects.active = body
-    box = bbox(body.data.vertices)
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.separate(type='LOOSE')
-    nails=[]
-    other=[]
-    junk=[]
+    mesh_ops.object_mode()
+    co = mesh_ops.coordinates(body.data)
+    box = [co.min(axis=0), co.max(axis=0)]
+    labels, n = mesh_ops.loose_parts(body.data)
+    lo, hi = mesh_ops.part_bounds(co, labels, n)
     bn=body.name
     if '.' in bn:
         bn=bn.split('.')
         bn=bn[0]
-    #for x in bpy.data.meshes.keys():
-    for ch in arm.children:
-        if ch.type!='MESH':
-            continue
-        x=ch.name
-        if not x.startswith(bn):
-            continue
-        b = bbox(bpy.data.objects[x].data.vertices)
-        #print(x, bpy.data.meshes[x].vertices[0].co, b, ( b[1][0]- b[0][0])/(box[1][0]-box[0][0]))
-        if b[1][0]<box[0][0]+0.2*(box[1][0]-box[0][0]) \
-         or b[0][0]>box[0][0]+0.8*(box[1][0]-box[0][0]) \
-         or b[1][1]<box[0][1]+0.2*(box[1][1]-box[0][1]):
-            nails.append(x)
-        elif b[0][1]>box[0][1]+0.96*(box[1][1]-box[0][1]):
-            junk.append(x)
-        else:
-            other.append(x)
-    bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.ops.object.select_all(action='DESELECT')
-    for x in junk:
-        bpy.data.objects[x].select_set(True)
-    bpy.ops.object.delete()
-    if len(nails)!=20:
+    nails = (hi[:,0]<box[0][0]+0.2*(box[1][0]-box[0][0])) \
+        | (lo[:,0]>box[0][0]+0.8*(box[1][0]-box[0][0])) \
+        | (hi[:,1]<box[0][1]+0.2*(box[1][1]-box[0][1]))
+    junk = ~nails & (lo[:,1]>box[0][1]+0.96*(box[1][1]-box[0][1]))
+    if np.count_nonzero(nails)!=20:
         # Not uncommon to have >20 because some nails come in several pieces
-        print(len(nails), "nail pieces")
+        print(np.count_nonzero(nails), "nail pieces")
         #print("Warning: failed to find the right number of nails: reconstruct may fail")
-    nails=join_meshes(nails, 'nails')
-    bpy.context.view_layer.objects.active = nails #bpy.data.objects[nails]
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.select_mode(type="VERT")
-    bpy.ops.mesh.select_non_manifold()
-    bpy.ops.mesh.remove_doubles()
-    bpy.ops.object.mode_set(mode='OBJECT')
+    mesh_ops.delete_vertices(body, junk[labels])
+    labels = labels[~junk[labels]]
+    nails = mesh_ops.split_off(body, nails[labels], 'nails')
+    mesh_ops.weld_non_manifold(nails)
 
+    other=[body.name]
     if body['Boy']>0.0:
         if 'cm_o_dan00' in bpy.data.objects:
             other.append('cm_o_dan00')
@@ -184,38 +144,26 @@ def disconnect_link(mat, node):
 # and BumpMap.png to be a bump map (R=B=255, variance in G.)
 # But I have at least one test case where _converted is a bump map.
 # This is a rough test to detect the condition and to switch the correct image.
+# tex_pixels is (h, w, 4), bottom row first, as floats or as decoded by texture_analysis.
 def test_inverted_bump_map(tex_pixels):
-    #w = tex.size[0]
-    #h = tex.size[1]
-    #v=tex.pixels[:]
     w = tex_pixels.shape[1]
     h = tex_pixels.shape[0]
-    #v = 
-    for x in range(w//4, w*3//4, max(1,w//16)):
-        for y in range(h//4, h*3//4, max(1,h//16)):
-            pixel = tex_pixels[y,x,:]
-            #index = ( y* w + x ) * 4
-            #pixel = tex_pixel
-            #    v[index], # RED
-            #    v[index + 1], # GREEN
-            #    v[index + 2], # BLUE
-            #]
-            #print("BumpMap center pixel", pixel)
-            if not (pixel[0]>0.999 and pixel[2]>0.999):
-                return False
-    return True
-
-def estimate_bump_gamma(tex, v):
-    if tex.size[0]>=1024 or tex.size[1]>=1024:
-        #v = v.reshape([tex.size[0], tex.size[1], 4])
-        v = v[::max(1,tex.size[0]//512), ::max(1,tex.size[1]//512), :]
-    v = v.reshape([-1, 4])
+    # Center pixels on a 16x16 grid
+    v = texture_analysis.to_floats(tex_pixels[h//4:h*3//4:max(1,h//16), w//4:w*3//4:max(1,w//16), :])
+    return bool(np.all((v[:,:,0]>0.999) & (v[:,:,2]>0.999)))
+
+def estimate_bump_gamma(v, name):
+    w = v.shape[1]
+    h = v.shape[0]
+    if w>=1024 or h>=1024:
+        v = v[::max(1,w//512), ::max(1,h//512), :]
+    v = texture_analysis.to_floats(v).reshape([-1, 4])
     averages = np.median(v, axis=0)
-    #print("Bump texture", tex.filepath, tex.size[0], tex.size[1], "%.5f %.5f %.5f" % (averages[0], averages[1], averages[2]))
+    #print("Bump texture", name, w, h, "%.5f %.5f %.5f" % (averages[0], averages[1], averages[2]))
     bump_gamma_r = 1.0
     bump_gamma_g = 1.6
     if averages[0]==1.0 or averages[1]==1.0 or averages[0]<0.1 or averages[1]<0.1:
-        print("ERROR: ", tex.filepath, "is not a normal map! (Averages %.5f %.5f %.5f)" % (averages[0], averages[1], averages[2]))
+        print("ERROR: ", name, "is not a normal map! (Averages %.5f %.5f %.5f)" % (averages[0], averages[1], averages[2]))
         return 0.0, 0.0
 
     if (averages[0]>0.47 and averages[0]<0.53) and \
@@ -228,6 +176,74 @@ def estimate_bump_gamma(tex, v):
         # averages[0] ^ bump_gamma_r = 0.5
     return bump_gamma_r, bump_gamma_g
 
+# Runs in texture_analysis' worker threads: (inverted, (gamma_r, gamma_g)) of a bump texture
+# file, straight from the file. 'inverted' is only tested for _converted maps (None otherwise),
+# and the gamma is not estimated for those that are inverted (they won't be used).
+def analyze_bump_file(fn):
+    px = texture_analysis.read_png(fn)
+    if px is None:
+        return None
+    px = px[::-1]
+    inverted = test_inverted_bump_map(px) if fn.endswith('_converted.png') else None
+    gamma = None if inverted else estimate_bump_gamma(px, fn)
+    textures.put_bump_analysis(textures.file_hash(fn), inverted, gamma)
+    return inverted, gamma
+
+# Whether a bump analysis result answers everything set_bump needs to know
+def bump_analysis_complete(v, converted):
+    if v is None:
+        return False
+    if converted:
+        return v[0] is not None and (v[0] or v[1] is not None)
+    return v[1] is not None
+
+def tex_key(tex):
+    try:
+        return textures.file_hash(bpy.path.abspath(tex.filepath))
+    except OSError:
+        return None
+
+# Starts analyzing every bump map in the texture directory in the background;
+# _converted maps (the ones normally used) go first
+def prefetch_bump_analysis():
+    index = textures.get_index(path)
+    files = index.kinds.get('converted', []) + [y for k in index.kinds if k.startswith('BumpMap') for y in index.kinds[k]]
+    for y in files:
+        if '_BumpMap' in y:
+            try:
+                fn = textures.canonical_file(path + y)
+                h = textures.file_hash(fn)
+                if not bump_analysis_complete(textures.get_bump_analysis(h), fn.endswith('_converted.png')):
+                    texture_analysis.submit(h, analyze_bump_file, fn)
+            except OSError:
+                pass
+
+# (inverted, (gamma_r, gamma_g)) of bump texture file 'fn' bound as 'tex', from the cache (which
+# is keyed by content, so shared by all presets using the same texture), the background analysis,
+# or else from the image's pixels (the file's, if 'tex' is a deferred texture's placeholder)
+def bump_analysis(fn, tex, converted):
+    key = textures.file_hash(fn)
+    v = textures.get_bump_analysis(key)
+    if bump_analysis_complete(v, converted):
+        return v
+    v = texture_analysis.result(key)
+    if bump_analysis_complete(v, converted):
+        return v
+    if lazy_textures.is_placeholder(tex):
+        v = analyze_bump_file(fn)
+        if bump_analysis_complete(v, converted):
+            return v
+        tex = textures.load_image(fn, csp='Non-Color')
+    # Fast copy of pixel data from bpy.data to numpy array.
+    # (Naively doing 'np.array(tex.pixels)' can take as long as 15 s for an 8k texture)
+    tex_pixels = np.zeros((tex.size[0]*tex.size[1], 4), 'f')
+    tex.pixels.foreach_get(tex_pixels.ravel())
+    tex_pixels = tex_pixels.reshape([tex.size[1], tex.size[0], 4])
+    inverted = test_inverted_bump_map(tex_pixels) if converted else None
+    gamma = None if inverted else estimate_bump_gamma(tex_pixels, tex.filepath)
+    textures.put_bump_analysis(key, inverted, gamma)
+    return inverted, gamma
+
 def set_bump(obj, node, x, y):
     t1=time.time()
     if isinstance(obj, bpy.types.Material):
@@ -236,26 +252,16 @@ def set_bump(obj, node, x, y):
         mat = obj.data.materials[0]
 
     tex = set_tex(obj, node, x, 'BumpMap'+y+'_converted', csp='Non-Color')
-    fix_bump_gamma = False
-    disable = False
-    tex_pixels = None
+    gamma = None
     if tex is not None:
-        # Fast copy of pixel data from bpy.data to numpy array.
-        # (Naively doing 'np.array(tex.pixels)' can take as long as 15 s for an 8k texture)
-        tex_pixels = np.zeros((tex.size[0]*tex.size[1], 4), 'f')
-        tex.pixels.foreach_get(tex_pixels.ravel())
-        tex_pixels = tex_pixels.reshape([tex.size[1], tex.size[0], 4])
-
-    if (tex is None) or test_inverted_bump_map(tex_pixels):
+        inverted, gamma = bump_analysis(find_tex(x, 'BumpMap'+y+'_converted'), tex, True)
+    if (tex is None) or inverted:
         if tex is not None:
-            print("Bump texture", tex.filepath, tex.size[0], tex.size[1])
+            print("Bump texture", find_tex(x, 'BumpMap'+y+'_converted'))
             print("Mislabeled BumpMap textures detected: fixing...")
         tex = set_tex(obj, node, x, 'BumpMap'+y, csp='Non-Color')
         if tex is not None:
-            tex_pixels = np.zeros((tex.size[0]*tex.size[1], 4), 'f')
-            tex.pixels.foreach_get(tex_pixels.ravel())
-            tex_pixels = tex_pixels.reshape([tex.size[1], tex.size[0], 4])
-
+            gamma = bump_analysis(find_tex(x, 'BumpMap'+y), tex, False)[1]
 
     gamma_r = 'Bump gamma ' + y + 'R'
     gamma_g = 'Bump gamma ' + y + 'G'
@@ -267,7 +273,7 @@ def set_bump(obj, node, x, y):
                 n.inputs[scale].default_value = 0.0
         return False
 
-    bump_gamma_r, bump_gamma_g = estimate_bump_gamma(tex, tex_pixels)
+    bump_gamma_r, bump_gamma_g = gamma
     if bump_gamma_r==0.0:
         for n in mat.node_tree.nodes:
             if (scale in n.inputs):
@@ -285,7 +291,9 @@ def set_bump(obj, node, x, y):
     #    print("set_bump", tex.filepath, t2-t1)
     return (tex is not None)
 
-def load_textures(arm, body, hair_color, eye_color, suffix):
+# With 'defer', hair, clothing and accessory textures are loaded when first needed (see lazy_textures)
+def load_textures(arm, body, hair_color, eye_color, suffix, defer=False):
+    global deferring
     hair_mats=[]
     head = bpy.data.objects[body["o_head"]]
     tang = bpy.data.objects[body["o_tang"]]
@@ -297,13 +305,13 @@ def load_textures(arm, body, hair_color, eye_color, suffix):
     nails = bpy.data.objects[body["nails"]]
     body_parts={body, head, tang, tooth, eyeshadow, eyelashes, eyebase_L, eyebase_R, nails}
     print("Body parts:", body_parts)
+    prefetch_bump_analysis()
+    prefetch_skin_tone()
 
-    with bpy.data.libraries.load(os.path.dirname(__file__)+"/assets/prefab_materials_meshexporter.blend") as (data_from, data_to):
-        #print(data_from.materials)
-        data_to.materials = data_from.materials
-        data_to.meshes = data_from.meshes
+    eyes = 'Eyes2' if find_tex('eye', 'ShadeIrisTex') is not None else 'Eyes'
+    mats = prefabs.load(materials=['Eyeshadow', 'Eyelashes', eyes, 'Head', 'Tongue', 'Teeth', 'Torso', 'Nails', 'test_hair', 'Clothing'])['materials']
 
-    eyeshadow_mat=replace_mat(eyeshadow, bpy.data.materials['Eyeshadow'].copy(),  'Eyeshadow_' + suffix)
+    eyeshadow_mat=replace_mat(eyeshadow, mats['Eyeshadow'].copy(),  'Eyeshadow_' + suffix)
     set_tex(eyeshadow, 'Image Texture', 'eyekage', 'MainTex')    
     body["eyeshadow_mat"]=eyeshadow_mat
     """
@@ -313,15 +321,15 @@ def load_textures(arm, body, hair_color, eye_color, suffix):
     set_tex(eyeshadow, 'Image Texture', 'eyekage', 'MainTex')    
     """
 
-    eyelash_mat=replace_mat(eyelashes, bpy.data.materials['Eyelashes'].copy(),  'Eyelashes_' + suffix)
+    eyelash_mat=replace_mat(eyelashes, mats['Eyelashes'].copy(),  'Eyelashes_' + suffix)
     set_tex(eyelashes, 'Image Texture', 'eyelashes', 'MainTex', csp='Non-Color')    
     hair_mats.append(eyelash_mat)
     #if hair_color!=None:
     eyelash_mat.node_tree.nodes['RGB'].outputs[0].default_value = hair_color
     body["eyelash_mat"]=eyelash_mat
 
-    if find_tex('eye', 'ShadeIrisTex') is not None:
-        eye_mat = bpy.data.materials['Eyes2'].copy()
+    if eyes=='Eyes2':
+        eye_mat = mats['Eyes2'].copy()
         replace_mat(eyebase_L, eye_mat, 'Eyes_' + suffix)
         replace_mat(eyebase_R, eye_mat, 'Eyes_' + suffix)
         set_tex(eyebase_L, 'ShadeIrisTex', 'eye', 'ShadeIrisTex', csp='Non-Color')    
@@ -338,7 +346,7 @@ def load_textures(arm, body, hair_color, eye_color, suffix):
         #if eye_color!=None:
         eye_mat.node_tree.nodes['RGB'].outputs[0].default_value = eye_color
     else:
-        eye_mat = bpy.data.materials['Eyes'].copy()
+        eye_mat = mats['Eyes'].copy()
         replace_mat(eyebase_L, eye_mat, 'Eyes_' + suffix)
         replace_mat(eyebase_R, eye_mat, 'Eyes_' + suffix)
         set_tex(eyebase_L, 'Image Texture', 'eye', 'MainTex', csp='Non-Color')    
@@ -352,7 +360,7 @@ def load_textures(arm, body, hair_color, eye_color, suffix):
         eye_mat.node_tree.nodes['RGB'].outputs[0].default_value = eye_color
     body["eye_mat"]=eye_mat
 
-    head_mat=replace_mat(head, bpy.data.materials['Head'].copy(), 'Head_' + suffix)
+    head_mat=replace_mat(head, mats['Head'].copy(), 'Head_' + suffix)
     set_tex(head, 'MainTex', 'skin_head', 'MainTex', alpha='NONE')
     set_tex(head, 'DetailMainTex', 'skin_head', 'DetailMainTex', csp='Non-Color')
     set_tex(head, 'DetailGlossMap', 'skin_head', 'DetailGlossMap', csp='Non-Color')
@@ -376,17 +384,17 @@ def load_textures(arm, body, hair_color, eye_color, suffix):
     head_mat.node_tree.nodes['RGB'].outputs[0].default_value = hair_color
     body["head_mat"] = head_mat
 
-    replace_mat(tang, bpy.data.materials['Tongue'].copy(), 'Tongue_' + suffix)
+    replace_mat(tang, mats['Tongue'].copy(), 'Tongue_' + suffix)
     set_tex(tang, 'Image Texture', 'tang', 'MainTex')
     set_bump(tang, 'Image Texture.001', 'tang', '')
     set_tex(tang, 'Image Texture.002', 'tang', 'DetailGlossMap', csp='Non-Color')
 
 
-    replace_mat(tooth, bpy.data.materials['Teeth'].copy(), 'Teeth_' + suffix)
+    replace_mat(tooth, mats['Teeth'].copy(), 'Teeth_' + suffix)
     set_tex(tooth, 'Image Texture', 'tooth', 'MainTex')
     set_bump(tooth, 'Image Texture.001', 'tooth', '')
 
-    torso_mat = replace_mat(body, bpy.data.materials['Torso'].copy(), 'Torso_' + suffix)
+    torso_mat = replace_mat(body, mats['Torso'].copy(), 'Torso_' + suffix)
     set_tex(body, 'MainTex', 'skin_body', 'MainTex', alpha='NONE')
     set_tex(body, 'DetailGlossMap', 'skin_body', 'DetailGlossMap', csp='Non-Color')
     set_bump(body, 'BumpMap', 'skin_body', '')
@@ -399,22 +407,23 @@ def load_textures(arm, body, hair_color, eye_color, suffix):
         torso_mat.node_tree.nodes['Shader'].inputs['Subsurface/MainTex mix'].default_value=0.2
     body["torso_mat"] = torso_mat
 
-    body["nails_mat"] = replace_mat(nails, bpy.data.materials['Nails'].copy(), 'Nails_' + suffix)
+    body["nails_mat"] = replace_mat(nails, mats['Nails'].copy(), 'Nails_' + suffix)
     
     hair=[]
+    deferring = defer
+    try:
+        load_child_textures(arm, body_parts, hair, hair_mats, hair_color, suffix, mats)
+    finally:
+        deferring = False
+    if len(hair)>1:
+        join_meshes([x.name for x in hair])
+
+def load_child_textures(arm, body_parts, hair, hair_mats, hair_color, suffix, mats):
     for ch in arm.children:
         x=ch.name
         obj = bpy.data.objects[x]
         mesh = obj.data
 
-        bpy.ops.object.select_all(action='DESELECT')
-        bpy.ops.object.mode_set(mode='OBJECT')
-        bpy.context.view_layer.objects.active = obj
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.mesh.select_all(action='SELECT')
-        bpy.ops.mesh.normals_tools(mode='RESET')
-        bpy.ops.object.mode_set(mode='OBJECT')
-
         if (bpy.data.objects[x].type!='MESH' 
                 or ('Prefab ' in x) \
                 or ('Material ' in x)):
@@ -436,7 +445,7 @@ def load_textures(arm, body, hair_color, eye_color, suffix):
             n = m.name
             if '.' in n:
                 n = n.split('.')[0]   
-            mat=replace_mat(obj, bpy.data.materials['test_hair'].copy(), 'hair_' + suffix)
+            mat=replace_mat(obj, mats['test_hair'].copy(), 'hair_' + suffix)
             if set_tex(obj, 'Image Texture', n, 'MainTex', csp='Non-Color') is None:
                 disconnect_link(mat, 'Alpha')
             set_bump(obj, 'Image Texture.001', n, '')
@@ -456,7 +465,7 @@ def load_textures(arm, body, hair_color, eye_color, suffix):
             n = m.name
             if '.' in n:
                 n = n.split('.')[0]            
-            mat=replace_mat(obj, bpy.data.materials['Clothing'].copy(), 'clothing_' + suffix)
+            mat=replace_mat(obj, mats['Clothing'].copy(), 'clothing_' + suffix)
             if set_tex(obj, 'Main Texture', n, 'MainTex') is None:
                 disconnect_link(mat, 'Alpha')
                 disconnect_link(mat, 'Combined Color')
@@ -473,60 +482,32 @@ def load_textures(arm, body, hair_color, eye_color, suffix):
                 # Item does not support clothes damage
                 mat.node_tree.nodes['Value'].outputs[0].default_value=-0.01
         arm['hair_mats']=hair_mats
-    if len(hair)>1:
-        join_meshes([x.name for x in hair])
 
 def fixup_head(body):
-    bpy.ops.object.select_all(action='DESELECT')
-    bpy.context.view_layer.objects.active = bpy.data.objects[body["o_head"]]
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.select_mode(type="VERT")
-    bpy.ops.mesh.select_non_manifold()
-    bpy.ops.mesh.remove_doubles()
+    mesh_ops.object_mode()
+    # Later steps select vertices through the mesh and expect vertex select mode
+    bpy.context.scene.tool_settings.mesh_select_mode = (True, False, False)
+    mesh_ops.weld_non_manifold(bpy.data.objects[body["o_head"]])
 
 def fixup_torso(body):
-    bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.ops.object.select_all(action='DESELECT')
     join_meshes([body.name, body["nails"]], body.name)
-    bpy.ops.object.select_all(action='DESELECT')
-    bpy.context.view_layer.objects.active = body
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.select_mode(type="VERT")
-    bpy.ops.mesh.select_non_manifold()
-    bpy.ops.mesh.remove_doubles(use_unselected=True)
+    mesh_ops.weld_non_manifold(body, use_unselected=True)
 
 def stitch_head_to_torso(body):
-    bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.ops.object.select_all(action='DESELECT')
     meshes=[body.name,body['o_head']]
     join_meshes(meshes, body.name)
-    bpy.ops.object.select_all(action='DESELECT')
-    bpy.context.view_layer.objects.active = body
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.select_all(action='DESELECT')
-    bpy.ops.mesh.select_non_manifold()
-    bpy.ops.mesh.remove_doubles(threshold=0.015, use_unselected=True)
-    bpy.ops.mesh.select_all(action='SELECT')
-    bpy.ops.mesh.normals_tools(mode='RESET')
-    
-    bpy.ops.mesh.select_all(action='DESELECT')
-    
-    bpy.ops.object.mode_set(mode='OBJECT')
+    mesh_ops.weld_non_manifold(body, 0.015, use_unselected=True)
+    normalize_meshes([body])
+
     sh = bpy.data.objects[body['o_eyeshadow']]
     sh.vertex_groups.clear()
     sh.vertex_groups.new(name='cf_J_eye_rs_L')
     sh.vertex_groups.new(name='cf_J_eye_rs_R')
-    for v in range(len(sh.data.vertices)):
-        side = 1 if sh.data.vertices[v].co[0]<0 else 0
-        sh.vertex_groups[side].add([v], 1.0, 'ADD')
-    
-    bpy.ops.object.mode_set(mode='EDIT')
-    bpy.ops.mesh.select_all(action='SELECT')
-    bpy.ops.mesh.mark_sharp(clear=True)
+    left = mesh_ops.coordinates(sh.data)[:,0]<0
+    sh.vertex_groups[1].add(np.flatnonzero(left).tolist(), 1.0, 'ADD')
+    sh.vertex_groups[0].add(np.flatnonzero(~left).tolist(), 1.0, 'ADD')
 
-    bpy.ops.mesh.select_all(action='DESELECT')
     meshes=[body.name,body['o_eyebase_L'],body['o_eyebase_R'],body['o_eyelashes'],body['o_eyeshadow']]
-    bpy.ops.object.mode_set(mode='OBJECT')
     body = join_meshes(meshes, body.name)
 
     #bpy.ops.mesh.select_all(action='SELECT')
@@ -542,6 +523,21 @@ def stitch_head_to_torso(body):
         pass
 
     
+# Mesh normalization pass: resets custom normals to the defaults and clears sharp edges on all
+# the meshes in one go through the data API. Same result as normals_tools(mode='RESET') and
+# mark_sharp(clear=True) on everything, without an edit mode round trip per mesh.
+def normalize_meshes(objs):
+    t1=time.time()
+    meshes=set(x.data for x in objs if x.type=='MESH')
+    for mesh in meshes:
+        if len(mesh.edges)>0:
+            mesh.edges.foreach_set('use_edge_sharp', np.zeros([len(mesh.edges)], dtype=bool))
+        if mesh.has_custom_normals:
+            # Zero custom normals mean 'use the default normal'
+            mesh.normals_split_custom_set(np.zeros([len(mesh.loops), 3], dtype=np.float32))
+        mesh.update()
+    print("Normalized %d meshes in %.3f s" % (len(meshes), time.time()-t1))
+
 def import_bodyparts(fbx):
     obj_list = bpy.data.objects.keys()
     arm_list = [x for x in obj_list if bpy.data.objects[x].type=='ARMATURE']
@@ -678,14 +674,7 @@ def import_bodyparts(fbx):
             if y.name==x or y.name.startswith(x+'.'):
                 body[x]=y.name #bpy.data.meshes[y]
            
-    for y in arm.children:
-        if y.type=='MESH':
-            bpy.ops.object.select_all(action='DESELECT')
-            bpy.context.view_layer.objects.active = y
-            bpy.ops.object.mode_set(mode='EDIT')
-            bpy.ops.mesh.select_all(action='SELECT')
-            bpy.ops.mesh.mark_sharp(clear=True)
-            bpy.ops.object.mode_set(mode='OBJECT')
+    normalize_meshes(arm.children)
 
     bpy.context.view_layer.objects.active = arm
     bpy.ops.object.mode_set(mode='OBJECT')
@@ -730,7 +719,14 @@ def save_with_backup(s, fn):
 def f4(x):
     return ("%.4f" % x).rstrip('0').rstrip('.')
 
-def customization_string(arm, x):
+# 'classes' is passed down to the children: per bone lists of whether the offset, rotation and
+# scale have shape (s, S) or FK components, and the {name: row} index of the lists
+def customization_string(arm, x, classes=None):
+    if classes is None:
+        table, index = armature.compile_bone_classes(arm)
+        classes = (armature.any_component(table['shape']).tolist(), armature.any_component(table['fk']).tolist(), index)
+    shape, fk, index = classes
+    k = index[x]
     s = ""
     b = arm.pose.bones[x]
     local = arm.pose.bones[x].matrix_basis
@@ -754,9 +750,7 @@ def customization_string(arm, x):
             null = True
             change = ""
             change2 = ""
-            bc = armature.bone_class(x, 'offset')
-            #print(x, bc)
-            if 's' in bc:
+            if shape[k][0]:
                 if local[0]!=Vector([0,0,0]):
                     null = False
                 if reference[0]!=Vector([0,0,0]):
@@ -768,11 +762,10 @@ def customization_string(arm, x):
                     change2 = f4(local[0][0]*100) + " " + f4(local[0][1]*100) + " " + f4(local[0][2]*100)
                     #s+=x+' offset %.4f %.4f %.4f\n' % (local[0][0]*100, local[0][1]*100, local[0][2]*100)
             else:
-                if local[0]!=reference[0] and not ('f' in bc):
+                if local[0]!=reference[0] and not fk[k][0]:
                     print("Not saving offset change on", x)
 
-            bc = armature.bone_class(x, 'rotation')
-            if bc=='s': #not (bc in ['c','x','f', '?']):
+            if shape[k][1]:
                 if local[1]!=Quaternion([1,0,0,0]):
                     null = False
                 if reference[1]!=Quaternion([1,0,0,0]):
@@ -785,10 +778,9 @@ def customization_string(arm, x):
                         change2+=" "
                     change2 += f4(euler[0]*180./3.1415926) + " " + f4(euler[1]*180./3.1415926) + " " + f4(euler[2]*180./3.1415926)
             else:
-                if local[1]!=reference[1] and bc!='f':
+                if local[1]!=reference[1] and not fk[k][1]:
                     print("Not saving rotation change on", x)
-            bc = armature.bone_class(x, 'scale')
-            if 's' in bc:
+            if shape[k][2]:
                 if local[2]!=Vector([1,1,1]):
                     null = False
                 if reference[2]!=Vector([1,1,1]):
@@ -799,7 +791,7 @@ def customization_string(arm, x):
                         change2+=" "
                     change2 += f4(local[2][0]) + " " + f4(local[2][1]) + " " + f4(local[2][2])
             else:
-                if local[2]!=reference[2] and not ('f' in bc):
+                if local[2]!=reference[2] and not fk[k][2]:
                     print("Not saving scale change on", x)
             if null and len(change)>0:
                 s += x + " null\n"
@@ -808,7 +800,7 @@ def customization_string(arm, x):
                     #s += x+' scale %.4f %.4f %.4f\n' % (local[2][0], local[2][1], local[2][2])
     b = arm.data.bones[x]
     for y in b.children.keys():
-        s += customization_string(arm, y)
+        s += customization_string(arm, y, classes)
     return s
 
 #def save_customization(arm, custfn):
@@ -824,24 +816,25 @@ def reset_customization(arm):
     bpy.ops.object.mode_set(mode='POSE')
     idx_map={'offset':0,'rotation':1,'scale':2}
     null_pose=(Vector(), Quaternion(), Vector([1,1,1]))
-    ch=('offset','rotation','scale')
-    for x in arm.pose.bones.keys():
-        pose = list(arm.pose.bones[x].matrix_basis.decompose())
-        if x in arm["deformed_uncustomized_rig"]:
-            known=True
-            op = Matrix(arm["deformed_uncustomized_rig"][x]).decompose()
-        else:
-            op = null_pose
-        for y in range(3):
-            c=armature.bone_class(x, ch[y])
-            for n in range(len(op[y])):
-                if c[n if y!=1 else 0] in ('s','i','u'):
-                    #ampl = sum([sum(delta[x]) for x in range(4)])
-                    if abs(pose[y][n]-op[y][n])>0.0001:
-                        print(x, y, n, abs(pose[y][n]-op[y][n]), pose[y][n], op[y][n])
-                    pose[y][n]=op[y][n]
-        arm.pose.bones[x].matrix_basis=armature.recompose(pose)
-        deformed_rig[x]=arm.pose.bones[x].matrix_basis.copy()
+    # Shape components (s, S, i, u) are reset, per bone
+    soft = armature.shape_components(armature.bone_class_table(arm)).tolist()
+    for k, b in enumerate(arm.pose.bones):
+        x = b.name
+        if any(soft[k]):
+            pose = list(b.matrix_basis.decompose())
+            if x in arm["deformed_uncustomized_rig"]:
+                op = Matrix(arm["deformed_uncustomized_rig"][x]).decompose()
+            else:
+                op = null_pose
+            for y in range(3):
+                for n in range(len(op[y])):
+                    if soft[k][armature.component_index(y, n)]:
+                        #ampl = sum([sum(delta[x]) for x in range(4)])
+                        if abs(pose[y][n]-op[y][n])>0.0001:
+                            print(x, y, n, abs(pose[y][n]-op[y][n]), pose[y][n], op[y][n])
+                        pose[y][n]=op[y][n]
+            b.matrix_basis=armature.recompose(pose)
+        deformed_rig[x]=b.matrix_basis.copy()
 
 def load_customization_from_string(arm, s):
     print("load_customization_from_string", s)
@@ -903,9 +896,12 @@ def fix_neck_loop(body):
             if len(x.verts[1].link_faces)<=4:
                 v.add(x.verts[1].index)
 
-    vg = body.vertex_groups['cf_J_Head_s'].index
-    boundary = [(x in v) and (add_extras.get_weight(body, x, vg)>0.99) for x in range(len(body.data.vertices))]
-    if len(boundary)>0:
+    bmd.free()
+
+    head = weights.get_weight_table(body).members('cf_J_Head_s', min_wt=0.99)
+    boundary = np.zeros([len(body.data.vertices)], dtype=bool)
+    boundary[head[np.isin(head, np.fromiter(v, dtype=np.int64, count=len(v)))]] = True
+    if boundary.any():
         bpy.ops.object.mode_set(mode='EDIT')
         bpy.ops.mesh.select_all(action='DESELECT')
         bpy.ops.object.mode_set(mode='OBJECT')
@@ -918,22 +914,103 @@ def fix_neck_loop(body):
 
 last_import_status='...'
 
+# Runtime (not saved with the .blend) skin tone properties of all objects
+def add_skin_tone_properties(mean_skin_tone):
+    bpy.types.Object.skin_tone_shift = bpy.props.FloatVectorProperty(
+        name="Skin Tone Shift",
+        #type='FLOAT_VECTOR',
+        default=(0.0, 0.0, 0.0),
+        min=-100.0,
+        max=100.0,
+        update=lambda self, context: None
+    )
+    bpy.types.Object.mean_skin_tone = bpy.props.FloatVectorProperty(
+        name="Mean Skin Tone",
+        default=mean_skin_tone,
+        update=lambda self, context: None 
+    )
+
+# Skin tone sample: median over a patch of the torso MainTex around UV (0.127, 0.766), as stored
+# in the file (sRGB). Read from the texture's 1/8 proxy if there is one, else from the file, decoding
+# only the rows and columns up to the patch; the image itself is only used if its pixels are
+# already loaded and the file can't be decoded.
+skin_tone_uv = (0.127, 0.766)
+skin_tone_patch = 0.015
+# Used (and not cached) if the texture can't be sampled at all
+default_skin_tone = (0.9, 0.75, 0.65)
+
+def skin_tone_from_file(fn):
+    header = texture_analysis.png_header(fn)
+    if header is None:
+        return None
+    w, h = header[:2]
+    x = int(w*skin_tone_uv[0])
+    y = int(h*skin_tone_uv[1])
+    r = max(1, int(w*skin_tone_patch))
+    # patch rows y-r..y+r counted from the bottom; PNG rows are stored top first
+    lo = max(0, y-r)
+    hi = min(h, y+r+1)
+    px = texture_analysis.read_png_window(fn, h-lo, x+r+1)
+    if px is None:
+        return None
+    patch = texture_analysis.to_floats(px[h-hi:h-lo, max(0,x-r):x+r+1, :3])
+    return tuple(float(c) for c in np.median(patch.reshape([-1, 3]), axis=0))
+
+def skin_tone_file(key, fn):
+    proxy = proxies.proxy_file(key, 8)
+    return proxy if os.path.exists(proxy) else fn
+
+# Starts sampling the skin tone of the torso texture in the background, unless it's cached
+def prefetch_skin_tone():
+    fn = find_tex('skin_body', 'MainTex')
+    if fn is None:
+        return
+    try:
+        h = textures.file_hash(fn)
+    except OSError:
+        return
+    if textures.get_skin_tone(h) is None:
+        texture_analysis.submit(("skin tone", h), skin_tone_from_file, skin_tone_file(h, fn))
+
+def sample_skin_tone(tex, key):
+    rgb = None
+    if key is not None:
+        rgb = texture_analysis.result(("skin tone", key))
+        if rgb is None:
+            rgb = skin_tone_from_file(skin_tone_file(key, bpy.path.abspath(tex.filepath)))
+    if rgb is not None or not tex.has_data:
+        return rgb
+    # Can't decode the file, but its pixels are loaded: scale down a copy
+    tmp = tex.copy()
+    try:
+        tmp.colorspace_settings.name = "Non-Color"
+        tmp.scale(256, 256)
+        px = np.zeros((256*256, 4), 'f')
+        tmp.pixels.foreach_get(px.ravel())
+        px = px.reshape([256, 256, 4])
+    finally:
+        bpy.data.images.remove(tmp)
+    x = int(256*skin_tone_uv[0])
+    y = int(256*skin_tone_uv[1])
+    r = max(1, int(256*skin_tone_patch))
+    patch = px[max(0,y-r):y+r+1, max(0,x-r):x+r+1, :3]
+    return tuple(float(c) for c in np.median(patch.reshape([-1, 3]), axis=0))
+
 def get_mean_skin_tone(body):
     mat = body["torso_mat"]
     tex = mat.node_tree.nodes["MainTex"].image
-
-    w = tex.size[0]
-    h = tex.size[1]
-    index = ( int(h*0.766)* w + int(w*0.127) ) * 4
-
-    # See Blender issue #117830
-    tex.colorspace_settings.name="Non-Color"
-    pixel = Color((
-        tex.pixels[index], 
-        tex.pixels[index + 1], 
-        tex.pixels[index + 2],
-    ))
-    tex.colorspace_settings.name="sRGB"
+    key = tex_key(tex)
+    rgb = textures.get_skin_tone(key) if key is not None else None
+    if rgb is None:
+        t1 = time.time()
+        rgb = sample_skin_tone(tex, key)
+        if rgb is None:
+            print("Failed to sample the skin tone of", tex.name)
+            rgb = default_skin_tone
+        elif key is not None:
+            textures.put_skin_tone(key, rgb)
+        print("Skin tone sampled in %.3f s" % (time.time()-t1))
+    pixel = Color(rgb)
     #print("Skin tone (sRGB):", pixel)
     pixel = pixel.from_srgb_to_scene_linear()
     #print("Skin tone (scene linear):", pixel)
@@ -941,6 +1018,13 @@ def get_mean_skin_tone(body):
     #print("Skin tone (gamma corrected):", pixel)
     return pixel
 
+# Clothing and accessories with deferred textures stay hidden (and untextured) until shown
+def hide_deferred_clothing(arm):
+    hair_mats = set(x.name for x in arm.get('hair_mats', []) if x is not None)
+    for x in arm.children:
+        if x.type=='MESH' and any(m.name not in hair_mats for m in lazy_textures.deferred_materials(x)):
+            x.hide_viewport = True
+
 def import_body(input, refactor, 
         do_extend_safe, do_extend_full, 
         add_injector,
@@ -948,7 +1032,10 @@ def import_body(input, refactor,
         replace_teeth, subdivide, 
         c_eye, c_hair,
         name, customization,
-        reweight_clothing=False
+        reweight_clothing=False,
+        use_cache=True,
+        texture_proxy=1,
+        defer_textures=False
         ):
     #global path, fbx, suffix, dumpfilename, last_import_status, customization
     global path, last_import_status
@@ -1001,8 +1088,38 @@ def import_body(input, refactor,
     if eye_color!=None:
         if len(eye_color)==3:
             eye_color=(eye_color[0], eye_color[1], eye_color[2], 1.0)
-        
+
+    cache_key = None
+    if use_cache:
+        options = {
+            "refactor": refactor, "extend_safe": do_extend_safe, "extend_full": do_extend_full,
+            "add_injector": add_injector, "add_exhaust": add_exhaust, "replace_teeth": replace_teeth,
+            "subdivide": subdivide, "reweight_clothing": reweight_clothing,
+            "eye_color": None if c_eye is None else [float(x) for x in c_eye],
+            "hair_color": None if c_hair is None else [float(x) for x in c_hair],
+            "name": name, "customization": customization, "defer_textures": defer_textures,
+        }
+        try:
+            cache_key = import_cache.cache_key(fbx, dumpfilename, [custfile, custfile2], options, path)
+            arm = import_cache.load(cache_key)
+        except Exception as e:
+            print("Import cache lookup failed:", e)
+            arm = None
+        if arm is not None:
+            add_skin_tone_properties(arm["Skin tone"])
+            arm.name = name
+            bpy.context.view_layer.objects.active = arm
+            bpy.ops.object.mode_set(mode='POSE')
+            if texture_proxy>1:
+                proxies.set_resolution(arm, texture_proxy)
+            last_import_status='Import successful (cached)'
+            return arm
+
+    weights.begin_caching()
     try:
+        weights.clear_weight_tables()
+        textures.clear_indexes()
+        texture_analysis.cancel()
         t1=time.time()
         success, arm, body = import_bodyparts(fbx)
         t2=time.time()
@@ -1017,7 +1134,10 @@ def import_body(input, refactor,
         t2=time.time()
         print("rebuild_torso done in %.3f s" % (t2-t1))
         t1=t2
-        load_textures(arm, body, hair_color, eye_color, suffix)
+        load_textures(arm, body, hair_color, eye_color, suffix, defer_textures)
+        n, saved = textures.memory_report()
+        if n>0:
+            print("Texture sharing: %d texture files reuse existing images, %.1f MB saved" % (n, saved / (1<<20)))
         t2=time.time()
         print("load_textures done in %.3f s" % (t2-t1))
         t1=t2
@@ -1049,7 +1169,7 @@ def import_body(input, refactor,
 
         tooth = bpy.data.objects[body["o_tooth"]]
         if refactor and replace_teeth:
-            tooth.data=bpy.data.meshes["Prefab Tooth v2"].copy()
+            tooth.data=prefabs.copy_mesh("Prefab Tooth v2")
             tooth.data.shape_keys.key_blocks["20"].value=0.
             tooth.data.shape_keys.key_blocks["Smaller"].value=0.
             tooth.location=Vector([0, 15.95, -0.08])
@@ -1129,6 +1249,7 @@ def import_body(input, refactor,
         bpy.ops.paint.weight_paint_toggle()
         bpy.ops.object.vertex_group_clean(group_select_mode='ALL', limit=0.005)
         bpy.ops.paint.weight_paint_toggle()
+        weights.clear_weight_tables()
 
         t2=time.time()
         print("Tweaks done in %.3f s" % (t2-t1))
@@ -1180,14 +1301,6 @@ def import_body(input, refactor,
         body["Alternate skin"] = True
         body["patchy skin"] = [1.0, 1.0, 1.0]
 
-        bpy.types.Object.skin_tone_shift = bpy.props.FloatVectorProperty(
-            name="Skin Tone Shift",
-            #type='FLOAT_VECTOR',
-            default=(0.0, 0.0, 0.0),
-            min=-100.0,
-            max=100.0,
-            update=lambda self, context: None
-        )
         #body.data["skin tone shift"] = [0.0, 0.0, 0.0]
         body.id_properties_ensure()
         body.id_properties_ui("patchy skin").update(min=0, max=10)
@@ -1197,11 +1310,7 @@ def import_body(input, refactor,
         #body.data.id_properties_ensure()
         #body.data.id_properties_ui("skin tone shift").update(min=-100, max=100)
 
-        bpy.types.Object.mean_skin_tone = bpy.props.FloatVectorProperty(
-            name="Mean Skin Tone",
-            default=get_mean_skin_tone(body),
-            update=lambda self, context: None 
-        )
+        add_skin_tone_properties(get_mean_skin_tone(body))
 
         bpy.context.view_layer.objects.active = body
         bpy.ops.object.mode_set(mode='EDIT')
@@ -1245,6 +1354,7 @@ def import_body(input, refactor,
         bpy.ops.paint.weight_paint_toggle()
         bpy.ops.object.vertex_group_clean(group_select_mode='ALL', limit=0.005)
         bpy.ops.paint.weight_paint_toggle()
+        weights.clear_weight_tables()
         bpy.context.view_layer.objects.active = arm
         bpy.ops.object.mode_set(mode='POSE')
 
@@ -1254,18 +1364,28 @@ def import_body(input, refactor,
         arm["Skin tone"] = body.mean_skin_tone
         arm["Name"] = name
         arm.name = name
+        if defer_textures:
+            hide_deferred_clothing(arm)
 
+        textures.flush()
+        texture_analysis.cancel()
         last_import_status='Import successful'
 
         t2=time.time()
         print("Wrap-up done in %.3f s" % (t2-t1))
         t1=t2
+        if cache_key is not None:
+            import_cache.save(cache_key, arm)
+        if texture_proxy>1:
+            proxies.set_resolution(arm, texture_proxy)
     except ImportException as e:
         print(e.text)
         last_import_status=e.text
     except:
         last_import_status='Import failed, see system console for details'
         raise
+    finally:
+        weights.end_caching()
     return arm
 
 """
@@ -0,0 +1,167 @@
+import bpy
+import time
+from bpy.app.handlers import persistent
+from . import textures, proxies
+
+#
+# Deferred texture loading.
+#
+# When importing with deferred textures, the texture nodes of clothing and accessories are bound
+# to a shared 1x1 placeholder image, and the files they should show are recorded on their
+# material, in its "hs2 deferred" property (node name -> {file, alpha, csp}).
+# The files are loaded when an object using the material becomes visible in the viewport,
+# or when a render starts (which needs Lock Interface, see proxies.require_lock_interface).
+#
+# Materials with deferred textures (names); rebuilt by scan()
+_pending = set()
+# Objects using them (names), so the viewport check doesn't walk every object; None when it
+# needs to be rebuilt (materials get assigned after defer())
+_objects = None
+
+def placeholder():
+    for img in bpy.data.images:
+        if img.get("hs2 placeholder"):
+            return img
+    img = bpy.data.images.new("hs2 placeholder", 1, 1)
+    img.generated_color = (0.5, 0.5, 0.5, 1.0)
+    img["hs2 placeholder"] = True
+    return img
+
+def is_placeholder(img):
+    return img is not None and bool(img.get("hs2 placeholder"))
+
+# Binds the node to the placeholder and records 'fn' to be loaded into it later
+def defer(mat, node, fn, alpha=None, csp=None):
+    if "hs2 deferred" not in mat:
+        mat["hs2 deferred"] = {}
+    global _objects
+    mat["hs2 deferred"][node] = {"file": fn, "alpha": alpha or "", "csp": csp or ""}
+    img = placeholder()
+    mat.node_tree.nodes[node].image = img
+    if len(_pending)==0:
+        proxies.require_lock_interface()
+    _pending.add(mat.name)
+    _objects = None
+    return img
+
+# Loads the deferred textures of a material
+def load_material(mat):
+    for node, x in mat.get("hs2 deferred", {}).items():
+        n = mat.node_tree.nodes.get(node)
+        if n is None or not is_placeholder(n.image):
+            continue
+        img = textures.load_image(x["file"], x["alpha"] or None, x["csp"] or None)
+        if img is None:
+            print('Warning: failed to load texture ', x["file"])
+            continue
+        n.image = img
+    if "hs2 deferred" in mat:
+        del mat["hs2 deferred"]
+    _pending.discard(mat.name)
+
+# Finds materials with deferred textures (after loading a file or appending characters)
+# and merges duplicate placeholders into one
+def scan():
+    global _objects
+    _pending.clear()
+    _objects = None
+    keep = None
+    for img in list(bpy.data.images):
+        if not is_placeholder(img):
+            continue
+        if keep is None:
+            keep = img
+        else:
+            img.user_remap(keep)
+            bpy.data.images.remove(img)
+    for mat in bpy.data.materials:
+        if "hs2 deferred" in mat:
+            _pending.add(mat.name)
+    if len(_pending)>0:
+        proxies.require_lock_interface()
+
+# Materials of the object that have deferred textures
+def deferred_materials(obj):
+    if obj.type!='MESH':
+        return []
+    return [slot.material for slot in obj.material_slots if slot.material is not None and "hs2 deferred" in slot.material]
+
+# Names of the objects with deferred textures
+def pending_objects():
+    global _objects
+    if len(_pending)==0:
+        _objects = set()
+    elif _objects is None or any(x not in bpy.data.objects for x in _objects):
+        # built once per import or scan, and again if objects have been renamed or deleted
+        _objects = set(x.name for x in bpy.data.objects if len(deferred_materials(x))>0)
+    return _objects
+
+# Loads the deferred textures of all objects passing 'test'; returns the objects
+def load_objects(objects, test):
+    global _objects
+    t1 = time.time()
+    loaded = []
+    for obj in objects:
+        mats = deferred_materials(obj)
+        if len(mats)>0 and test(obj):
+            for mat in mats:
+                load_material(mat)
+            loaded.append(obj)
+    if len(loaded)>0:
+        if _objects is not None:
+            # including objects sharing the materials just loaded
+            _objects = set(x for x in _objects if x in bpy.data.objects and len(deferred_materials(bpy.data.objects[x]))>0)
+        print("Deferred textures of %d objects loaded in %.3f s" % (len(loaded), time.time()-t1))
+    return loaded
+
+def _load_visible():
+    layer = bpy.context.view_layer
+    objects = [layer.objects.get(x) for x in pending_objects()]
+    loaded = load_objects([x for x in objects if x is not None], lambda x: x.visible_get())
+    # Characters shown at a lower texture resolution get the proxies of the new images
+    for arm in set(x.parent for x in loaded if x.parent is not None):
+        factor = arm.get("texture resolution", 1)
+        if factor!=1:
+            proxies.set_resolution(arm, factor)
+    return None
+
+@persistent
+def depsgraph_update(scene, depsgraph):
+    if len(_pending)==0:
+        return
+    # Only objects (shown, hidden, added, or their material changed) and collections
+    # (shown or hidden) can make a deferred texture visible
+    found = False
+    for u in depsgraph.updates:
+        if isinstance(u.id, bpy.types.Object):
+            found = True
+            obj = u.id.original
+            if _objects is not None and obj.name not in _objects and len(deferred_materials(obj))>0:
+                _objects.add(obj.name)
+        elif isinstance(u.id, bpy.types.Collection):
+            found = True
+    if found and not bpy.app.timers.is_registered(_load_visible):
+        # Not from within the handler: loading images changes the depsgraph
+        bpy.app.timers.register(_load_visible, first_interval=0.0)
+
+@persistent
+def render_init(scene):
+    if len(_pending)>0 and proxies.can_switch_images(scene):
+        load_objects(scene.objects, lambda x: not x.hide_render)
+
+@persistent
+def load_post(dummy):
+    scan()
+
+def register_handlers():
+    unregister_handlers()
+    bpy.app.handlers.depsgraph_update_post.append(depsgraph_update)
+    # Ahead of proxies' handler, so the full resolution images are there to switch to
+    bpy.app.handlers.render_init.insert(0, render_init)
+    bpy.app.handlers.load_post.append(load_post)
+
+def unregister_handlers():
+    for handlers in (bpy.app.handlers.depsgraph_update_post, bpy.app.handlers.render_init, bpy.app.handlers.load_post):
+        for h in list(handlers):
+            if getattr(h, "__module__", None)==__name__:
+                handlers.remove(h)
@@ -0,0 +1,100 @@
+import bpy
+import bmesh
+import numpy as np
+
+#
+# Data-level mesh restructuring: the loose part / delete / merge by distance steps of the import,
+# done on mesh data directly rather than through edit mode operators, so they don't depend on
+# the active object, the selection or the current mode (other than not being in edit mode).
+#
+
+def object_mode():
+    if bpy.context.mode!='OBJECT':
+        bpy.ops.object.mode_set(mode='OBJECT')
+
+# (V,3) float64 array of vertex coordinates
+def coordinates(mesh):
+    co = np.zeros([len(mesh.vertices)*3], dtype=np.float64)
+    mesh.vertices.foreach_get('co', co)
+    return co.reshape([-1, 3])
+
+# Loose parts of the mesh, as (labels, n): labels[i] is the part (0..n-1) vertex i belongs to.
+# Connected components by hooking roots together and pointer jumping, O(log V) rounds.
+def loose_parts(mesh):
+    nv = len(mesh.vertices)
+    e = np.zeros([len(mesh.edges)*2], dtype=np.int64)
+    mesh.edges.foreach_get('vertices', e)
+    a = e[0::2]
+    b = e[1::2]
+    labels = np.arange(nv)
+    while True:
+        la = labels[a]
+        lb = labels[b]
+        if np.array_equal(la, lb):
+            break
+        np.minimum.at(labels, la, lb)
+        np.minimum.at(labels, lb, la)
+        while True:
+            v = labels[labels]
+            if np.array_equal(v, labels):
+                break
+            labels = v
+    roots, labels = np.unique(labels, return_inverse=True)
+    return labels, len(roots)
+
+# Per part bounding boxes: (lo, hi), each (n,3)
+def part_bounds(co, labels, n):
+    lo = np.full([n, 3], np.inf)
+    hi = np.full([n, 3], -np.inf)
+    np.minimum.at(lo, labels, co)
+    np.maximum.at(hi, labels, co)
+    return lo, hi
+
+def _edit(obj, func):
+    bm = bmesh.new()
+    bm.from_mesh(obj.data)
+    bm.verts.ensure_lookup_table()
+    try:
+        func(bm)
+        bm.to_mesh(obj.data)
+    finally:
+        bm.free()
+    obj.data.update()
+
+def delete_vertices(obj, mask):
+    idx = np.flatnonzero(mask)
+    if len(idx)==0:
+        return
+    _edit(obj, lambda bm: bmesh.ops.delete(bm, geom=[bm.verts[i] for i in idx], context='VERTS'))
+
+# Moves the vertices in 'mask' (and everything using them) to a new object, like
+# separating them in edit mode: the new object is a copy of 'obj' in the same collections
+def split_off(obj, mask, name):
+    new = obj.copy()
+    new.data = obj.data.copy()
+    new.name = name
+    for c in obj.users_collection:
+        c.objects.link(new)
+    delete_vertices(new, ~mask)
+    delete_vertices(obj, mask)
+    return new
+
+# What select_non_manifold() selects (wire, boundary, multi-face and non-contiguous edges,
+# and non-manifold vertices), in index order
+def non_manifold_verts(bm):
+    v = set(x for x in bm.verts if not x.is_manifold)
+    for e in bm.edges:
+        if e.is_wire or e.is_boundary or len(e.link_faces)>2 or (e.is_manifold and not e.is_contiguous):
+            v.update(e.verts)
+    return sorted(v, key=lambda x: x.index)
+
+# select_non_manifold() followed by remove_doubles(threshold=dist, use_unselected=...):
+# the same bmesh operators the edit mode operator runs
+def weld_non_manifold(obj, dist=0.0001, use_unselected=False):
+    def weld(bm):
+        verts = non_manifold_verts(bm)
+        if use_unselected:
+            bmesh.ops.automerge(bm, verts=verts, dist=dist)
+        else:
+            bmesh.ops.remove_doubles(bm, verts=verts, dist=dist)
+    _edit(obj, weld)
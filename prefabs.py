@@ -0,0 +1,84 @@
+import bpy
+import os
+import time
+
+#
+# Datablocks of the prefab library, assets/prefab_materials_meshexporter.blend.
+#
+# load() returns the named datablocks and only reads the ones the session doesn't have yet from
+# the library (along with whatever they use). Appended datablocks are recognized by their
+# "hs2 prefab" property, which holds their name in the library (they may get renamed on a name
+# clash); linked ones by their library.
+#
+# Linking is meant for templates that are only read or copied (rig text blocks, meshes that get
+# copied): those end up with no users, so they aren't saved, and saved files don't refer to the
+# library. Anything a character keeps using is appended.
+#
+library_path = os.path.join(os.path.dirname(__file__), "assets", "prefab_materials_meshexporter.blend")
+
+# (type, library name, link) -> name in bpy.data, for this session
+_names = {}
+
+def _library():
+    for lib in bpy.data.libraries:
+        if os.path.normpath(bpy.path.abspath(lib.filepath))==os.path.normpath(library_path):
+            return lib
+    return None
+
+def _find(kind, name, link):
+    coll = getattr(bpy.data, kind)
+    if link:
+        lib = _library()
+        return None if lib is None else coll.get((name, lib.filepath))
+    x = coll.get(_names.get((kind, name, link), name))
+    if x is not None and x.library is None and x.get("hs2 prefab")==name:
+        return x
+    return None
+
+# {type: {name: datablock}} of the datablocks named per type, e.g.
+#   load(materials=['Torso', 'Head'], objects=['Prefab Dongle'])
+# Names missing from the library are left out.
+def load(link=False, **kinds):
+    found = {}
+    missing = {}
+    for kind, names in kinds.items():
+        found[kind] = {}
+        for name in names:
+            x = _find(kind, name, link)
+            if x is None:
+                missing.setdefault(kind, []).append(name)
+            else:
+                found[kind][name] = x
+    if len(missing)==0:
+        return found
+    t1 = time.time()
+    requested = {}
+    with bpy.data.libraries.load(library_path, link=link) as (data_from, data_to):
+        for kind, names in missing.items():
+            available = set(getattr(data_from, kind))
+            requested[kind] = [x for x in names if x in available]
+            setattr(data_to, kind, requested[kind])
+    n = 0
+    for kind, names in requested.items():
+        for name, x in zip(names, getattr(data_to, kind)):
+            if x is None:
+                continue
+            if not link:
+                x["hs2 prefab"] = name
+            _names[(kind, name, link)] = x.name
+            found[kind][name] = x
+            n += 1
+    print("Loaded %d prefab datablocks in %.3f s" % (n, time.time()-t1))
+    return found
+
+def get(kind, name, link=False):
+    return load(link, **{kind: [name]})[kind][name]
+
+# Local copy of a prefab mesh, read from the library through a link. Materials it uses are
+# replaced by their appended versions, so the copy doesn't depend on the library.
+def copy_mesh(name):
+    mesh = get('meshes', name, link=True).copy()
+    for i, m in enumerate(mesh.materials):
+        if m is not None and m.library is not None:
+            mesh.materials[i] = get('materials', m.name)
+    return mesh
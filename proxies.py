@@ -0,0 +1,293 @@
+import bpy
+import os
+import zlib
+import struct
+import numpy as np
+from bpy.app.handlers import persistent
+from concurrent.futures import ThreadPoolExecutor
+from . import textures, texture_analysis
+
+#
+# Low resolution proxy textures.
+#
+# A proxy is a 1/2, 1/4 or 1/8 box-filtered copy of a texture file, cached as
+# cache/proxies/<content hash>_<factor>.png and loaded as an image of its own that points back
+# at the full resolution image through its "hs2 full res" property. Switching a character to
+# proxies swaps the images of its materials' texture nodes (the full resolution images may be
+# shared with other characters, so they are never modified). Proxies are generated in
+# worker threads; nodes switch over as their proxies become ready.
+#
+# Characters are switched back to full resolution while rendering.
+#
+cache_dir = os.path.join(os.path.dirname(__file__), "cache", "proxies")
+
+_pool = None
+# proxy file -> future
+_jobs = {}
+# armature name -> factor it's waiting to be switched to
+_waiting = {}
+# proxy files that couldn't be made
+_failed = set()
+# armature names switched to full resolution for the current render
+_rendering = []
+
+def proxy_file(h, factor):
+    return os.path.join(cache_dir, "%s_%d.png" % (h, factor))
+
+# Box filter by an integer factor; works on (h, w, c) integer arrays
+def downscale(px, factor):
+    h = px.shape[0] // factor * factor
+    w = px.shape[1] // factor * factor
+    v = px[:h, :w].reshape([h//factor, factor, w//factor, factor, px.shape[2]])
+    v = v.mean(axis=(1, 3), dtype=np.float64)
+    return np.rint(v).astype(px.dtype)
+
+# Minimal PNG writer for (h, w, 4) uint8/uint16 RGBA, Up-filtered
+def write_png(fn, px):
+    h, w, c = px.shape
+    depth = 16 if px.dtype==np.uint16 else 8
+    rows = px.astype('>u2' if depth==16 else np.uint8).view(np.uint8).reshape([h, -1])
+    up = rows.copy()
+    up[1:] -= rows[:-1]
+    data = np.concatenate([np.full([h, 1], 2, np.uint8), up], axis=1)
+    def chunk(kind, x):
+        return struct.pack('>I', len(x)) + kind + x + struct.pack('>I', zlib.crc32(kind + x) & 0xffffffff)
+    tmp = fn + ".tmp%d" % os.getpid()
+    with open(tmp, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, depth, 6, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(data.tobytes(), 3)))
+        f.write(chunk(b'IEND', b''))
+    os.replace(tmp, fn)
+
+# Worker thread: decodes 'src' and writes all requested proxies of it.
+# Returns False if the file couldn't be decoded, in which case make_proxies_in_blender takes over.
+def _make_proxies(src, outputs):
+    px = texture_analysis.read_png(src)
+    if px is None:
+        return False
+    for factor, fn in outputs:
+        write_png(fn, downscale(px, factor))
+    return True
+
+# Main thread fallback for files the Python decoder can't handle
+def make_proxies_in_blender(img, outputs):
+    for factor, fn in outputs:
+        tmp = img.copy()
+        try:
+            tmp.scale(max(1, img.size[0]//factor), max(1, img.size[1]//factor))
+            tmp.filepath_raw = fn
+            tmp.file_format = 'PNG'
+            tmp.save()
+        finally:
+            bpy.data.images.remove(tmp)
+
+def _full_res(img):
+    return img.get("hs2 full res", img)
+
+def _source_file(img):
+    if img.source!='FILE' or img.packed_file is not None or len(img.filepath)==0:
+        return None
+    fn = bpy.path.abspath(img.filepath)
+    return fn if os.path.exists(fn) else None
+
+# All image texture nodes in the materials of the character
+def image_nodes(arm):
+    mats = set()
+    for obj in [arm] + list(arm.children_recursive):
+        if obj.type=='MESH':
+            for slot in obj.material_slots:
+                if slot.material is not None and slot.material.node_tree is not None:
+                    mats.add(slot.material)
+    return [n for m in mats for n in m.node_tree.nodes if n.type=='TEX_IMAGE' and n.image is not None]
+
+# (full resolution image pointer, factor) -> proxy image, of all proxies loaded
+def _loaded_proxies():
+    v = {}
+    for x in bpy.data.images:
+        img = x.get("hs2 full res")
+        if img is not None:
+            v[(img.as_pointer(), x.get("hs2 proxy factor"))] = x
+    return v
+
+# The proxy image of 'img' at 'factor', loading it if the file exists; otherwise None
+def get_proxy(img, factor, h, loaded):
+    x = loaded.get((img.as_pointer(), factor))
+    if x is not None:
+        return x
+    fn = proxy_file(h, factor)
+    if not os.path.exists(fn):
+        return None
+    proxy = bpy.data.images.load(fn)
+    proxy.name = "%s (1/%d)" % (img.name, factor)
+    proxy.colorspace_settings.name = img.colorspace_settings.name
+    proxy.alpha_mode = img.alpha_mode
+    proxy["hs2 full res"] = img
+    proxy["hs2 proxy factor"] = factor
+    loaded[(img.as_pointer(), factor)] = proxy
+    return proxy
+
+# Starts generating missing proxies of all textures of the character in the background
+def generate(arm, factor):
+    global _pool
+    if factor==1:
+        return
+    todo = {}
+    for node in image_nodes(arm):
+        img = _full_res(node.image)
+        src = _source_file(img)
+        if src is None:
+            continue
+        fn = proxy_file(textures.file_hash(src), factor)
+        if not os.path.exists(fn) and fn not in _jobs and fn not in _failed:
+            todo.setdefault(src, (img, []))[1].append((factor, fn))
+    if len(todo)==0:
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    if _pool is None:
+        _pool = ThreadPoolExecutor(texture_analysis.threads)
+    for src, (img, outputs) in todo.items():
+        future = _pool.submit(_make_proxies, src, outputs)
+        for _, fn in outputs:
+            _jobs[fn] = (future, img.name, outputs)
+    if not bpy.app.timers.is_registered(_poll):
+        bpy.app.timers.register(_poll, first_interval=0.5)
+
+# Switches the texture nodes of the character to proxies at 'factor' (1 = full resolution).
+# Textures whose proxies aren't ready yet keep their current image until they are.
+def set_resolution(arm, factor):
+    arm["texture resolution"] = factor
+    if factor!=1:
+        require_lock_interface()
+    missing = False
+    loaded = _loaded_proxies()
+    replaced = []
+    for node in image_nodes(arm):
+        img = _full_res(node.image)
+        if factor==1:
+            replaced.append(node.image)
+            node.image = img
+            continue
+        src = _source_file(img)
+        if src is None:
+            continue
+        h = textures.file_hash(src)
+        proxy = get_proxy(img, factor, h, loaded)
+        if proxy is None:
+            missing = missing or proxy_file(h, factor) not in _failed
+        else:
+            replaced += [img, node.image]
+            node.image = proxy
+    free_unused(replaced)
+    if missing:
+        _waiting[arm.name] = factor
+        generate(arm, factor)
+    else:
+        _waiting.pop(arm.name, None)
+
+# Frees the pixel buffers of those of the images (full resolution images or proxies switched
+# away from) no node uses any more: an image may still be shown by another character.
+# They are loaded again when a node shows them.
+def free_unused(images):
+    images = [x for x in set(images) if x.has_data]
+    if len(images)==0:
+        return
+    used = set()
+    trees = [m.node_tree for m in bpy.data.materials if m.node_tree is not None] + list(bpy.data.node_groups)
+    trees += [w.node_tree for w in bpy.data.worlds if w.node_tree is not None]
+    for tree in trees:
+        for n in tree.nodes:
+            img = getattr(n, "image", None)
+            if img is not None:
+                used.add(img.as_pointer())
+    n = 0
+    for img in images:
+        if img.as_pointer() not in used:
+            img.buffers_free()
+            n += 1
+    if n>0:
+        print("Freed the pixel buffers of %d images no longer shown" % n)
+
+def _poll():
+    for fn in list(_jobs):
+        future, name, outputs = _jobs[fn]
+        if not future.done():
+            continue
+        del _jobs[fn]
+        ok = False
+        try:
+            ok = future.result()
+        except Exception as e:
+            print("Failed to make proxy", fn, e)
+        if not ok and name in bpy.data.images and not os.path.exists(fn):
+            try:
+                make_proxies_in_blender(bpy.data.images[name], [x for x in outputs if x[1]==fn])
+            except Exception as e:
+                print("Failed to make proxy", fn, e)
+        if not os.path.exists(fn):
+            _failed.add(fn)
+    if len(_jobs)>0:
+        return 0.5
+    for name, factor in list(_waiting.items()):
+        del _waiting[name]
+        if name in bpy.data.objects:
+            set_resolution(bpy.data.objects[name], factor)
+    return None
+
+def _characters():
+    return [x for x in bpy.data.objects if x.type=='ARMATURE' and x.get("texture resolution", 1)!=1]
+
+#
+# The render handlers below (and lazy_textures') switch images of texture nodes. For renders
+# started from the UI (F12, animation), they run in the render thread, so that is only safe
+# while the interface is locked for the render. Characters with proxies or deferred textures
+# turn on Lock Interface in the render settings of every scene; the handlers leave the
+# images alone (and say so) if it has been turned off since.
+#
+def require_lock_interface():
+    for scene in bpy.data.scenes:
+        if not scene.render.use_lock_interface:
+            scene.render.use_lock_interface = True
+            print("Turned on Lock Interface in the render settings of", scene.name, "(needed to switch textures for rendering)")
+
+def can_switch_images(scene):
+    if bpy.app.background or scene.render.use_lock_interface:
+        return True
+    print("Lock Interface is off in the render settings of", scene.name, "- rendering with the textures shown in the viewport")
+    return False
+
+@persistent
+def render_init(scene):
+    if not can_switch_images(scene):
+        return
+    for arm in _characters():
+        factor = arm["texture resolution"]
+        set_resolution(arm, 1)
+        arm["texture resolution"] = factor
+        _rendering.append(arm.name)
+
+@persistent
+def render_done(scene):
+    for name in _rendering:
+        if name in bpy.data.objects:
+            arm = bpy.data.objects[name]
+            set_resolution(arm, arm["texture resolution"])
+    _rendering.clear()
+
+@persistent
+def load_post(dummy):
+    if len(_characters())>0:
+        require_lock_interface()
+
+def register_handlers():
+    unregister_handlers()
+    bpy.app.handlers.render_init.append(render_init)
+    bpy.app.handlers.render_complete.append(render_done)
+    bpy.app.handlers.render_cancel.append(render_done)
+    bpy.app.handlers.load_post.append(load_post)
+
+def unregister_handlers():
+    for handlers in (bpy.app.handlers.render_init, bpy.app.handlers.render_complete, bpy.app.handlers.render_cancel, bpy.app.handlers.load_post):
+        for h in list(handlers):
+            if getattr(h, "__module__", None)==__name__:
+                handlers.remove(h)
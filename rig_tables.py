@@ -0,0 +1,120 @@
+import os
+import time
+import numpy as np
+from mathutils import Matrix
+from . import prefabs
+
+# Default rigs (the 'Rig_*' text blocks of the prefab library), compiled into an (N,4,4) float32
+# .npy and a list of bone names per body + head combination, with the head offset already applied.
+# The .npy is memory-mapped when loaded. Tables are rebuilt when the prefab library changes.
+cache_dir = os.path.join(os.path.dirname(__file__), "cache", "rigs")
+TABLE_VERSION = 1
+
+# Set to False to always parse the text blocks (for benchmarking)
+use_cache = True
+_tables = {}
+
+# Added to the y and z translation of the head rigs' matrices
+head_offset = (15.935, -0.23)
+
+#
+# Matrices of the bones of a default rig, in text block order (body bones first, then head bones
+# the body rig doesn't have; head bones replace body bones of the same name).
+#
+# Also works as a read-only {name: Matrix} mapping.
+#
+class RigTable:
+    def __init__(self, names, matrices):
+        self.names = names
+        self.index = {x: k for k, x in enumerate(names)}
+        self.matrices = matrices
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return Matrix(self.matrices[self.index[name]].tolist())
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+    # A new {name: Matrix} dict
+    def to_dict(self):
+        m = self.matrices.tolist()
+        return {x: Matrix(m[k]) for k, x in enumerate(self.names)}
+
+# (names, (N,4,4) float32) of a rig text block: one bone per line, name and 16 numbers
+def parse_rig(text):
+    names = []
+    values = []
+    for x in text.lines:
+        y = x.body.split()
+        if len(y)==0:
+            continue
+        names.append(y[0])
+        values.append([float(z) for z in y[1:17]])
+    return names, np.array(values, dtype=np.float32).reshape([-1,4,4])
+
+def build(body, head):
+    names, m = parse_rig(prefabs.get('texts', body, link=True))
+    head_names, h = parse_rig(prefabs.get('texts', head, link=True))
+    # Offset in double precision, as mathutils does for m[1][3] += ...
+    h64 = h.astype(np.float64)
+    h64[:,1,3] += head_offset[0]
+    h64[:,2,3] += head_offset[1]
+    h = h64.astype(np.float32)
+    index = {x: k for k, x in enumerate(names)}
+    extra = []
+    for k, x in enumerate(head_names):
+        if x in index:
+            m[index[x]] = h[k]
+        else:
+            extra.append(k)
+    return names + [head_names[k] for k in extra], np.concatenate([m, h[extra]])
+
+def _cache_path(body, head):
+    st = os.stat(prefabs.library_path)
+    return os.path.join(cache_dir, "%s+%s_%d_%d_v%d.npy" % (body, head, st.st_size, st.st_mtime_ns, TABLE_VERSION))
+
+# The RigTable of a body rig ('Rig_Male', 'Rig_Female') combined with a head rig ('Rig_Male_Head',
+# 'Rig_Female_Head0', 'Rig_Female_Head1'), from memory, the on-disk cache, or else built
+def load_rig(body, head):
+    t1 = time.time()
+    fn = _cache_path(body, head)
+    if use_cache and fn in _tables:
+        return _tables[fn]
+    table = None
+    if use_cache and os.path.exists(fn):
+        try:
+            with open(fn[:-4] + ".txt", 'r') as f:
+                names = f.read().split('\n')
+            table = RigTable(names, np.load(fn, mmap_mode='r'))
+        except Exception as e:
+            print("Failed to read rig table", fn, e)
+    if table is None:
+        table = RigTable(*build(body, head))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = fn + ".tmp%d" % os.getpid()
+            with open(tmp + ".txt", 'w') as f:
+                f.write('\n'.join(table.names))
+            with open(tmp, 'wb') as f:
+                np.save(f, table.matrices)
+            os.replace(tmp + ".txt", fn[:-4] + ".txt")
+            os.replace(tmp, fn)
+        except Exception as e:
+            print("Failed to cache rig table", fn, e)
+        print("Rig %s + %s compiled in %.3f s (%d bones)" % (body, head, time.time()-t1, len(table)))
+    else:
+        print("Rig %s + %s loaded in %.3f s (%d bones)" % (body, head, time.time()-t1, len(table)))
+    _tables[fn] = table
+    return table
+
+def clear_rig_cache():
+    _tables.clear()
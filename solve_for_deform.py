@@ -5,17 +5,27 @@ from mathutils import Matrix, Vector, Euler, Quaternion
 import struct
 import numpy as np
 import time
+from .weights import read_weights_csr
+
+def coordinates(x):
+    v = np.zeros([len(x)*3], dtype=np.float32)
+    x.foreach_get("co", v)
+    return v.reshape([-1,3])
+
+# The shape solve_for_deform deforms a mesh back to: the (V,3) vertex coordinates, or if the mesh
+# has shape keys, {shape key name: (V,3) coordinates}
+def snapshot(mesh):
+    if mesh.shape_keys!=None:
+        return {y.name: coordinates(y.data) for y in mesh.shape_keys.key_blocks}
+    return coordinates(mesh.vertices)
 
 #
 # This simply calculates:
 #
 # for x in range(len(target)):
-#       target[x].co = mats[x] @ undeformed[x].co
+#       target[x].co = mats[x] @ undeformed[x]
 #
-def np_solve(target, undeformed, np_mats, obj):
-    np_undeformed = np.zeros([len(target)*3], dtype=np.float32)
-    undeformed.foreach_get("co", np_undeformed)
-    np_undeformed = np_undeformed.reshape([-1,3])
+def np_solve(target, np_undeformed, np_mats, obj):
     np_undeformed = np.concatenate([np_undeformed, np.ones([np_undeformed.shape[0],1],dtype=np.float32)], axis=1)
     out = np.einsum("Bac,Bc->Ba",np_mats,np_undeformed)
     print_count=0
@@ -26,47 +36,56 @@ def np_solve(target, undeformed, np_mats, obj):
     out = (out[:,:3]/out[:,3:]).reshape([-1])
     target.foreach_set("co", out)
 
-# Given an object 'b' that is parented to an armature 'arm' in a nontrivial pose, and a reference
-# object with the same number of vertices, deforms the rest position of 'b' until it matches 'b2' in pose position.
-def solve_for_deform(arm, b, b2):
-    np_mats = np.zeros([len(b.data.vertices), 4, 4], dtype=np.float32)
-    totwts = np.zeros([len(b.data.vertices), 1, 1], dtype=np.float32)
-
-    bone_mats = [None]*len(b.vertex_groups)
+# Stacks the pose space matrices of all bones that own a vertex group of 'b' into one (G,4,4) array,
+# indexed by vertex group index. Groups without a matching bone get a zero matrix and a False mask entry.
+def stack_bone_matrices(arm, b):
+    bone_mats = np.zeros([len(b.vertex_groups), 4, 4], dtype=np.float32)
+    is_bone = np.zeros([len(b.vertex_groups)], dtype=bool)
     for y in b.vertex_groups:
         if y.name in arm.pose.bones:
             bone_mats[y.index] = arm.pose.bones[y.name].matrix_channel
-    z=Matrix()
-    z.zero()
+            is_bone[y.index] = True
+    return bone_mats, is_bone
 
-    # The effect of armature deformation on a vertex 'v' is
-    # v_.co = sum([g.weight * arm.pose.bones[b.vertex_groups[g.group].name].matrix_channel for g in v.groups]) @ v.co
-    # (assuming that vertex weights are normalized.)
-    # We calculate the sum and then invert the matrix.
-    for x in range(len(b.data.vertices)):
-        deform = z.copy()
-        totwt = 0.0
-        for y in b.data.vertices[x].groups:
-            m = bone_mats[y.group]
-            if m is not None:
-                deform += m*y.weight
-                totwt += y.weight
-        totwts[x,0,0] = totwt
-        np_mats[x] = deform if totwt>0.0 else Matrix()
+# The effect of armature deformation on a vertex 'v' is
+# v_.co = sum([g.weight * arm.pose.bones[b.vertex_groups[g.group].name].matrix_channel for g in v.groups]) @ v.co
+# (assuming that vertex weights are normalized.)
+# With W the (V,G) weight matrix and M the (G,16) flattened bone matrices this is just W @ M.
+# Accumulation runs in vertex group order, same as the per-vertex loop it replaces.
+def blend_bone_matrices(indptr, indices, data, bone_mats, is_bone):
+    nverts = len(indptr)-1
+    rows = np.repeat(np.arange(nverts), np.diff(indptr))
+    wts = np.where(is_bone[indices], data, np.float32(0.0))
+    deform = np.zeros([nverts, 16], dtype=np.float32)
+    np.add.at(deform, rows, bone_mats.reshape([-1,16])[indices] * wts[:,None])
+    totwts = np.bincount(rows, weights=wts, minlength=nverts).astype(np.float32)
+    deform = deform.reshape([-1,4,4])
+    deform[totwts<=0.0] = np.eye(4, dtype=np.float32)
+    return deform, totwts.reshape([-1,1,1])
+
+# Given an object 'b' that is parented to an armature 'arm' in a nontrivial pose, and a snapshot
+# of its shape (see snapshot()), deforms the rest position of 'b' until it matches the snapshot in pose position.
+def solve_for_deform(arm, b, ref):
+    t1 = time.time()
+    indptr, indices, data = read_weights_csr(b.data)
+    t2 = time.time()
+    bone_mats, is_bone = stack_bone_matrices(arm, b)
+    np_mats, totwts = blend_bone_matrices(indptr, indices, data, bone_mats, is_bone)
+    t3 = time.time()
 
     # an extra step is needed if the object is offset / rotated relative to the armature
     dm_fwd = np.array(b.matrix_local, dtype=np.float32)
     dm_inv = np.array(b.matrix_local.inverted(), dtype=np.float32)
-    np_mats = np.array([np.linalg.inv(x) for x in np_mats]) * totwts
+    np_mats = np.linalg.inv(np_mats) * totwts
     np_mats = np.einsum("ca,Bae,ed->Bcd", dm_inv, np_mats, dm_fwd)
+    t4 = time.time()
 
     if b.data.shape_keys!=None:
         for y in b.data.shape_keys.key_blocks:
             target=b.data.shape_keys.key_blocks[y.name].data
-            undeformed=b2.data.shape_keys.key_blocks[y.name].data
-            np_solve(target, undeformed, np_mats, b)
+            np_solve(target, ref[y.name], np_mats, b)
     else:
         target=b.data.vertices
-        undeformed=b2.data.vertices
-        np_solve(target, undeformed, np_mats, b)
-
+        np_solve(target, ref, np_mats, b)
+    t5 = time.time()
+    print("%s: weights %.3f s, blend %.3f s, invert %.3f s, apply %.3f s (%d verts, %d weights)" % (b.name, t2-t1, t3-t2, t4-t3, t5-t4, len(indptr)-1, len(data)))
@@ -0,0 +1,53 @@
+import numpy as np
+from mathutils import kdtree
+
+#
+# Nearest-neighbour lookups over a fixed point set, backed by mathutils.kdtree.
+#
+# 'points' is an (N,3) array of coordinates, or (N,2) for UV lookups (stored with z=0).
+# 'ids' optionally gives the value to report for each point (e.g. a vertex index);
+# by default it's the position in 'points'. Building is O(N log N), every query O(log N),
+# and nothing the size of (queries x points) is ever allocated.
+#
+class PointIndex:
+    def __init__(self, points, ids=None):
+        points = _as_3d(points)
+        self.ids = np.arange(len(points)) if ids is None else np.asarray(ids)
+        self.tree = kdtree.KDTree(len(points))
+        for k, co in enumerate(points.tolist()):
+            self.tree.insert(co, k)
+        self.tree.balance()
+        self.size = len(points)
+
+    # For each query point, the id of the nearest point and the distance to it
+    # (id -1 and distance inf if the index is empty)
+    def nearest(self, queries):
+        queries = _as_3d(queries)
+        ids = np.full([len(queries)], -1, dtype=np.int64)
+        dist = np.full([len(queries)], np.inf)
+        if self.size==0:
+            return ids, dist
+        found = [self.tree.find(co) for co in queries.tolist()]
+        pos = np.array([f[1] for f in found], dtype=np.int64).reshape([-1])
+        ids[:] = self.ids[pos]
+        dist[:] = [f[2] for f in found]
+        return ids, dist
+
+    # True for each query point that has a point of the index closer than 'tol'
+    def within(self, queries, tol):
+        return self.nearest(queries)[1] < tol
+
+def _as_3d(points):
+    points = np.asarray(points, dtype=np.float64)
+    if points.ndim==1:
+        points = points.reshape([-1,3])
+    if points.shape[1]==2:
+        points = np.concatenate([points, np.zeros([len(points),1])], axis=1)
+    return points
+
+# Coordinates of all vertices of 'obj' in world space, as a (V,3) array
+def world_coordinates(obj):
+    co = np.zeros([len(obj.data.vertices)*3], dtype=np.float32)
+    obj.data.vertices.foreach_get("co", co)
+    mw = np.array(obj.matrix_world, dtype=np.float64)
+    return co.reshape([-1,3]) @ mw[:3,:3].T + mw[:3,3]
@@ -0,0 +1,239 @@
+import os
+import zlib
+import struct
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# OpenImageIO (bundled with recent Blender builds) decodes without holding the GIL;
+# without it, PNGs are decoded with zlib and numpy, whose per-row and per-diagonal loops
+# mostly hold it (so that path runs off the main thread, but doesn't use many cores)
+try:
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
+
+# PNGs with Average/Paeth filtered rows are unfiltered one anti-diagonal at a time, in bands
+# of this many rows; the skewed copies of a band take about 4*(rows+width)*rows*bpp bytes
+wavefront_rows = 512
+threads = max(1, os.cpu_count() or 1)
+
+_pool = None
+_futures = {}
+
+#
+# Decoding
+#
+
+# (h, w, 4) RGBA uint8/uint16 array of a PNG file, top row first, or None if it can't be decoded
+def read_png(fn):
+    if oiio is not None:
+        try:
+            return _read_oiio(fn)
+        except Exception:
+            pass
+    try:
+        return _decode_png(fn)
+    except Exception as e:
+        print("Failed to decode", fn, e)
+        return None
+
+def _rgba(px, alpha_max):
+    c = px.shape[2]
+    if c==4:
+        return px
+    v = np.empty(px.shape[:2] + (4,), px.dtype)
+    if c<=2:
+        v[:, :, :3] = px[:, :, :1]
+    else:
+        v[:, :, :3] = px[:, :, :3]
+    v[:, :, 3] = px[:, :, 1] if c==2 else alpha_max
+    return v
+
+# (rows, cols, 4) RGBA array of the top left corner of a PNG file, top row first, or None if it
+# can't be decoded. Only the rows needed are decompressed, and only 'cols' columns unfiltered
+# (PNG filters only look up and left).
+def read_png_window(fn, rows, cols):
+    if oiio is not None:
+        try:
+            return _read_oiio(fn, rows)[:, :cols]
+        except Exception:
+            pass
+    try:
+        return _decode_png(fn, rows, cols)
+    except Exception as e:
+        print("Failed to decode", fn, e)
+        return None
+
+def _read_oiio(fn, rows=None):
+    inp = oiio.ImageInput.open(fn)
+    if inp is None:
+        raise Exception(oiio.geterror())
+    try:
+        spec = inp.spec()
+        fmt = "uint16" if spec.format.size()>1 else "uint8"
+        h = spec.height if rows is None else min(rows, spec.height)
+        if h==spec.height:
+            px = inp.read_image(0, 0, 0, spec.nchannels, fmt)
+        else:
+            px = inp.read_scanlines(0, 0, 0, h, 0, 0, spec.nchannels, fmt)
+    finally:
+        inp.close()
+    if px is None:
+        raise Exception(oiio.geterror())
+    px = np.asarray(px).reshape([h, spec.width, spec.nchannels])
+    return _rgba(px, 65535 if fmt=="uint16" else 255)
+
+_channels = {0: 1, 2: 3, 4: 2, 6: 4}
+
+# (width, height, bit depth, color type) from the IHDR chunk of a PNG file, or None
+def png_header(fn):
+    try:
+        with open(fn, 'rb') as f:
+            data = f.read(29)
+    except OSError:
+        return None
+    if len(data)<29 or data[:8]!=b'\x89PNG\r\n\x1a\n' or data[12:16]!=b'IHDR':
+        return None
+    return struct.unpack('>IIBB', data[16:26])
+
+def _decode_png(fn, rows=None, cols=None):
+    with open(fn, 'rb') as f:
+        data = f.read()
+    if data[:8]!=b'\x89PNG\r\n\x1a\n':
+        return None
+    pos = 8
+    idat = []
+    header = None
+    while pos<len(data):
+        n, kind = struct.unpack('>I4s', data[pos:pos+8])
+        chunk = data[pos+8:pos+8+n]
+        if kind==b'IHDR':
+            header = struct.unpack('>IIBBBBB', chunk)
+        elif kind==b'IDAT':
+            idat.append(chunk)
+        elif kind==b'IEND':
+            break
+        pos += n+12
+    w, h, depth, ctype, _, _, interlace = header
+    if interlace!=0 or depth not in (8, 16) or ctype not in _channels:
+        return None
+    c = _channels[ctype]
+    bpp = c*depth//8
+    if rows is None:
+        data = zlib.decompress(b''.join(idat))
+    else:
+        # only as much of the stream as the first rows take
+        h = min(rows, h)
+        need = h*(w*bpp+1)
+        d = zlib.decompressobj()
+        data = []
+        n = 0
+        for x in idat:
+            data.append(d.decompress(x))
+            n += len(data[-1])
+            if n>=need:
+                break
+        data = b''.join(data)
+    cw = w if cols is None else min(cols, w)
+    out = _unfilter(data, h, w, bpp, cw)
+    if depth==16:
+        px = out.view('>u2').astype(np.uint16).reshape([h, cw, c])
+    else:
+        px = out.reshape([h, cw, c])
+    return _rgba(px, 65535 if depth==16 else 255)
+
+# Undoes PNG row filtering of the first 'cols' (default: all) columns; returns (h, cols*bpp) uint8
+def _unfilter(data, h, w, bpp, cols=None):
+    d = np.frombuffer(data, np.uint8, count=h*(w*bpp+1)).reshape([h, w*bpp+1])
+    filters = d[:, 0]
+    if cols is not None:
+        w = cols
+    raw = d[:, 1:w*bpp+1]
+    if filters.max()<=2:
+        # None/Sub/Up only: one row at a time, uint8 arithmetic wraps like the filters do
+        out = np.empty([h, w*bpp], np.uint8)
+        prev = np.zeros([w*bpp], np.uint8)
+        for y in range(h):
+            f = filters[y]
+            if f==0:
+                out[y] = raw[y]
+            elif f==1:
+                out[y] = np.cumsum(raw[y].reshape([w, bpp]), axis=0, dtype=np.uint8).reshape([-1])
+            else:
+                np.add(raw[y], prev, out=out[y])
+            prev = out[y]
+        return out
+    raw = raw.reshape([h, w, bpp])
+    out = np.empty([h, w, bpp], np.uint8)
+    prev = np.zeros([w, bpp], np.uint8)
+    for y in range(0, h, wavefront_rows):
+        band = slice(y, min(h, y+wavefront_rows))
+        out[band] = _unfilter_wavefront(raw[band], filters[band], prev)
+        prev = out[band.stop-1]
+    return out.reshape([h, w*bpp])
+
+# Every filter type only looks at the pixels left, above and above-left, so all pixels on
+# an anti-diagonal y+x=s can be done at once. The rows of the band are stored skewed and
+# transposed, T[s+2, y+1] = pixel (y, s-y), so that each diagonal is a contiguous slice;
+# the row above the band ('prev', already unfiltered) is T[x+1, 0].
+def _unfilter_wavefront(raw, filters, prev):
+    h, w, bpp = raw.shape
+    ys = np.arange(h)[:, None]
+    xs = np.arange(w)[None, :]
+    T = np.zeros([h+w+2, h+1, bpp], np.int16)
+    T[1:w+1, 0] = prev
+    R = np.zeros([h+w+2, h, bpp], np.int16)
+    R[xs+ys+2, ys] = raw
+    f = filters.astype(np.int64)[:, None]
+    for s in range(h+w-1):
+        y0 = max(0, s-w+1)
+        y1 = min(h-1, s)+1
+        a = T[s+1, y0+1:y1+1]
+        b = T[s+1, y0:y1]
+        c = T[s, y0:y1]
+        ff = f[y0:y1]
+        p = a+b-c
+        pa = np.abs(p-a)
+        pb = np.abs(p-b)
+        pc = np.abs(p-c)
+        paeth = np.where((pa<=pb) & (pa<=pc), a, np.where(pb<=pc, b, c))
+        pred = np.where(ff==4, paeth, np.where(ff==3, (a+b)>>1, np.where(ff==2, b, np.where(ff==1, a, 0))))
+        T[s+2, y0+1:y1+1] = (R[s+2, y0:y1]+pred) & 255
+    return T[:, 1:][xs+ys+2, ys].astype(np.uint8)
+
+# Float view of (a part of) a decoded image, computed the way Blender's Image.pixels does
+def to_floats(px):
+    if px.dtype==np.uint8:
+        return px.astype(np.float32) * np.float32(1.0/255.0)
+    if px.dtype==np.uint16:
+        return px.astype(np.float32) * np.float32(1.0/65535.0)
+    return px
+
+#
+# Background analysis: submit(key, func, fn) runs func(fn) in the thread pool;
+# result(key) waits for it (None if nothing was submitted under key).
+#
+
+def submit(key, func, fn):
+    global _pool
+    if key in _futures:
+        return
+    if _pool is None:
+        _pool = ThreadPoolExecutor(threads)
+    _futures[key] = _pool.submit(func, fn)
+
+def result(key):
+    f = _futures.get(key)
+    if f is None or f.cancelled():
+        return None
+    try:
+        return f.result()
+    except Exception as e:
+        print("Texture analysis failed:", e)
+        return None
+
+# Drops results and cancels whatever hasn't started yet
+def cancel():
+    for f in _futures.values():
+        f.cancel()
+    _futures.clear()
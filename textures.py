@@ -0,0 +1,424 @@
+import bpy
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import texture_analysis
+
+# Set to False to re-list the directory and rehash the file on every lookup (for benchmarking)
+use_cache = True
+_indexes = {}
+
+#
+# Texture dedup index: the content hash of every texture file seen, kept in an SQLite database
+# as (path, size, mtime, hash) so that a file is only hashed again after it changes.
+# Identical textures exported into several dump folders all resolve to the first one indexed
+# (see canonical_file), so they end up sharing one image.
+#
+# Hashes are blake2b-128: they are only used to find duplicates, and blake2b is faster than MD5.
+#
+db_path = os.path.join(os.path.dirname(__file__), "cache", "textures.sqlite")
+# Previous (MD5, text) index; only read for the order of its paths when creating the database
+legacy_map_path = os.path.join(os.path.dirname(__file__), "assets", "hash_map.txt")
+HASH_VERSION = 1
+# Bump analysis results are cached per content hash too; bump this when the analysis changes
+BUMP_VERSION = 1
+SKIN_TONE_VERSION = 1
+index_threads = max(1, min(8, (os.cpu_count() or 2) - 1))
+
+_lock = threading.RLock()
+_conn = None
+# path -> (size, mtime, hash)
+_hashes = {}
+# hash -> path of the first file indexed with that content
+_canonical = {}
+_pending_rows = []
+# hash -> (inverted, (gamma_r, gamma_g)); either may be None if it was never computed
+_bump = {}
+_pending_bump = []
+# hash -> (r, g, b) sampled skin tone of a torso texture
+_skin_tone = {}
+_pending_skin_tone = []
+_generation = 0
+# (files hashed, files to hash) of the indexing running in the background, or None
+_progress = None
+
+def _hash_bytes(fn):
+    h = hashlib.blake2b(digest_size=16)
+    with open(fn, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<22), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _open_db():
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        _conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        _conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, hash TEXT)")
+        _conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        _conn.execute("CREATE TABLE IF NOT EXISTS bump (hash TEXT PRIMARY KEY, inverted INTEGER, gamma_r REAL, gamma_g REAL)")
+        _conn.execute("CREATE TABLE IF NOT EXISTS skin_tone (hash TEXT PRIMARY KEY, r REAL, g REAL, b REAL)")
+        v = _conn.execute("SELECT value FROM meta WHERE key='hash_version'").fetchone()
+        if v is None or int(v[0])!=HASH_VERSION:
+            _conn.execute("DELETE FROM files")
+            _conn.execute("DELETE FROM bump")
+            _conn.execute("DELETE FROM skin_tone")
+            _conn.execute("INSERT OR REPLACE INTO meta VALUES ('hash_version', ?)", (str(HASH_VERSION),))
+        v = _conn.execute("SELECT value FROM meta WHERE key='bump_version'").fetchone()
+        if v is None or int(v[0])!=BUMP_VERSION:
+            _conn.execute("DELETE FROM bump")
+            _conn.execute("INSERT OR REPLACE INTO meta VALUES ('bump_version', ?)", (str(BUMP_VERSION),))
+        v = _conn.execute("SELECT value FROM meta WHERE key='skin_tone_version'").fetchone()
+        if v is None or int(v[0])!=SKIN_TONE_VERSION:
+            _conn.execute("DELETE FROM skin_tone")
+            _conn.execute("INSERT OR REPLACE INTO meta VALUES ('skin_tone_version', ?)", (str(SKIN_TONE_VERSION),))
+        _conn.commit()
+    return _conn
+
+def _remember(fn, size, mtime, h):
+    with _lock:
+        _hashes[fn] = (size, mtime, h)
+        _canonical.setdefault(h, fn)
+        _pending_rows.append((fn, size, mtime, h))
+
+# Writes hashes and analysis results computed since the last flush to the database
+def flush():
+    with _lock:
+        if len(_pending_rows)==0 and len(_pending_bump)==0 and len(_pending_skin_tone)==0:
+            return
+        try:
+            db = _open_db()
+            db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", _pending_rows)
+            db.executemany("INSERT OR REPLACE INTO bump VALUES (?, ?, ?, ?)", _pending_bump)
+            db.executemany("INSERT OR REPLACE INTO skin_tone VALUES (?, ?, ?, ?)", _pending_skin_tone)
+            db.commit()
+        except Exception as e:
+            print("Failed to update texture index", db_path, e)
+        _pending_rows.clear()
+        _pending_bump.clear()
+        _pending_skin_tone.clear()
+
+# Cached (r, g, b) skin tone sampled from the texture with content hash 'h', or None
+def get_skin_tone(h):
+    return _skin_tone.get(h)
+
+def put_skin_tone(h, rgb):
+    with _lock:
+        _skin_tone[h] = tuple(rgb)
+        _pending_skin_tone.append((h,) + tuple(rgb))
+
+# Cached (inverted, (gamma_r, gamma_g)) of the bump texture with content hash 'h', or None
+def get_bump_analysis(h):
+    return _bump.get(h)
+
+# Caches a bump analysis result; None fields keep what was cached before
+def put_bump_analysis(h, inverted, gamma):
+    with _lock:
+        old = _bump.get(h)
+        if old is not None:
+            inverted = old[0] if inverted is None else inverted
+            gamma = old[1] if gamma is None else gamma
+        _bump[h] = (inverted, gamma)
+        _pending_bump.append((h, None if inverted is None else int(inverted),
+            None if gamma is None else gamma[0], None if gamma is None else gamma[1]))
+
+# Reads the database into memory; cheap, so it can run on add-on registration
+def load_index():
+    t1 = time.time()
+    with _lock:
+        _hashes.clear()
+        _canonical.clear()
+        _bump.clear()
+        _skin_tone.clear()
+        try:
+            db = _open_db()
+            for fn, size, mtime, h in db.execute("SELECT path, size, mtime, hash FROM files ORDER BY rowid"):
+                _hashes[fn] = (size, mtime, h)
+                _canonical.setdefault(h, fn)
+            for h, inverted, gamma_r, gamma_g in db.execute("SELECT hash, inverted, gamma_r, gamma_g FROM bump"):
+                _bump[h] = (None if inverted is None else bool(inverted), None if gamma_r is None else (gamma_r, gamma_g))
+            for h, r, g, b in db.execute("SELECT hash, r, g, b FROM skin_tone"):
+                _skin_tone[h] = (r, g, b)
+        except Exception as e:
+            print("Failed to read texture index", db_path, e)
+    print("Texture index: %d files, %d unique, loaded in %.3f s" % (len(_hashes), len(_canonical), time.time()-t1))
+
+# Content hash of a file, from the index if the file hasn't changed since it was hashed
+def file_hash(fn):
+    st = os.stat(fn)
+    v = _hashes.get(fn)
+    if use_cache and v is not None and v[0]==st.st_size and v[1]==st.st_mtime_ns:
+        return v[2]
+    h = _hash_bytes(fn)
+    _remember(fn, st.st_size, st.st_mtime_ns, h)
+    return h
+
+# The first indexed file with the same content as 'fn' (or 'fn' itself)
+def canonical_file(fn):
+    h = file_hash(fn)
+    x = _canonical.get(h, fn)
+    if x!=fn and not os.path.exists(x):
+        with _lock:
+            _canonical[h] = fn
+        x = fn
+    return x
+
+def _stale(fn):
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    v = _hashes.get(fn)
+    if v is not None and v[0]==st.st_size and v[1]==st.st_mtime_ns:
+        return None
+    return (fn, st.st_size, st.st_mtime_ns)
+
+def _legacy_paths():
+    v = []
+    try:
+        with open(legacy_map_path, "r") as f:
+            for x in f:
+                x = x.strip()
+                if len(x)>0 and not x.startswith('#'):
+                    v.append(x.split(' ', 1)[0])
+    except OSError:
+        pass
+    return v
+
+def _index_files(files, generation):
+    global _progress
+    t1 = time.time()
+    stale = [x for x in map(_stale, files) if x is not None]
+    _progress = (0, len(stale))
+    n = 0
+    try:
+        with ThreadPoolExecutor(index_threads) as pool:
+            # map() yields in submission order, so canonical files don't depend on thread timing
+            for (fn, size, mtime), h in zip(stale, pool.map(lambda x: _try_hash(x[0]), stale)):
+                if generation!=_generation:
+                    break
+                if h is not None:
+                    _remember(fn, size, mtime, h)
+                n += 1
+                _progress = (n, len(stale))
+                if n % 256 == 0:
+                    flush()
+    finally:
+        flush()
+        if generation==_generation:
+            _progress = None
+    print("Texture index: %d new or changed textures hashed in %.3f s, %d unique" % (n, time.time()-t1, len(_canonical)))
+
+def _try_hash(fn):
+    try:
+        return _hash_bytes(fn)
+    except OSError:
+        return None
+
+# Hashes all .png files in the given texture directories that aren't in the index yet (or have
+# changed) in a background thread pool. Lookups work meanwhile; they hash on demand.
+# Starting a new indexing run abandons the previous one.
+def start_indexing(texture_dirs):
+    global _generation
+    files = []
+    if len(_hashes)==0:
+        files += _legacy_paths()
+    for d in texture_dirs:
+        try:
+            files += [os.path.join(d, x) for x in sorted(os.listdir(d)) if x.endswith('.png')]
+        except OSError:
+            pass
+    _generation += 1
+    t = threading.Thread(target=_index_files, args=(files, _generation), daemon=True)
+    t.start()
+    return t
+
+# Human-readable state of the background indexing, or None when idle
+def indexing_status():
+    p = _progress
+    if p is None:
+        return None
+    return "Indexing textures: %d/%d" % p
+
+#
+# The .png files of one texture directory, listed once.
+#
+# Textures are named <object>_..._<kind>.png; files are bucketed by the part of the name after
+# the last '_', so a lookup only scans the files of its kind, and every (object, kind) lookup
+# is remembered. Matches what a scan of os.listdir(path) in listing order would return.
+#
+class TextureIndex:
+    def __init__(self, path):
+        self.path = path
+        self.kinds = {}
+        self.found = {}
+        try:
+            files = os.listdir(path)
+        except OSError:
+            files = []
+        for y in files:
+            if y.endswith('.png') and '_' in y:
+                self.kinds.setdefault(y[:-4].rsplit('_', 1)[1], []).append(y)
+
+    # First file with 'x1_' in its name ending in '_x2.png', or None
+    def find(self, x1, x2):
+        key = (x1, x2)
+        if key not in self.found:
+            prefix = x1 + '_'
+            suffix = '_' + x2 + '.png'
+            self.found[key] = None
+            for y in self.kinds.get(x2.rsplit('_', 1)[-1], []):
+                if prefix in y and y.endswith(suffix):
+                    self.found[key] = self.path + y
+                    break
+        return self.found[key]
+
+def get_index(path):
+    if not use_cache or path not in _indexes:
+        _indexes[path] = TextureIndex(path)
+    return _indexes[path]
+
+# Forgets directory listings (files may have been added or removed) and the image lookup;
+# hashes stay valid because they are checked against size and mtime
+def clear_indexes():
+    global _images
+    _indexes.clear()
+    _images = None
+
+#
+# Image sharing: every image loaded from a file is looked up by the content hash of that file
+# and its alpha mode and color space, so identical textures from different dump folders share
+# one datablock as long as they are used with the same settings. Images record the
+# files they stand in for in their "hs2 shared" property (one per line; ID properties can't hold
+# lists of strings), for memory_report.
+#
+# (hash, alpha, csp) -> image, built from bpy.data.images on first use after clear_indexes
+_images = None
+
+# (alpha, csp) of an image, as load_image is asked for them: alpha 'NONE' or '' (the default,
+# straight alpha), csp 'Non-Color' or '' (the color space Blender picks when loading)
+def _settings(img):
+    return ('NONE' if img.alpha_mode=='NONE' else '', 'Non-Color' if img.colorspace_settings.is_data else '')
+
+def _image_hash(img):
+    if img.source!='FILE' or img.packed_file is not None or len(img.filepath)==0:
+        return None
+    try:
+        return file_hash(bpy.path.abspath(img.filepath))
+    except OSError:
+        return None
+
+def _image_map():
+    global _images
+    if _images is None:
+        _images = {}
+        for img in bpy.data.images:
+            h = _image_hash(img)
+            if h is not None:
+                _images.setdefault((h,) + _settings(img), img)
+    return _images
+
+# Approximate size of the decoded image in memory. Images that aren't loaded (e.g. only shown
+# through proxies) are sized from their file's header: img.size would load them.
+def image_bytes(img):
+    if img.has_data:
+        return img.size[0] * img.size[1] * img.channels * (4 if img.is_float else 1)
+    header = texture_analysis.png_header(bpy.path.abspath(img.filepath))
+    if header is None:
+        return 0
+    # Blender keeps 8 bit PNGs as RGBA bytes, 16 bit ones as RGBA floats
+    w, h, depth, _ = header
+    return w * h * 4 * (4 if depth==16 else 1)
+
+def _shared_files(img):
+    return [x for x in img.get("hs2 shared", "").split("\n") if len(x)>0]
+
+def _add_shared(img, fn):
+    v = _shared_files(img)
+    if fn not in v:
+        v.append(fn)
+        img["hs2 shared"] = "\n".join(v)
+
+# An image already loaded from a file with the same content as 'fn', with the same alpha mode
+# and color space, or None
+def shared_image(fn, alpha=None, csp=None):
+    key = (file_hash(fn), 'NONE' if alpha is not None else '', csp or '')
+    img = _image_map().get(key)
+    if img is None:
+        return None
+    try:
+        path = bpy.path.abspath(img.filepath)
+        changed = _settings(img)!=key[1:]
+    except ReferenceError:
+        changed = True
+    if changed:
+        # removed, or its settings were changed since
+        del _images[key]
+        return None
+    if os.path.normpath(path)!=os.path.normpath(fn):
+        _add_shared(img, fn)
+    return img
+
+# Registers an image just loaded from 'fn'
+def add_image(fn, img):
+    _image_map()[(file_hash(fn),) + _settings(img)] = img
+
+# The image of texture file 'fn' with the given alpha mode and color space: an image already
+# loaded from identical content with the same settings, or else the file, newly loaded (as a
+# separate image even if the file is loaded with other settings). None on failure.
+def load_image(fn, alpha=None, csp=None):
+    img = shared_image(fn, alpha, csp)
+    if img is not None:
+        return img
+    img = bpy.data.images.load(fn, check_existing=False)
+    if img is None:
+        return None
+    if alpha is not None:
+        img.alpha_mode = 'NONE'
+    if csp is not None:
+        img.colorspace_settings.name = csp
+    add_image(fn, img)
+    return img
+
+# Merges images loaded separately from identical files (e.g. after appending characters
+# imported in other sessions) into one, if they have the same color space and alpha mode.
+# Returns (number of images removed, bytes saved).
+def share_images():
+    first = {}
+    merged = []
+    for img in bpy.data.images:
+        h = _image_hash(img)
+        if h is None:
+            continue
+        key = (h, img.colorspace_settings.name, img.alpha_mode)
+        if key not in first:
+            first[key] = img
+        else:
+            merged.append((img, first[key]))
+    saved = 0
+    for img, keep in merged:
+        _add_shared(keep, bpy.path.abspath(img.filepath))
+        for x in _shared_files(img):
+            _add_shared(keep, x)
+        if img.has_data:
+            saved += image_bytes(img)
+        img.user_remap(keep)
+        bpy.data.images.remove(img)
+    if len(merged)>0:
+        clear_indexes()
+        print("Shared %d duplicate images, %.1f MB saved" % (len(merged), saved / (1<<20)))
+    return len(merged), saved
+
+# (number of texture files served by another file's image, bytes that would otherwise be loaded)
+def memory_report():
+    n = 0
+    saved = 0
+    for img in bpy.data.images:
+        k = len(_shared_files(img))
+        if k>0:
+            n += k
+            saved += k * image_bytes(img)
+    return n, saved
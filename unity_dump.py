@@ -0,0 +1,176 @@
+import os
+import time
+import hashlib
+import numpy as np
+from mathutils import Matrix
+
+# Parsed dumps are saved here as .npz, named after the dump's path, size and modification time
+# (so that finding them doesn't need reading the dump), and re-importing the same character
+# skips parsing. The dump's MD5, computed while parsing, is saved along.
+cache_dir = os.path.join(os.path.dirname(__file__), "cache", "dumps")
+CACHE_VERSION = 2
+
+# Set to False to always parse the dump file (for benchmarking)
+use_cache = True
+_dumps = {}
+
+#
+# World space matrices of all cf_/cm_/p_c bones of a Unity dump.
+#
+# world[index[name]] is the (Blender-space) world matrix of bone 'name'; parent[k] is the row of
+# the bone's parent, or -1 if the parent came later in the dump (or had no matrix), in which case
+# the bone's local matrix is the same as its world matrix. Local matrices are only computed when
+# asked for.
+#
+# Also works as a read-only {name: Matrix} mapping of world matrices.
+#
+class UnityDump:
+    def __init__(self, names, world, parent, hash):
+        self.names = names
+        self.index = {x: k for k, x in enumerate(names)}
+        self.world = world
+        self.parent = parent
+        self.hash = hash
+        self.local = None
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __getitem__(self, name):
+        return Matrix(self.world[self.index[name]].tolist())
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def keys(self):
+        return list(self.names)
+
+    # (N,4,4) local matrices (parent.inverted() @ world), computed on first use
+    def local_matrices(self):
+        if self.local is None:
+            local = self.world.copy()
+            has_parent = self.parent>=0
+            local[has_parent] = np.linalg.inv(self.world[self.parent[has_parent]]) @ self.world[has_parent]
+            self.local = local
+        return self.local
+
+    # A new {name: Matrix} dict of local matrices
+    def local_dict(self):
+        local = self.local_matrices()
+        return {x: Matrix(local[k].tolist()) for k, x in enumerate(self.names)}
+
+# MD5 of the dump's text, from the parsed dump (so the dump is read at most once)
+def dump_hash(path):
+    return load_dump(path).hash
+
+# The lines of a text file, hashing them into 'h' as they are read
+def _hashed_lines(f, h):
+    for x in f:
+        h.update(x.encode('utf-8'))
+        yield x
+
+# Single pass over the dump, without keeping it in memory.
+# Returns (names, world (N,4,4), parent (N,), MD5 of the dump's text).
+def parse_dump(path):
+    h = hashlib.md5()
+    names = []
+    index = {}
+    world = []
+    parent = []
+    bone_parent = {}
+    root_pos = [0,0,0]
+    name = ''
+    with open(path, 'r') as text:
+        f = _hashed_lines(text, h)
+        first = True
+        for x in f:
+            x = x.strip()
+            if first:
+                first = False
+                if 'cf_J_Root' in x:
+                    x = 'cf_J_Root--UnityEngine.GameObject'
+                elif 'CommonSpace' in x:
+                    x = 'CommonSpace--UnityEngine.GameObject'
+                else:
+                    print(x)
+
+            if x.endswith('--UnityEngine.GameObject'):
+                name = x.split('-')[0]
+            elif x.startswith('@parent<Transform>'):
+                y = x.split()
+                bone_parent[name] = y[2] if len(y)>2 else None
+            elif x.startswith('@localToWorldMatrix<Matrix4x4>'):
+                if not name.startswith('cf_') \
+                    and not name.startswith('cm_') \
+                    and not name.startswith('p_c'):
+                    continue
+                m = [x.split()[-4:], next(f).split()[-4:], next(f).split()[-4:], next(f).split()[-4:]]
+                m = [[float(y) for y in z] for z in m]
+                if name=='cf_J_Root':
+                    root_pos = [m[0][3],m[1][3],m[2][3]]
+                m[0][3]-=root_pos[0]
+                m[1][3]-=root_pos[1]
+                m[2][3]-=root_pos[2]
+                m[0][1]*=-1
+                m[0][2]*=-1
+                m[0][3]*=-1
+                m[1][0]*=-1
+                m[2][0]*=-1
+                m[3][0]*=-1
+                if m[0][0]==0.0 and m[0][1]==0.0 and m[0][2]==0.0:
+                    m[0][0]=0.0010
+                if m[1][0]==0.0 and m[1][1]==0.0 and m[1][2]==0.0:
+                    m[1][1]=0.0010
+                if m[2][0]==0.0 and m[2][1]==0.0 and m[2][2]==0.0:
+                    m[2][2]=0.0010
+                p = index.get(bone_parent.get(name), -1)
+                if name in index:
+                    world[index[name]] = m
+                    parent[index[name]] = p
+                else:
+                    index[name] = len(names)
+                    names.append(name)
+                    world.append(m)
+                    parent.append(p)
+    return names, np.array(world, dtype=np.float64).reshape([-1,4,4]), np.array(parent, dtype=np.int64), h.digest()
+
+def _cache_path(path):
+    st = os.stat(path)
+    key = hashlib.md5(os.path.abspath(path).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, "%s_%d_%d_v%d.npz" % (key, st.st_size, st.st_mtime_ns, CACHE_VERSION))
+
+# Returns the UnityDump for the dump file at 'path', from memory or the on-disk cache if this
+# dump file has been loaded before and hasn't changed since; otherwise it is read once.
+def load_dump(path):
+    t1 = time.time()
+    fn = _cache_path(path)
+    if use_cache and fn in _dumps:
+        return _dumps[fn]
+    dump = None
+    if use_cache and os.path.exists(fn):
+        try:
+            with np.load(fn) as f:
+                dump = UnityDump(f["names"].tolist(), f["world"], f["parent"], f["hash"].tobytes())
+        except Exception as e:
+            print("Failed to read cached dump", fn, e)
+    if dump is None:
+        dump = UnityDump(*parse_dump(path))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = fn + ".tmp.npz"
+            np.savez(tmp, names=np.array(dump.names), world=dump.world, parent=dump.parent,
+                hash=np.frombuffer(dump.hash, dtype=np.uint8))
+            os.replace(tmp, fn)
+        except Exception as e:
+            print("Failed to cache dump", fn, e)
+        print("Dump parsed in %.3f s (%d bones)" % (time.time()-t1, len(dump)))
+    else:
+        print("Dump loaded from cache in %.3f s (%d bones)" % (time.time()-t1, len(dump)))
+    _dumps[fn] = dump
+    return dump
+
+def clear_dump_cache():
+    _dumps.clear()
@@ -0,0 +1,262 @@
+import numpy as np
+
+# Vertex groups are addressed as vertex*GROUP_STRIDE+group in a single sorted key array,
+# so a mesh can't have more vertex groups than this.
+GROUP_STRIDE = 1<<20
+
+# Set to False to rebuild the table on every get_weight_table call (for benchmarking)
+use_cache = True
+_tables = {}
+# Tables are only kept between get_weight_table calls within a caching pass (an import, a tweak
+# operator), see begin_caching(). Outside of one, weights painted or changed by operators since
+# are always read again.
+_caching = 0
+
+# Reads all vertex group weights of 'mesh' in one pass and returns them as a
+# CSR (vertex x group) matrix: row x holds the groups of vertex x in
+# indices[indptr[x]:indptr[x+1]] and their weights in data[indptr[x]:indptr[x+1]],
+# in the same order as mesh.vertices[x].groups.
+def read_weights_csr(mesh):
+    groups = [v.groups for v in mesh.vertices]
+    counts = np.fromiter((len(g) for g in groups), dtype=np.int64, count=len(groups))
+    indptr = np.zeros([len(groups)+1], dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+    nnz = int(indptr[-1])
+    indices = np.fromiter((e.group for g in groups for e in g), dtype=np.int32, count=nnz)
+    data = np.fromiter((e.weight for g in groups for e in g), dtype=np.float32, count=nnz)
+    return indptr, indices, data
+
+# Concatenation of range(lo[k], hi[k]) for all k
+def _ranges(lo, hi):
+    n = hi-lo
+    return np.arange(n.sum(), dtype=np.int64) + np.repeat(lo-(np.cumsum(n)-n), n)
+
+# Blender stores weights as float32 clamped to [0,1]; values read back after a write
+# should look exactly like they would if they had gone through vertex.groups.
+def _stored(w):
+    return np.clip(w, 0.0, 1.0).astype(np.float32).astype(np.float64)
+
+#
+# All vertex group weights of a mesh object, loaded once into a sparse (vertex x group) table.
+#
+# Every operation takes an array of vertex indices. A group is a vertex group index or name;
+# get() and add() also accept a list/tuple of groups (summed / distributed proportionally, like
+# get_weight and add_weight), and get/set/add accept an integer array with one group per vertex.
+# Nothing is written to the mesh until flush(), which pushes every modified group back
+# with a handful of VertexGroup.add calls.
+#
+class WeightTable:
+    def __init__(self, obj):
+        self.obj = obj
+        indptr, indices, data = read_weights_csr(obj.data)
+        rows = np.repeat(np.arange(len(indptr)-1, dtype=np.int64), np.diff(indptr))
+        keys = rows*GROUP_STRIDE + indices
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.weights = data[order].astype(np.float64)
+        self.flushed_keys = self.keys.copy()
+        self.flushed_weights = self.weights.copy()
+        self.dirty = set()
+        self.columns = {}
+        self.signature = _signature(obj)
+        self.group_names = [g.name for g in obj.vertex_groups]
+
+    def group_index(self, group):
+        if isinstance(group, str):
+            return self.obj.vertex_groups[group].index
+        return group
+
+    def new_group(self, name):
+        if not name in self.obj.vertex_groups:
+            self.obj.vertex_groups.new(name=name)
+            self.group_names.append(name)
+        return self.obj.vertex_groups[name].index
+
+    # Removing a vertex group shifts the indices of all groups after it; the table follows along.
+    def remove_group(self, group):
+        g = self.group_index(group)
+        self.obj.vertex_groups.remove(self.obj.vertex_groups[g])
+        def drop(keys, weights):
+            keep = (keys % GROUP_STRIDE) != g
+            keys = keys[keep]
+            return keys - ((keys % GROUP_STRIDE) > g), weights[keep]
+        self.keys, self.weights = drop(self.keys, self.weights)
+        self.flushed_keys, self.flushed_weights = drop(self.flushed_keys, self.flushed_weights)
+        self.dirty = set([x-1 if x>g else x for x in self.dirty if x!=g])
+        self.columns = {}
+        del self.group_names[g]
+
+    def _find(self, verts, group):
+        keys = np.asarray(verts, dtype=np.int64)*GROUP_STRIDE + np.asarray(group, dtype=np.int64)
+        pos = np.searchsorted(self.keys, keys)
+        found = np.zeros(keys.shape, dtype=bool)
+        inside = pos<len(self.keys)
+        found[inside] = self.keys[pos[inside]]==keys[inside]
+        return keys, pos, found
+
+    # Positions of (verts, group) entries, creating zero-weight entries where missing
+    def _entries(self, verts, group):
+        keys, pos, found = self._find(verts, group)
+        if not found.all():
+            missing = np.unique(keys[~found])
+            at = np.searchsorted(self.keys, missing)
+            self.keys = np.insert(self.keys, at, missing)
+            self.weights = np.insert(self.weights, at, 0.0)
+            pos = np.searchsorted(self.keys, keys)
+        self._touch(keys)
+        return pos
+
+    def _touch(self, keys):
+        groups = np.unique(keys % GROUP_STRIDE).tolist()
+        self.dirty.update(groups)
+        for g in groups:
+            self.columns.pop(g, None)
+
+    # Positions of all entries belonging to 'verts', and the index into 'verts' each one belongs to
+    def _row_entries(self, verts):
+        verts = np.asarray(verts, dtype=np.int64)
+        lo = np.searchsorted(self.keys, verts*GROUP_STRIDE)
+        hi = np.searchsorted(self.keys, (verts+1)*GROUP_STRIDE)
+        return _ranges(lo, hi), np.repeat(np.arange(len(verts)), hi-lo)
+
+    # (vertex indices, weights) of all members of one group, sorted by vertex index
+    def column(self, group):
+        g = self.group_index(group)
+        if not g in self.columns:
+            sel = (self.keys % GROUP_STRIDE)==g
+            self.columns[g] = (self.keys[sel] // GROUP_STRIDE, self.weights[sel])
+        return self.columns[g]
+
+    # Same as add_extras.vgroup: vertices with weight above min_wt in 'group' (or any of a list of groups).
+    # Names that don't exist are skipped.
+    def members(self, group, min_wt=None):
+        if min_wt is None:
+            min_wt = 0.0
+        names = group if isinstance(group, list) else [group]
+        ids = [self.group_index(g) for g in names if not isinstance(g, str) or g in self.obj.vertex_groups]
+        verts = [v[w>min_wt] for v, w in [self.column(g) for g in ids]]
+        if len(verts)==1:
+            return verts[0]
+        return np.unique(np.concatenate([np.zeros([0], dtype=np.int64)]+verts))
+
+    def has(self, verts, group):
+        return self._find(verts, self.group_index(group))[2]
+
+    def get(self, verts, group):
+        if isinstance(group, (list, tuple)):
+            return sum([self.get(verts, g) for g in group])
+        keys, pos, found = self._find(verts, self.group_index(group))
+        out = np.zeros(keys.shape)
+        out[found] = self.weights[pos[found]]
+        return out
+
+    # Like set_weight, this adds 'verts' to the group even where the new weight is zero
+    def set(self, verts, group, weights):
+        pos = self._entries(verts, self.group_index(group))
+        self.weights[pos] = _stored(np.broadcast_to(weights, pos.shape))
+
+    def add(self, verts, group, weights):
+        if isinstance(group, (list, tuple)):
+            ids = [self.group_index(g) for g in group]
+            wts = np.stack([self.get(verts, g) for g in ids])
+            wtot = wts.sum(axis=0)
+            share = np.where(wtot==0.0, 1.0/len(ids), wts/np.where(wtot==0.0, 1.0, wtot))
+            for g, s in zip(ids, share):
+                self.add(verts, g, weights*s)
+            return
+        pos = self._entries(verts, self.group_index(group))
+        upos, inv = np.unique(pos, return_inverse=True)
+        delta = np.bincount(inv.reshape([-1]), weights=np.broadcast_to(weights, pos.shape).reshape([-1]), minlength=len(upos))
+        self.weights[upos] = _stored(self.weights[upos] + delta)
+
+    # Multiplies the weight of 'group' (or of every group, if None) on each vertex by 'factors'
+    def scale(self, verts, factors, group=None):
+        if group is not None:
+            self.set(verts, group, self.get(verts, group)*factors)
+            return
+        f = np.broadcast_to(np.asarray(factors, dtype=np.float64), np.shape(verts))
+        pos, owner = self._row_entries(verts)
+        self.weights[pos] = _stored(self.weights[pos]*f[owner])
+        self._touch(self.keys[pos])
+
+    # All entries of 'verts' as (index into verts, group, weight) arrays
+    def rows(self, verts):
+        pos, owner = self._row_entries(verts)
+        return owner, self.keys[pos] % GROUP_STRIDE, self.weights[pos]
+
+    def row_sum(self, verts):
+        pos, owner = self._row_entries(verts)
+        return np.bincount(owner, weights=self.weights[pos], minlength=len(verts))
+
+    # Rescales all groups on each vertex so that their weights add up to 'total'
+    def normalize(self, verts, total=1.0):
+        s = self.row_sum(verts)
+        self.scale(verts, np.where(s>0.0, total/np.where(s>0.0, s, 1.0), 1.0))
+
+    # Writes modified weights back to the mesh. VertexGroup.add takes one weight for a
+    # list of vertices, so changed entries of each group are bucketed by value.
+    def flush(self):
+        for g in sorted(self.dirty):
+            cur = (self.keys % GROUP_STRIDE) == g
+            keys, wts = self.keys[cur], self.weights[cur]
+            old = (self.flushed_keys % GROUP_STRIDE) == g
+            okeys, owts = self.flushed_keys[old], self.flushed_weights[old]
+            pos = np.searchsorted(okeys, keys)
+            same = np.zeros(len(keys), dtype=bool)
+            inside = pos<len(okeys)
+            same[inside] = (okeys[pos[inside]]==keys[inside]) & (owts[pos[inside]]==wts[inside])
+            keys, wts = keys[~same], wts[~same]
+            if len(keys)==0:
+                continue
+            values, inv = np.unique(wts, return_inverse=True)
+            order = np.argsort(inv, kind='stable')
+            bounds = np.cumsum(np.bincount(inv, minlength=len(values)))
+            vg = self.obj.vertex_groups[g]
+            for k, chunk in enumerate(np.split(keys[order] // GROUP_STRIDE, bounds[:-1])):
+                vg.add(chunk.tolist(), float(values[k]), 'REPLACE')
+        self.flushed_keys = self.keys.copy()
+        self.flushed_weights = self.weights.copy()
+        self.dirty = set()
+
+
+def _signature(obj):
+    return (obj.data.name, len(obj.data.vertices), len(obj.data.edges))
+
+# Returns the weight table of 'obj'. Within a caching pass, it is loaded only if the mesh changed
+# since the last call: vertex count, edge count and vertex group names are checked here; code in
+# the pass that writes weights without going through the table (VertexGroup.add, vertex.groups,
+# bpy.ops) must call invalidate_weight_table() afterwards. Edits made through the table are
+# visible to later callers in the pass right away, but only reach the mesh on flush().
+def get_weight_table(obj):
+    if _caching==0:
+        return WeightTable(obj)
+    key = obj.as_pointer()
+    table = _tables.get(key)
+    if use_cache and table is not None and table.signature==_signature(obj):
+        names = [g.name for g in obj.vertex_groups]
+        # groups appended since the table was loaded are still empty
+        if names[:len(table.group_names)]==table.group_names:
+            table.obj = obj
+            table.group_names = names
+            return table
+    table = WeightTable(obj)
+    _tables[key] = table
+    return table
+
+def invalidate_weight_table(obj):
+    _tables.pop(obj.as_pointer(), None)
+
+def clear_weight_tables():
+    _tables.clear()
+
+# Starts a caching pass; every begin_caching() needs an end_caching(), e.g. in a finally
+def begin_caching():
+    global _caching
+    _caching += 1
+
+# Ends a caching pass; the tables are dropped when the outermost one ends
+def end_caching():
+    global _caching
+    _caching = max(0, _caching-1)
+    if _caching==0:
+        _tables.clear()